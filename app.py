@@ -1,33 +1,100 @@
-from flask import Flask, request, jsonify
-from flask_bcrypt import Bcrypt
+import time
+startup_started = time.perf_counter()  # Measures import and startup time
+
+from flask import Flask, Request, request, jsonify, g, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from keras.models import load_model
-from keras.preprocessing import image
-from keras.applications.mobilenet import preprocess_input
 import numpy as np
 from flask_cors import CORS
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
-from PIL import Image
-import io
-import uuid
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, PyMongoError
 import os
+import atexit
+import itertools
+import hmac
+import logging
+import threading
+import uuid
 from bson import ObjectId
 from datetime import datetime
 from datetime import timedelta
 from dotenv import load_dotenv
+from batching import MicroBatcher, InferenceBusy
+from inference_pool import InferencePool
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from model_runtime import class_list, LazyRuntime
+from diagnostics import memory_stats
+from catalog import CatalogCache, FIELDS as CATALOG_FIELDS, variant_etag
+import history
+from db_indexes import ensure_indexes
+from functools import wraps
+from passwords import PasswordHasher, AuthBusy
+from tta import TTAPolicy
+from embeddings import EmbeddingStore, EmbeddingPipeline
+from postprocessing import PostProcessor, load_calibration
+from imaging import read_pixels, preprocess, UploadArchiver
+from uploads import UploadBuffer, UploadRejected
+from PIL import Image
+from werkzeug.exceptions import RequestEntityTooLarge
+from prediction_cache import PredictionCache, RedisBackend, key_for_bytes, key_for_array
+import metrics
+import database
+import streaming
+from database import CircuitOpen
+from logs import configure_logging
+from profiler import SamplingProfiler
 
 load_dotenv()
+
+# Log records are written by a background thread; LOG_LEVEL=DEBUG also logs
+# every prediction
+configure_logging(os.getenv('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+
+class UploadRequest(Request):
+    """Streams each uploaded file into a size-limited in-memory buffer that
+    checks the image header as it arrives, instead of spooling it to disk."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadBuffer(max_upload_bytes, Image.MAX_IMAGE_PIXELS)
+
+    def _load_form_data(self):
+        try:
+            super()._load_form_data()
+        except RequestEntityTooLarge:
+            raise UploadRejected(f"Request is larger than {self.max_content_length / (1024 * 1024):g} MB", 413)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify through streaming.dumps: orjson when it is installed, and
+    ObjectIds written as strings."""
+
+    def dumps(self, obj, **kwargs):
+        return streaming.dumps(obj, sort_keys=self.sort_keys).decode("utf-8")
+
+
 app = Flask(__name__)
-bcrypt = Bcrypt(app)
+app.request_class = UploadRequest
+app.json = FastJSONProvider(app)
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')  # Get JWT Secret Key
 uri = os.getenv('MONGO_URI')  # Get MongoDB URI
 app.config['TESTING'] = False
 jwt = JWTManager(app)
+
+# Upload limits: the whole request body, each uploaded file, and the pixels
+# of an image. Oversized files and non-images are rejected while they are
+# still arriving; a non-image only fails its own file.
+app.config['MAX_CONTENT_LENGTH'] = int(float(os.getenv('MAX_REQUEST_MB', 64)) * 1024 * 1024)
+max_upload_bytes = int(float(os.getenv('MAX_UPLOAD_MB', 10)) * 1024 * 1024)
+Image.MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 40_000_000))
 CORS(app, resources={r"/*": {"origins": "*"}})  # Enable CORS for all origins
 
-# Create a new client and connect to the server
-client = MongoClient(uri, server_api=ServerApi('1'))
+# Create a new client; it connects on first use, so it is safe to create
+# before a forking server starts its workers. Pool size and timeouts come
+# from the MONGO_* settings (see database.py), and every command's latency
+# and connection checkout wait is recorded for /metrics.
+pool_metrics = metrics.PoolMetrics()
+client = database.create_client(uri, listeners=[metrics.CommandMetrics(), pool_metrics])
 if app.config['TESTING']:
     db = client.SnakesG1_test  # Use test database
 else:
@@ -36,40 +103,421 @@ else:
 users_collection = db.users
 snakes_collection = db.snakes 
 
-# Load your trained snake prediction model
-model = load_model("mobilenet-ft.h5")
-
-# Define your list of snake classes
-class_list = ["Cobra", "Common Krait", "Hump nosed pit viper", "Python", "Rat snake", "Russell's viper", "Saw Scaled Viper"]
-
-def serialize_snake(snake):
-    # Convert ObjectId to string for JSON serialization
-    snake['_id'] = str(snake['_id'])
-    return snake
+# Each group of database calls in a request (see db_deadline) must finish
+# within MONGO_REQUEST_TIMEOUT_MS (0: no limit); slower requests get a 504
+mongo_request_timeout = float(os.getenv('MONGO_REQUEST_TIMEOUT_MS', 5000)) / 1000.0
+
+# The snake catalog is small and rarely changes, so it is served from memory.
+# CATALOG_READ_PREFERENCE=secondaryPreferred loads it from secondaries. A
+# load that fails or takes over CATALOG_SLOW_MS counts against a circuit
+# breaker; while it is open the last loaded catalog is served. Every worker
+# reloads it at least every CATALOG_MAX_AGE_S seconds (0: only on writes).
+catalog_read_preference = database.read_preference(
+    os.getenv('CATALOG_READ_PREFERENCE', 'primary'), int(os.getenv('CATALOG_MAX_STALENESS_S', -1)))
+catalog_breaker = database.CircuitBreaker(
+    failure_threshold=int(os.getenv('CATALOG_BREAKER_FAILURES', 3)),
+    reset_seconds=float(os.getenv('CATALOG_BREAKER_RESET_S', 30)),
+    slow_call_seconds=float(os.getenv('CATALOG_SLOW_MS', 500)) / 1000.0,
+)
+catalog = CatalogCache(
+    database.with_read_preference(snakes_collection, catalog_read_preference),
+    breaker=catalog_breaker,
+    load_timeout=float(os.getenv('CATALOG_TIMEOUT_MS', 2000)) / 1000.0,
+    max_age=float(os.getenv('CATALOG_MAX_AGE_S', 300)),
+    # Started by each worker on its first catalog read, after the fork
+    watch_changes=os.getenv('CATALOG_CHANGE_STREAM', '').lower() in ('1', 'true', 'yes'),
+)
+
+# Set INFERENCE_ENABLED=false to serve only the account and catalog routes;
+# TensorFlow is then never imported
+inference_enabled = os.getenv('INFERENCE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+max_batch_size = int(os.getenv('PREDICT_MAX_BATCH_SIZE', 8))
+
+# Your trained snake prediction model, with the configured runtime backend.
+# It is loaded by create_app() or on first use, not at import time.
+model = LazyRuntime(
+    os.getenv('MODEL_BACKEND', 'keras'),
+    os.getenv('MODEL_PATH'),
+    warmup_batch_sizes=(1, max_batch_size) if os.getenv('MODEL_WARMUP', 'true').lower() in ('1', 'true', 'yes') else None,
+)
+
+# INFERENCE_MODE=inline runs the model on the web worker, micro-batching
+# concurrent requests. INFERENCE_MODE=pool hands preprocessed images to a pool
+# of dedicated inference processes so slow forward passes never block the
+# catalog and account routes.
+inference_mode = os.getenv('INFERENCE_MODE', 'inline')
+
+# EMBEDDINGS_ENABLED=true also returns each image's penultimate-layer
+# embedding from the model, stores it for /similar and reuses the prediction
+# of near-identical earlier uploads. Needs the keras or tf-function backend
+# and inline inference.
+embedding_pipeline = None
+if os.getenv('EMBEDDINGS_ENABLED', '').lower() in ('1', 'true', 'yes'):
+    if inference_mode == 'inline' and model.backend in ('keras', 'tf-function'):
+        embedding_pipeline = EmbeddingPipeline(
+            model,
+            EmbeddingStore(
+                os.getenv('EMBEDDINGS_DIR', 'embeddings'),
+                len(class_list),
+                ivf_min_items=int(os.getenv('EMBEDDINGS_IVF_MIN_ITEMS', 20000)),
+                nprobe=int(os.getenv('EMBEDDINGS_IVF_NPROBE', 8)),
+            ),
+            dedupe_threshold=float(os.getenv('DEDUPE_THRESHOLD', 0.98)),
+        )
+    else:
+        logger.warning("Embeddings need inline inference with the keras or tf-function backend; disabled")
+
+def forward(batch):
+    # One forward pass of the micro-batcher, timed for /metrics
+    metrics.BATCH_SIZE.observe(len(batch))
+    with metrics.stage("forward"):
+        return (embedding_pipeline or model).predict(batch)
+
+inference_max_queue = int(os.getenv('INFERENCE_MAX_QUEUE', 64))
+if inference_mode == 'pool':
+    inference = InferencePool(
+        model.backend,
+        model.path,
+        num_workers=int(os.getenv('INFERENCE_WORKERS', 2)),
+        cores_per_worker=int(os.getenv('INFERENCE_CORES_PER_WORKER', 0)) or None,
+        intra_op_threads=int(os.getenv('INFERENCE_THREADS', 1)),
+        max_queue=inference_max_queue,
+        max_batch_size=max_batch_size,
+        max_in_flight=float(os.getenv('INFERENCE_MAX_IN_FLIGHT', 120)),
+    )
+else:
+    inference = MicroBatcher(
+        forward,
+        max_batch_size=max_batch_size,
+        max_wait_ms=float(os.getenv('PREDICT_MAX_WAIT_MS', 5)),
+        max_queue=inference_max_queue,
+    )
 
-def save_prediction(user_id, snake, accuracy):
-    timestamp = datetime.utcnow().isoformat()
-    prediction = {
+# Seconds a request waits for its prediction, and the Retry-After sent when
+# the inference queue is full
+predict_timeout = float(os.getenv('PREDICT_TIMEOUT', 30))
+retry_after = os.getenv('PREDICT_RETRY_AFTER', '1')
+
+# Optionally keep a copy of every upload in static/, written in the background
+archiver = UploadArchiver("static") if os.getenv('ARCHIVE_UPLOADS', '').lower() in ('1', 'true', 'yes') else None
+
+# Cache of prediction probabilities keyed by a hash of the uploaded image
+cache_url = os.getenv('PREDICTION_CACHE_URL')
+prediction_cache = PredictionCache(
+    max_entries=int(os.getenv('PREDICTION_CACHE_SIZE', 1024)),
+    ttl_seconds=float(os.getenv('PREDICTION_CACHE_TTL', 3600)),
+    backend=RedisBackend(cache_url) if cache_url else None,
+)
+cache_pixel_keys = os.getenv('PREDICTION_CACHE_PIXEL_KEYS', '').lower() in ('1', 'true', 'yes')
+
+# Prediction history kept per user, and the page size of /account/predictions
+history_limit = int(os.getenv('HISTORY_LIMIT', 100))
+history_page_size = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+
+# Prediction history is written in the background, in bulk, so /predict
+# never waits on the database
+history_writer = history.HistoryWriter(
+    users_collection,
+    limit=history_limit,
+    batch_size=int(os.getenv('HISTORY_WRITE_BATCH_SIZE', 100)),
+    flush_interval=float(os.getenv('HISTORY_WRITE_INTERVAL', 0.5)),
+    max_queue=int(os.getenv('HISTORY_WRITE_MAX_QUEUE', 10000)),
+)
+atexit.register(history_writer.close)
+
+# Password hashing runs on its own small thread pool. BCRYPT_ROUNDS is the
+# cost factor; stored hashes made with another one are upgraded on login.
+# Beyond AUTH_MAX_PENDING hashes in progress, auth requests get a 429.
+password_hasher = PasswordHasher(
+    rounds=int(os.getenv('BCRYPT_ROUNDS', 12)),
+    max_workers=int(os.getenv('AUTH_HASH_WORKERS', 2)),
+    max_pending=int(os.getenv('AUTH_MAX_PENDING', 16)),
+)
+auth_retry_after = os.getenv('AUTH_RETRY_AFTER', '1')
+
+# Temperature fitted offline by calibrate.py (CALIBRATION_FILE), and the
+# top-class probability below which a result is flagged uncertain
+calibration_file = os.getenv('CALIBRATION_FILE')
+postprocessor = PostProcessor(
+    class_list,
+    temperature=load_calibration(calibration_file)['temperature'] if calibration_file else 1.0,
+    uncertain_threshold=float(os.getenv('PREDICT_UNCERTAIN_THRESHOLD', 0.5)),
+)
+
+# Test-time augmentation: /predict?tta=auto runs TTA_VIEWS augmented views of
+# the image in one batch when the single view is less confident than
+# TTA_THRESHOLD; tta=always does so for every image. TTA_DEFAULT applies
+# when the request does not say.
+tta_policy = TTAPolicy(views=int(os.getenv('TTA_VIEWS', 4)), threshold=float(os.getenv('TTA_THRESHOLD', 0.6)))
+tta_default = os.getenv('TTA_DEFAULT', 'off')
+
+# Documents fetched per round trip when streaming a list response
+stream_batch_size = int(os.getenv('STREAM_BATCH_SIZE', 100))
+
+# Most images accepted by a single /predict/batch request
+batch_max_images = int(os.getenv('PREDICT_BATCH_MAX_IMAGES', 32))
+
+# With PROFILE_TOKEN set, a request with the header "X-Profile: <token>" is
+# run under a sampling profiler and its stacks are saved to PROFILE_DIR
+profile_token = os.getenv('PROFILE_TOKEN')
+profile_dir = os.getenv('PROFILE_DIR', 'profiles')
+profile_interval = float(os.getenv('PROFILE_INTERVAL_MS', 5)) / 1000.0
+
+# Queue depths and batch size, read when /metrics is scraped
+metrics.registry.gauge("snake_inference_queue_depth", "Images waiting for the model.",
+                       lambda: inference.stats()["queue_depth"])
+metrics.registry.gauge("snake_inference_last_batch_size", "Images in the latest forward pass.",
+                       lambda: inference.stats().get("last_batch_size"))
+metrics.registry.gauge("snake_history_queue_depth", "Prediction history writes waiting for the database.",
+                       lambda: history_writer.stats()["queue_depth"])
+metrics.registry.gauge("snake_mongodb_connections_checked_out", "Pooled MongoDB connections in use.",
+                       lambda: pool_metrics.checked_out)
+metrics.registry.gauge("snake_catalog_breaker_open", "Whether the catalog is being served from cache because the database is failing.",
+                       lambda: int(catalog_breaker.state != "closed"))
+
+startup_stats = {"import_seconds": round(time.perf_counter() - startup_started, 3)}
+
+def preload_inference(warm_up=True):
+    """Loads the model, or starts the inference pool, before the first request."""
+    if not inference_enabled:
+        return
+    if inference_mode == 'pool':
+        # Pool workers load their own model. A preloading master leaves
+        # starting them to each forked web worker.
+        if warm_up:
+            inference.start()
+    else:
+        model.load(warmup=warm_up)
+
+
+def create_app(preload_model=None, warm_up=True):
+    """Application factory for `python app.py` and gunicorn (see gunicorn.conf.py).
+
+    With preload_model (default: the PRELOAD_MODEL setting, on unless set to
+    false) the model is loaded before the first request. A preloading gunicorn
+    master passes warm_up=False and warms the model up in each worker instead.
+    """
+    if preload_model is None:
+        preload_model = os.getenv('PRELOAD_MODEL', 'true').lower() in ('1', 'true', 'yes')
+
+    # Unique indexes on users.email and snakes.name. A short-lived client is
+    # used so the shared one stays unconnected until the workers are forked.
+    # Duplicate emails and snake names are only rejected by these indexes, so
+    # the app does not start without them.
+    if os.getenv('ENSURE_INDEXES', 'true').lower() in ('1', 'true', 'yes'):
+        with database.create_client(uri) as index_client:
+            ensure_indexes(index_client[db.name])
+
+    if preload_model:
+        preload_inference(warm_up)
+
+    startup_stats["ready_seconds"] = round(time.perf_counter() - startup_started, 3)
+    logger.info("Startup took %.2fs %s", startup_stats['ready_seconds'], memory_stats())
+    return app
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(e):
+    return jsonify({"error": str(e)}), e.status
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({"error": f"Request is larger than {app.config['MAX_CONTENT_LENGTH'] / (1024 * 1024):g} MB"}), 413
+
+@app.errorhandler(PyMongoError)
+def database_error(e):
+    # Past the request's deadline, or the database cannot be reached
+    if e.timeout:
+        return jsonify({"error": "The database did not respond in time."}), 504
+    if isinstance(e, ConnectionFailure):
+        return jsonify({"error": "The database is unavailable."}), 503, {"Retry-After": retry_after}
+    return jsonify({"error": str(e)}), 500
+
+@app.errorhandler(CircuitOpen)
+def circuit_open(e):
+    return jsonify({"error": str(e)}), 503, {"Retry-After": retry_after}
+
+def inference_required(view):
+    # Prediction routes answer 503 when the server runs without the model
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not inference_enabled:
+            return jsonify({"error": "Prediction is disabled on this server."}), 503
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.timings = metrics.start_request_timings()
+    if profile_token and hmac.compare_digest(request.headers.get('X-Profile', '').encode(), profile_token.encode()):
+        g.profiler = SamplingProfiler(threading.get_ident(), profile_interval).start()
+
+@app.after_request
+def finish_request_metrics(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        response.headers['X-Profile-Id'] = save_profile(profiler.stop())
+    if g.get('timings'):
+        response.headers['Server-Timing'] = metrics.server_timing(g.timings)
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, route, request.method, str(response.status_code))
+    return response
+
+def db_deadline():
+    """Gives the database calls inside it, together, MONGO_REQUEST_TIMEOUT_MS.
+    Routes wrap only their database calls in it, so receiving an upload,
+    inference and password hashing do not use up the deadline."""
+    return database.request_deadline(mongo_request_timeout)
+
+def save_profile(profiler):
+    # Folded stacks for flamegraph.pl or speedscope, named by the returned id
+    profile_id = uuid.uuid4().hex
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, profile_id + ".folded")
+    with open(path, "w") as f:
+        f.write(profiler.collapsed())
+    logger.info("Profiled %s %s: %d samples in %.3fs, saved to %s; top frames %s",
+                request.method, request.path, profiler.samples, profiler.duration, path, profiler.top(5))
+    return profile_id
+
+def decode_image(data, out=None):
+    # imaging.decode_image, timed as its decode and preprocess stages
+    with metrics.stage("decode"):
+        img = read_pixels(data)
+    with metrics.stage("preprocess"):
+        return preprocess(img, out)
+
+def make_prediction_record(snake, accuracy):
+    return {
         "snake": snake,
         "accuracy": accuracy,
-        "timestamp": timestamp
+        "timestamp": datetime.utcnow().isoformat()
     }
-    
-    result = users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$push": {"recent_predictions": prediction}}
-    )
 
-    # Debugging statements
-    print("Update result matched_count:", result.matched_count)
-    print("Update result modified_count:", result.modified_count)
-
-    if result.matched_count == 0:
-        print("No user found with ID:", user_id)
-    if result.modified_count == 0:
-        print("No update performed for user ID:", user_id)
-
-    return result
+def describe_predictions(probabilities, k=None, lookup=None):
+    """Results for a batch of probabilities. Without k only the top snake and
+    its accuracy are given; with k also the k most likely snakes, joined to
+    their catalog entries in `lookup`, and whether the result is uncertain."""
+    results = postprocessor(probabilities, k or 1, lookup if k else None)
+    if not k:
+        return [{"snake": result["snake"], "accuracy": result["accuracy"]} for result in results]
+    return results
+
+def upload_bytes(file):
+    """The bytes of an uploaded file; raises the UploadRejected of a header
+    that was not an accepted image while it arrived."""
+    rejected = getattr(file.stream, 'rejected', None)
+    if rejected is not None:
+        raise rejected
+    return file.read()
+
+def read_uploads(files, read=upload_bytes):
+    # The bytes of each file (None where its header was rejected) and the
+    # rejected files' errors by index, for classify_batch
+    uploads, errors = [], {}
+    for i, file in enumerate(files):
+        try:
+            uploads.append(read(file))
+        except UploadRejected as e:
+            uploads.append(None)
+            errors[i] = f"Could not read image: {e}"
+    return uploads, errors
+
+def classify_batch(uploads, errors=None):
+    """Classifies a list of uploaded files' bytes in as few forward passes as
+    the inference engine's batch size allows. Uploads that are None already
+    have their error in `errors` and are skipped.
+
+    Returns the probabilities of each image (None where it could not be
+    decoded) and a dict of decode errors by index.
+    """
+    probabilities = [None] * len(uploads)
+    keys = [None] * len(uploads)
+    errors = dict(errors or {})
+
+    # Serve cached files first and decode the rest into one batch tensor
+    batch = np.empty((len(uploads), 224, 224, 3), dtype=np.float32)
+    pending = []
+    filenames = [None] * len(uploads)
+    for i, data in enumerate(uploads):
+        if data is None:
+            continue
+        if archiver is not None:
+            filenames[i] = archiver.archive(data)
+
+        keys[i] = key_for_bytes(data)
+        probabilities[i] = prediction_cache.get(keys[i])
+        if probabilities[i] is not None:
+            continue
+        try:
+            decode_image(data, out=batch[len(pending)])
+        except Exception as e:
+            errors[i] = f"Could not read image: {e}"
+            continue
+        pending.append(i)
+
+    # Every image that was not cached, queued for inference together
+    if pending:
+        predictions, embeddings, duplicate = split_predictions(inference.predict_many(batch[:len(pending)], timeout=predict_timeout))
+        for row, i in enumerate(pending):
+            probabilities[i] = predictions[row]
+            prediction_cache.set(keys[i], predictions[row])
+        if embeddings is not None and not duplicate.all():
+            remember_embeddings(embeddings[~duplicate], predictions[~duplicate],
+                                [filenames[i] for row, i in enumerate(pending) if not duplicate[row]])
+
+    return probabilities, errors
+
+def split_predictions(rows):
+    """Probabilities, embeddings and duplicate flags of inference output; the
+    last two are None unless embeddings are enabled."""
+    if embedding_pipeline is None:
+        return rows, None, None
+    return embedding_pipeline.split(rows)
+
+def remember_embeddings(embeddings, probabilities, images):
+    """Stores new images' embeddings for /similar, with their top prediction."""
+    results = describe_predictions(probabilities)
+    timestamp = datetime.now().isoformat()
+    items = [dict(result, timestamp=timestamp, image=image) for result, image in zip(results, images)]
+    try:
+        embedding_pipeline.store.add(embeddings, probabilities, items)
+    except Exception as e:
+        logger.error("Error storing embeddings: %s", e)
+
+def tta_predictions(data, predictions, mode, img_array=None):
+    """Probabilities for an upload after test-time augmentation, if the
+    policy calls for it, and the number of views they came from."""
+    if not tta_policy.should_augment(predictions, mode):
+        return predictions, 1
+
+    key = f"{key_for_bytes(data)}:tta{tta_policy.views}"
+    merged = prediction_cache.get(key)
+    if merged is None:
+        if img_array is None:
+            img_array = decode_image(data)
+        # The single-view predictions are reused, so only K - 1 views are run
+        merged = tta_policy.run(img_array, lambda views: split_predictions(inference.predict_many(views, timeout=predict_timeout))[0],
+                                predictions)
+        prediction_cache.set(key, merged)
+    return merged, tta_policy.views
+
+def batch_results(filenames, probabilities, errors, k, lookup=None):
+    # Per-image response entries plus the history records to save
+    results = [{"filename": filename} for filename in filenames]
+    classified = [i for i, probs in enumerate(probabilities) if probs is not None]
+    for i in range(len(filenames)):
+        if probabilities[i] is None:
+            results[i]["error"] = errors.get(i)
+
+    # Post-processed as one array
+    described = describe_predictions(np.array([probabilities[i] for i in classified]), k, lookup) if classified else []
+    records = []
+    for i, result in zip(classified, described):
+        results[i].update(result)
+        records.append(make_prediction_record(result["snake"], result["accuracy"]))
+    return results, records
 
 
 @app.route("/", methods=["GET"])
@@ -78,18 +526,19 @@ def home():
     return "Snake Prediction API is running!"
 
 
+def auth_busy(e):
+    return jsonify({"error": str(e)}), 429, {"Retry-After": auth_retry_after}
+
 @app.route('/register', methods=['POST'])
 def register():
     data = request.json
     if not data or not data.get('email') or not data.get('password'):
         return jsonify({"error": "Email and password are required"}), 400
 
-    # Check if the email is already registered
-    existing_user = users_collection.find_one({"email": data['email']})
-    if existing_user:
-        return jsonify({"error": "Email is already registered"}), 400
-
-    hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8')
+    try:
+        hashed_password = password_hasher.hash(data['password'])
+    except AuthBusy as e:
+        return auth_busy(e)
     user = {
         "email": data['email'],
         "password": hashed_password,
@@ -97,8 +546,14 @@ def register():
     }
 
     try:
-        db.users.insert_one(user)
+        # The unique index on email rejects duplicates atomically
+        with db_deadline():
+            db.users.insert_one(user)
         return jsonify({"message": "User registered successfully"}), 201
+    except DuplicateKeyError:
+        return jsonify({"error": "Email is already registered"}), 400
+    except PyMongoError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -108,8 +563,17 @@ def login():
     if not data or not data.get('email') or not data.get('password'):
         return jsonify({"error": "Email and password are required"}), 400
 
-    user = db.users.find_one({"email": data['email']})
-    if user and bcrypt.check_password_hash(user['password'], data['password']):
+    with db_deadline():
+        user = db.users.find_one({"email": data['email']})
+    try:
+        valid = user is not None and password_hasher.check(user['password'], data['password'])
+    except AuthBusy as e:
+        return auth_busy(e)
+    if valid:
+        # Upgrade hashes made with a different BCRYPT_ROUNDS
+        if password_hasher.needs_rehash(user['password']):
+            password_hasher.rehash_in_background(data['password'], lambda hashed: db.users.update_one(
+                {"_id": user['_id'], "password": user['password']}, {"$set": {"password": hashed}}))
         # Set token expiration
         access_token = create_access_token(
             identity=str(user['_id']),
@@ -123,11 +587,41 @@ def login():
 @jwt_required()
 def get_predictions():
     user_id = get_jwt_identity()
-    user = db.users.find_one({"_id": ObjectId(user_id)})
-    if user:
-        return jsonify({"recent_predictions": user['recent_predictions']}), 200
-    else:
-        return jsonify({"error": "User not found"}), 404
+    # Let users read their own writes that are still queued
+    if history_writer.has_pending(user_id):
+        history_writer.flush(timeout=5)
+
+    limit = min(max(request.args.get('limit', history_page_size, type=int), 1), history_limit)
+    cursor = request.args.get('cursor')
+
+    try:
+        fields = streaming.parse_fields(request.args.get('fields'), history.RECORD_FIELDS)
+        ndjson = streaming.wants_ndjson(request.args.get('format'), request.headers.get('Accept'))
+        pipeline = history.records_pipeline(user_id, limit, cursor, fields)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # One record per result, fetched in batches while the response is sent
+    with db_deadline():
+        records = db.users.aggregate(pipeline, batchSize=stream_batch_size)
+        first = next(records, None)
+        # No records: an empty page, or no such user
+        if first is None and not db.users.count_documents({"_id": ObjectId(user_id)}, limit=1):
+            records.close()
+            return jsonify({"error": "User not found"}), 404
+
+    page = history.PageStream(limit, cursor, fields)
+
+    def items():
+        try:
+            for record in itertools.chain([first] if first is not None else [], records):
+                item = page.accept(record)
+                if item is not None:
+                    yield item
+        finally:
+            records.close()
+
+    return stream_response(items(), "recent_predictions", ndjson, lambda: {"next_cursor": page.next_cursor()})
 
 @app.route('/account/changepassword', methods=['PUT'])
 @jwt_required()
@@ -137,12 +631,18 @@ def change_password():
         return jsonify({"error": "Old and new password are required"}), 400
 
     user_id = get_jwt_identity()
-    user = db.users.find_one({"_id": ObjectId(user_id)})
+    with db_deadline():
+        user = db.users.find_one({"_id": ObjectId(user_id)})
 
     # Check if the old password is correct
-    if user and bcrypt.check_password_hash(user['password'], data['old_password']):
-        hashed_password = bcrypt.generate_password_hash(data['new_password']).decode('utf-8')
-        db.users.update_one({"_id": ObjectId(user_id)}, {"$set": {"password": hashed_password}})
+    try:
+        valid = user is not None and password_hasher.check(user['password'], data['old_password'])
+        hashed_password = password_hasher.hash(data['new_password']) if valid else None
+    except AuthBusy as e:
+        return auth_busy(e)
+    if valid:
+        with db_deadline():
+            db.users.update_one({"_id": ObjectId(user_id)}, {"$set": {"password": hashed_password}})
         return jsonify({"message": "Password updated successfully"}), 200
     else:
         # Provide a specific error message for the incorrect old password
@@ -154,10 +654,12 @@ def add_snake():
     if not data or not all(field in data for field in ('name', 'image', 'description', 'endemism', 'wikiLink')):
         return jsonify({'error': 'Missing data'}), 400
 
-    if snakes_collection.find_one({'name': data['name']}):
+    try:
+        with db_deadline():
+            snakes_collection.insert_one(data)
+    except DuplicateKeyError:
         return jsonify({'error': 'Snake already exists'}), 400
-
-    snakes_collection.insert_one(data)
+    catalog.invalidate()
     return jsonify({'message': 'Snake added successfully'}), 201
     
 @app.route("/updatesnake/<name>", methods=["PUT"])
@@ -166,105 +668,292 @@ def update_snake(name):
     if not data or not all(field in data for field in ('name', 'image', 'description', 'endemism', 'wikiLink')):
         return jsonify({'error': 'Missing data'}), 400
 
-    result = snakes_collection.update_one({'name': name}, {'$set': data})
+    try:
+        with db_deadline():
+            result = snakes_collection.update_one({'name': name}, {'$set': data})
+    except DuplicateKeyError:
+        return jsonify({'error': 'Snake already exists'}), 400
     if result.matched_count == 0:
         return jsonify({'error': 'Snake not found'}), 404
+    catalog.invalidate()
 
     return jsonify({'message': 'Snake updated successfully'}), 200
 
 @app.route("/deletesnake/<name>", methods=["DELETE"])
 def delete_snake(name):
     try:
-        result = snakes_collection.delete_one({"name": name})
+        with db_deadline():
+            result = snakes_collection.delete_one({"name": name})
 
         if result.deleted_count > 0:
+            catalog.invalidate()
             return jsonify({"message": f"Snake '{name}' deleted successfully"})
         else:
             return jsonify({"error": f"Snake '{name}' not found"}), 404
+    except PyMongoError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def stream_response(items, key, ndjson, trailer=None):
+    # Chunked JSON ({key: [...], **trailer}) or NDJSON, encoded as it is sent
+    if ndjson:
+        chunks, mimetype = streaming.ndjson_chunks(items, trailer), streaming.NDJSON_MIMETYPE
+    else:
+        chunks, mimetype = streaming.json_chunks(items, key, trailer), streaming.JSON_MIMETYPE
+    return app.response_class(stream_with_context(chunks), mimetype=mimetype)
+
+def catalog_response(body, etag, last_modified):
+    # Clients revalidate with If-None-Match / If-Modified-Since and get a 304
+    # while the catalog is unchanged
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route('/snakelist', methods=['GET'])
 def snake_list():
-    snakes = list(snakes_collection.find({}, {'_id': 0, 'name': 1}))
-    return jsonify({'snakes': snakes}), 200
+    snapshot = catalog.get()
+    return catalog_response(snapshot.list_body, snapshot.list_etag, snapshot.last_modified)
 
 @app.route("/searchsnake/<name>", methods=["GET"])
 def search_snake(name):
     try:
-        snake = snakes_collection.find_one({"name": name})
-
-        if snake:
-            serialized_snake = serialize_snake(snake)
-            return jsonify({"snake": serialized_snake})
-        else:
+        snapshot = catalog.get()
+        snake = snapshot.by_name.get(name)
+
+        if snake is None:
+            # Not in the cached index; check the database in case another
+            # worker added it since the cache was loaded
+            with db_deadline():
+                snake = snakes_collection.find_one({"name": name})
+            if snake:
+                catalog.invalidate()
+                return jsonify({"snake": snake})
             return jsonify({"error": "Snake not found."}), 404
 
+        response = jsonify({"snake": snake})
+        response.set_etag(snapshot.snakes_etag)
+        response.last_modified = snapshot.last_modified
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    except (PyMongoError, CircuitOpen):
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/snakes", methods=["GET"])
 def get_snakes():
+    # ?fields=name,image returns only those fields of each snake, and
+    # ?format=ndjson (or Accept: application/x-ndjson) one snake per line
     try:
-        snakes = list(snakes_collection.find({}))
-
-        # Serialize each snake document
-        serialized_snakes = [serialize_snake(snake) for snake in snakes]
+        fields = streaming.parse_fields(request.args.get('fields'), CATALOG_FIELDS)
+        ndjson = streaming.wants_ndjson(request.args.get('format'), request.headers.get('Accept'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        return jsonify({"snakes": serialized_snakes})
+    try:
+        snapshot = catalog.get()
+        if fields is None and not ndjson:
+            return catalog_response(snapshot.snakes_body, snapshot.snakes_etag, snapshot.last_modified)
+
+        # Streamed from the cached catalog; the ETag still changes with it
+        response = stream_response((streaming.project(snake, fields) for snake in snapshot.snakes), "snakes", ndjson)
+        response.set_etag(variant_etag(snapshot.snakes_etag, fields, ndjson))
+        response.last_modified = snapshot.last_modified
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    except (PyMongoError, CircuitOpen):
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
 @app.route("/predict", methods=["POST"])
+@inference_required
 @jwt_required(optional=True)  # Allow this route to be accessed both with and without JWT
 def predict():
     if request.method == "POST":
         try:
-            file = request.files["image"]
-
-            # Generate a unique filename using UUID
-            unique_filename = str(uuid.uuid4()) + ".jpg"
-
-            # Construct the path to save the file within the 'static' folder
-            save_path = os.path.join("static", unique_filename)
-
-            # Save the uploaded image to the specified path
-            file.save(save_path)
-
-            # Read the image file
-            img = image.load_img(save_path, target_size=(224, 224))
-            img_array = image.img_to_array(img)
-            img_array = preprocess_input(img_array)
-            img_array = np.expand_dims(img_array, axis=0)
-
-            # Make predictions
-            predictions = model.predict(img_array)
-            predicted_class_index = np.argmax(predictions)
-            predicted_snake = class_list[predicted_class_index]
-            accuracy_percentage = round(predictions[0][predicted_class_index] * 100, 2)
-
-            # Debugging statements
-            print("Predicted snake:", predicted_snake)
-            print("Accuracy percentage:", accuracy_percentage)
+            with metrics.stage("receive"):
+                file = request.files["image"]
+                data = upload_bytes(file)
+
+            filename = archiver.archive(data) if archiver is not None else None
+
+            tta = request.args.get('tta', tta_default)
+            if tta not in TTAPolicy.MODES:
+                return jsonify({"error": f"tta must be one of {', '.join(TTAPolicy.MODES)}"}), 400
+
+            # Reuse the result if this exact file was classified recently
+            bytes_key = key_for_bytes(data)
+            predictions = prediction_cache.get(bytes_key)
+            img_array = None
+            if predictions is None:
+                # Decode and preprocess in memory, straight from the upload bytes
+                img_array = decode_image(data)
+
+                pixel_key = key_for_array(img_array) if cache_pixel_keys else None
+                predictions = prediction_cache.get(pixel_key)
+                if predictions is None:
+                    # Make predictions (batched together with other in-flight requests)
+                    with metrics.stage("inference"):
+                        predictions, embedding, duplicate = split_predictions(inference.predict(img_array, timeout=predict_timeout))
+                    if embedding is not None and not duplicate:
+                        remember_embeddings(embedding[np.newaxis], predictions[np.newaxis], [filename])
+                    prediction_cache.set(pixel_key, predictions)
+                prediction_cache.set(bytes_key, predictions)
+
+            # Low-confidence images get a second look from augmented views
+            predictions, views = tta_predictions(data, predictions, tta, img_array)
+
+            # ?k=3 adds the three most likely snakes with their catalog entries
+            k = request.args.get('k', type=int)
+            result = describe_predictions(np.asarray([predictions]), k, catalog.get().by_name if k else None)[0]
+            predicted_snake, accuracy_percentage = result["snake"], result["accuracy"]
 
             # Save the prediction if the user is logged in
             current_user_id = get_jwt_identity()
+            logger.debug("Predicted snake: %s, accuracy: %s, user: %s", predicted_snake, accuracy_percentage, current_user_id)
             if current_user_id:
-                print("Logged in user ID:", current_user_id)
-                save_prediction(current_user_id, predicted_snake, accuracy_percentage)
-                print("Prediction saved to MongoDB")
+                history_writer.enqueue(current_user_id, [make_prediction_record(predicted_snake, accuracy_percentage)])
+
+            if tta != 'off':
+                result["tta_views"] = views
 
             # Return prediction results as JSON
-            return jsonify({"snake": predicted_snake, "accuracy": accuracy_percentage})
+            with metrics.stage("serialize"):
+                response = jsonify(result)
+            return response
 
         except FileNotFoundError:
             return jsonify({"error": "Uploaded file not found."}), 400
+        except UploadRejected as e:
+            return upload_rejected(e)
+        except InferenceBusy as e:
+            return jsonify({"error": str(e)}), 503, {"Retry-After": retry_after}
+        except FutureTimeoutError:
+            return jsonify({"error": "Prediction timed out."}), 504
+        except (PyMongoError, CircuitOpen):
+            # Answered by the database_error and circuit_open handlers
+            raise
         except Exception as e:
-            print("Error during prediction:", str(e))
+            logger.exception("Error during prediction: %s", e)
             return jsonify({"error": str(e)}), 500
     else:
         return jsonify({"error": "Invalid request method. Use POST."}), 405
 
+@app.route("/predict/batch", methods=["POST"])
+@inference_required
+@jwt_required(optional=True)
+def predict_batch():
+    files = request.files.getlist("images") or request.files.getlist("image")
+    if not files:
+        return jsonify({"error": "No images uploaded. Use the 'images' form field."}), 400
+    if len(files) > batch_max_images:
+        return jsonify({"error": f"Too many images, the limit is {batch_max_images}."}), 400
+
+    k = min(max(request.args.get("k", 3, type=int), 1), len(class_list))
+
+    try:
+        probabilities, errors = classify_batch(*read_uploads(files))
+        results, records = batch_results([file.filename for file in files], probabilities, errors, k, catalog.get().by_name)
+
+        # Save every prediction if the user is logged in
+        current_user_id = get_jwt_identity()
+        if current_user_id and records:
+            history_writer.enqueue(current_user_id, records)
+
+        return jsonify({"results": results})
+
+    except InferenceBusy as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": retry_after}
+    except FutureTimeoutError:
+        return jsonify({"error": "Prediction timed out."}), 504
+    except (PyMongoError, CircuitOpen):
+        raise
+    except Exception as e:
+        logger.exception("Error during batch prediction: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+def similar_images(embedding, k):
+    # The stored images nearest to one embedding, most similar first
+    positions, similarities = embedding_pipeline.store.search(embedding[np.newaxis], k)
+    found = positions[0] >= 0
+    items = embedding_pipeline.store.items(positions[0][found])
+    return [dict(item, similarity=round(float(similarity), 4)) for item, similarity in zip(items, similarities[0][found])]
+
+@app.route("/similar", methods=["POST"])
+@inference_required
+def similar():
+    """Finds the previously classified images that look most like the upload."""
+    if embedding_pipeline is None:
+        return jsonify({"error": "Similar-image search is disabled on this server."}), 503
+    file = request.files.get("image")
+    if file is None:
+        return jsonify({"error": "No image uploaded. Use the 'image' form field."}), 400
+    k = min(max(request.args.get("k", 5, type=int), 1), 100)
+
+    try:
+        img_array = decode_image(upload_bytes(file))
+        _, embedding, _ = split_predictions(inference.predict(img_array, timeout=predict_timeout))
+        return jsonify({"results": similar_images(embedding, k)}), 200
+    except UploadRejected as e:
+        return upload_rejected(e)
+    except InferenceBusy as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": retry_after}
+    except FutureTimeoutError:
+        return jsonify({"error": "Prediction timed out."}), 504
+    except Exception as e:
+        logger.exception("Error during similar-image search: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+def predict_stats_report():
+    report = {
+        "batching": inference.stats(),
+        "cache": prediction_cache.stats(),
+        "history_writer": history_writer.stats(),
+    }
+    if embedding_pipeline is not None:
+        report["embeddings"] = embedding_pipeline.stats()
+    return report
+
+def health_report():
+    return {
+        "startup": startup_stats,
+        "inference_enabled": inference_enabled,
+        "model": {
+            "backend": model.backend,
+            "loaded": model.loaded,
+            "load_seconds": model.load_seconds,
+            "warmup_seconds": model.warmup_seconds,
+        },
+        "auth": password_hasher.stats(),
+        "database": {
+            "pool": database.client_options(),
+            "connections_checked_out": pool_metrics.checked_out,
+            "request_timeout_seconds": mongo_request_timeout or None,
+            "catalog": catalog.stats(),
+        },
+        "memory": memory_stats(),
+    }
+
+@app.route("/predict/stats", methods=["GET"])
+def predict_stats():
+    """Reports micro-batch fill, prediction cache and history writer statistics."""
+    return jsonify(predict_stats_report()), 200
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Reports this worker's stage, request and MongoDB latency histograms and queue gauges."""
+    return app.response_class(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Reports startup time, model state and memory use of this worker."""
+    return jsonify(health_report()), 200
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
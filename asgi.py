@@ -0,0 +1,834 @@
+"""ASGI entry point serving the same API as app.py without blocking on I/O.
+
+    uvicorn asgi:app --workers 2
+
+MongoDB is reached through Motor, uploads are read from the request stream
+and password hashing, image decoding and model inference run in executors, so a single
+process can hold many slow connections open at once. The model, inference
+engine, prediction cache and history writer are the ones configured in
+app.py, and tokens are interchangeable with the Flask server's.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+
+import jwt
+import numpy as np
+from bson import ObjectId
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, PyMongoError
+from PIL import Image
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import FormData, Headers, MutableHeaders, UploadFile
+from starlette.responses import JSONResponse as StarletteJSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import app as api
+import database
+import history
+import metrics
+import streaming
+from batching import InferenceBusy
+from catalog import AsyncCatalogCache, FIELDS as CATALOG_FIELDS, variant_etag
+from db_indexes import ensure_indexes_async
+from passwords import AuthBusy
+from tta import TTAPolicy
+from uploads import UploadBuffer, UploadRejected
+from prediction_cache import key_for_bytes, key_for_array
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:
+    # python-multipart before 0.0.13
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+SNAKE_FIELDS = ('name', 'image', 'description', 'endemism', 'wikiLink')
+
+
+class JSONResponse(StarletteJSONResponse):
+    """JSON encoded like the Flask app's: orjson when it is installed, and
+    ObjectIds as strings."""
+
+    def render(self, content):
+        return streaming.dumps(content)
+
+logger = logging.getLogger(__name__)
+
+
+def create_access_token(identity, expires_delta=timedelta(hours=1)):
+    # Same claims as flask_jwt_extended, so either server accepts the token
+    now = datetime.now(timezone.utc)
+    claims = {
+        "fresh": False,
+        "iat": now,
+        "jti": str(uuid.uuid4()),
+        "type": "access",
+        "sub": identity,
+        "nbf": now,
+        "exp": now + expires_delta,
+    }
+    return jwt.encode(claims, api.app.config['JWT_SECRET_KEY'], algorithm="HS256")
+
+
+class AuthError(Exception):
+    pass
+
+
+def get_identity(request, optional=False):
+    """The user id from the Bearer token, or None when optional and absent."""
+    header = request.headers.get("Authorization", "")
+    if not header:
+        if optional:
+            return None
+        raise AuthError("Missing Authorization Header")
+    scheme, _, token = header.partition(" ")
+    if scheme != "Bearer" or not token:
+        raise AuthError("Bad Authorization header. Expected 'Authorization: Bearer <JWT>'")
+    try:
+        claims = jwt.decode(token, api.app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        raise AuthError("Token has expired")
+    except jwt.InvalidTokenError as e:
+        raise AuthError(str(e))
+    if claims.get("type") != "access":
+        raise AuthError("Only access tokens are allowed")
+    return claims["sub"]
+
+
+def auth_error(e):
+    return JSONResponse({"msg": str(e)}, status_code=401)
+
+
+async def run_blocking(func, *args):
+    # Run with this request's context, so stage timings reach its Server-Timing
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.get_running_loop().run_in_executor(None, call)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def conditional_response(request, body, etag, last_modified, media_type="application/json"):
+    # Mirrors Flask's make_conditional for the cached catalog routes; `body`
+    # is bytes or an iterator of chunks to stream
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+        "Cache-Control": "no-cache",
+    }
+    if_none_match = request.headers.get("If-None-Match")
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_none_match is not None:
+        not_modified = if_none_match.strip() == "*" or f'"{etag}"' in [tag.strip() for tag in if_none_match.split(",")]
+    elif if_modified_since is not None:
+        try:
+            not_modified = last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    if not isinstance(body, bytes):
+        return StreamingResponse(body, media_type=media_type, headers=headers)
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def stream_response(items, key, ndjson, trailer=None):
+    # Chunked JSON ({key: [...], **trailer}) or NDJSON of an async iterator,
+    # like app.stream_response
+    media_type = streaming.NDJSON_MIMETYPE if ndjson else streaming.JSON_MIMETYPE
+    return StreamingResponse(streaming.async_chunks(items, None if ndjson else key, trailer), media_type=media_type)
+
+
+def auth_busy(e):
+    return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": api.auth_retry_after})
+
+
+def upload_rejected(e):
+    return JSONResponse({"error": str(e)}, status_code=e.status)
+
+
+class UploadFormParser:
+    """Parses a multipart/form-data body as it streams in, writing each file
+    into an UploadBuffer like the Flask app's UploadRequest: a file over
+    MAX_UPLOAD_MB or an image over MAX_IMAGE_PIXELS aborts the request
+    there, and a header that is not an accepted image is recorded on that
+    file only. Files are returned as UploadFiles around their buffers."""
+
+    max_field_bytes = 64 * 1024
+
+    def __init__(self, boundary, max_files):
+        self.max_files = max_files
+        self.items = []
+        self.files = 0
+        self._parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        })
+
+    async def parse(self, stream):
+        try:
+            async for chunk in stream:
+                self._parser.write(chunk)
+            self._parser.finalize()
+        except FormParserError:
+            raise UploadRejected("Invalid multipart data")
+        return FormData(self.items)
+
+    def on_part_begin(self):
+        self._headers = []
+        self._header_name = self._header_value = b""
+        self._name = None
+        self._filename = None
+        self._buffer = None
+        self._data = bytearray()
+
+    def on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers.append((self._header_name.lower(), self._header_value))
+        self._header_name = self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(dict(self._headers).get(b"content-disposition", b""))
+        self._name = options.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" in options:
+            self.files += 1
+            if self.files > self.max_files:
+                raise UploadRejected(f"Too many files, the limit is {self.max_files}")
+            self._filename = options[b"filename"].decode("utf-8", "replace")
+            self._buffer = UploadBuffer(api.max_upload_bytes, Image.MAX_IMAGE_PIXELS)
+
+    def on_part_data(self, data, start, end):
+        if self._buffer is not None:
+            self._buffer.write(data[start:end])
+            return
+        if len(self._data) + end - start > self.max_field_bytes:
+            raise UploadRejected("Form field is too large", 413)
+        self._data += data[start:end]
+
+    def on_part_end(self):
+        if self._buffer is None:
+            self.items.append((self._name, self._data.decode("utf-8", "replace")))
+            return
+        size = self._buffer.tell()
+        self._buffer.seek(0)
+        self.items.append((self._name, UploadFile(self._buffer, size=size, filename=self._filename,
+                                                  headers=Headers(raw=self._headers))))
+
+
+async def read_form(request, max_files=1000):
+    """The request's form with size and format limits enforced while it
+    arrives (see UploadFormParser); an empty form for other content types."""
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data":
+        return FormData()
+    if b"boundary" not in params:
+        raise UploadRejected("Missing boundary in multipart")
+    return await UploadFormParser(params[b"boundary"], max_files).parse(request.stream())
+
+
+def upload_bytes(upload):
+    """The bytes of a file from read_form; raises the UploadRejected of a
+    header that was not an accepted image, like app.upload_bytes."""
+    if upload.file.rejected is not None:
+        raise upload.file.rejected
+    return upload.file.getvalue()
+
+
+class RequestSizeLimit:
+    """Answers 413 as soon as a request body grows past `max_bytes`, counting
+    the body as it streams in rather than after it has been buffered."""
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.max_bytes:
+            await self.app(scope, receive, send)
+            return
+
+        too_large = UploadRejected(f"Request is larger than {self.max_bytes / (1024 * 1024):g} MB", 413)
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and int(content_length) > self.max_bytes:
+            await upload_rejected(too_large)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.max_bytes:
+                raise too_large
+            return message
+
+        try:
+            await self.app(scope, limited_receive, send)
+        except UploadRejected as e:
+            await upload_rejected(e)(scope, receive, send)
+
+
+class RequestMetrics:
+    """Records each request's latency for /metrics and sends the stages it
+    went through in a Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings = metrics.start_request_timings()
+        status = 500
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if timings:
+                    MutableHeaders(scope=message).append("Server-Timing", metrics.server_timing(timings))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, route_name(scope), scope["method"], str(status))
+
+
+async def database_error(request, e):
+    if e.timeout:
+        return JSONResponse({"error": "The database did not respond in time."}, status_code=504)
+    if isinstance(e, ConnectionFailure):
+        return JSONResponse({"error": "The database is unavailable."}, status_code=503,
+                            headers={"Retry-After": api.retry_after})
+    return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def circuit_open(request, e):
+    return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": api.retry_after})
+
+
+def route_name(scope):
+    # The route's path template, so /searchsnake/{name} is one series
+    route = scope.get("route")
+    if route is not None and hasattr(route, "path"):
+        return route.path
+    endpoint = scope.get("endpoint")
+    return getattr(endpoint, "__name__", "unmatched")
+
+
+def inference_unavailable():
+    if not api.inference_enabled:
+        return JSONResponse({"error": "Prediction is disabled on this server."}, status_code=503)
+    return None
+
+
+async def home(request):
+    return PlainTextResponse("Snake Prediction API is running!")
+
+
+async def register(request):
+    data = await read_json(request)
+    if not data or not data.get('email') or not data.get('password'):
+        return JSONResponse({"error": "Email and password are required"}, status_code=400)
+
+    try:
+        hashed_password = await asyncio.wrap_future(api.password_hasher.submit_hash(data['password']))
+    except AuthBusy as e:
+        return auth_busy(e)
+    user = {
+        "email": data['email'],
+        "password": hashed_password,
+        "recent_predictions": []
+    }
+
+    try:
+        with api.db_deadline():
+            await request.app.state.db.users.insert_one(user)
+        return JSONResponse({"message": "User registered successfully"}, status_code=201)
+    except DuplicateKeyError:
+        return JSONResponse({"error": "Email is already registered"}, status_code=400)
+    except PyMongoError:
+        raise
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def login(request):
+    data = await read_json(request)
+    if not data or not data.get('email') or not data.get('password'):
+        return JSONResponse({"error": "Email and password are required"}, status_code=400)
+
+    users = request.app.state.db.users
+    with api.db_deadline():
+        user = await users.find_one({"email": data['email']})
+    try:
+        valid = user is not None and await asyncio.wrap_future(api.password_hasher.submit_check(user['password'], data['password']))
+    except AuthBusy as e:
+        return auth_busy(e)
+    if valid:
+        # Upgrade hashes made with a different BCRYPT_ROUNDS after answering,
+        # like app.py; the new hash is stored from the event loop
+        if api.password_hasher.needs_rehash(user['password']):
+            loop = asyncio.get_running_loop()
+            api.password_hasher.rehash_in_background(data['password'], lambda hashed: asyncio.run_coroutine_threadsafe(
+                users.update_one({"_id": user['_id'], "password": user['password']}, {"$set": {"password": hashed}}),
+                loop).result(api.mongo_request_timeout or None))
+        access_token = create_access_token(str(user['_id']))
+        return JSONResponse({"token": access_token, "user_id": str(user['_id'])})
+    return JSONResponse({"error": "Invalid credentials"}, status_code=401)
+
+
+async def get_predictions(request):
+    try:
+        user_id = get_identity(request)
+    except AuthError as e:
+        return auth_error(e)
+
+    # Let users read their own writes that are still queued
+    if api.history_writer.has_pending(user_id):
+        await run_blocking(api.history_writer.flush, 5)
+
+    try:
+        limit = int(request.query_params.get('limit', api.history_page_size))
+    except ValueError:
+        limit = api.history_page_size
+    limit = min(max(limit, 1), api.history_limit)
+    cursor = request.query_params.get('cursor')
+
+    try:
+        fields = streaming.parse_fields(request.query_params.get('fields'), history.RECORD_FIELDS)
+        ndjson = streaming.wants_ndjson(request.query_params.get('format'), request.headers.get('accept'))
+        pipeline = history.records_pipeline(user_id, limit, cursor, fields)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    # One record per result, fetched in batches while the response is sent
+    records = request.app.state.db.users.aggregate(pipeline, batchSize=api.stream_batch_size)
+    with api.db_deadline():
+        first = await records.to_list(1)
+        # No records: an empty page, or no such user
+        if not first and not await request.app.state.db.users.count_documents({"_id": ObjectId(user_id)}, limit=1):
+            return JSONResponse({"error": "User not found"}, status_code=404)
+
+    page = history.PageStream(limit, cursor, fields)
+
+    async def items():
+        for record in first:
+            item = page.accept(record)
+            if item is not None:
+                yield item
+        async for record in records:
+            item = page.accept(record)
+            if item is not None:
+                yield item
+
+    return stream_response(items(), "recent_predictions", ndjson, lambda: {"next_cursor": page.next_cursor()})
+
+
+async def change_password(request):
+    try:
+        user_id = get_identity(request)
+    except AuthError as e:
+        return auth_error(e)
+
+    data = await read_json(request)
+    if not data or not data.get('old_password') or not data.get('new_password'):
+        return JSONResponse({"error": "Old and new password are required"}, status_code=400)
+
+    users = request.app.state.db.users
+    with api.db_deadline():
+        user = await users.find_one({"_id": ObjectId(user_id)})
+    try:
+        valid = user is not None and await asyncio.wrap_future(api.password_hasher.submit_check(user['password'], data['old_password']))
+        if valid:
+            hashed_password = await asyncio.wrap_future(api.password_hasher.submit_hash(data['new_password']))
+    except AuthBusy as e:
+        return auth_busy(e)
+    if valid:
+        with api.db_deadline():
+            await users.update_one({"_id": ObjectId(user_id)}, {"$set": {"password": hashed_password}})
+        return JSONResponse({"message": "Password updated successfully"})
+    return JSONResponse({"error": "The old password is wrong"}, status_code=401)
+
+
+async def add_snake(request):
+    data = await read_json(request)
+    if not data or not all(field in data for field in SNAKE_FIELDS):
+        return JSONResponse({'error': 'Missing data'}, status_code=400)
+
+    try:
+        with api.db_deadline():
+            await request.app.state.db.snakes.insert_one(data)
+    except DuplicateKeyError:
+        return JSONResponse({'error': 'Snake already exists'}, status_code=400)
+    request.app.state.catalog.invalidate()
+    return JSONResponse({'message': 'Snake added successfully'}, status_code=201)
+
+
+async def update_snake(request):
+    name = request.path_params['name']
+    data = await read_json(request)
+    if not data or not all(field in data for field in SNAKE_FIELDS):
+        return JSONResponse({'error': 'Missing data'}, status_code=400)
+
+    try:
+        with api.db_deadline():
+            result = await request.app.state.db.snakes.update_one({'name': name}, {'$set': data})
+    except DuplicateKeyError:
+        return JSONResponse({'error': 'Snake already exists'}, status_code=400)
+    if result.matched_count == 0:
+        return JSONResponse({'error': 'Snake not found'}, status_code=404)
+    request.app.state.catalog.invalidate()
+    return JSONResponse({'message': 'Snake updated successfully'})
+
+
+async def delete_snake(request):
+    name = request.path_params['name']
+    try:
+        with api.db_deadline():
+            result = await request.app.state.db.snakes.delete_one({"name": name})
+        if result.deleted_count > 0:
+            request.app.state.catalog.invalidate()
+            return JSONResponse({"message": f"Snake '{name}' deleted successfully"})
+        return JSONResponse({"error": f"Snake '{name}' not found"}, status_code=404)
+    except PyMongoError:
+        raise
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def snake_list(request):
+    snapshot = await request.app.state.catalog.get()
+    return conditional_response(request, snapshot.list_body, snapshot.list_etag, snapshot.last_modified)
+
+
+async def search_snake(request):
+    name = request.path_params['name']
+    try:
+        snapshot = await request.app.state.catalog.get()
+        snake = snapshot.by_name.get(name)
+        if snake is None:
+            with api.db_deadline():
+                snake = await request.app.state.db.snakes.find_one({"name": name})
+            if snake:
+                request.app.state.catalog.invalidate()
+                return JSONResponse({"snake": snake})
+            return JSONResponse({"error": "Snake not found."}, status_code=404)
+
+        body = api.app.json.dumps({"snake": snake}).encode('utf-8')
+        return conditional_response(request, body, snapshot.snakes_etag, snapshot.last_modified)
+    except (PyMongoError, database.CircuitOpen):
+        raise
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def get_snakes(request):
+    try:
+        fields = streaming.parse_fields(request.query_params.get('fields'), CATALOG_FIELDS)
+        ndjson = streaming.wants_ndjson(request.query_params.get('format'), request.headers.get('accept'))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    try:
+        snapshot = await request.app.state.catalog.get()
+        if fields is None and not ndjson:
+            return conditional_response(request, snapshot.snakes_body, snapshot.snakes_etag, snapshot.last_modified)
+
+        snakes = (streaming.project(snake, fields) for snake in snapshot.snakes)
+        if ndjson:
+            chunks, media_type = streaming.ndjson_chunks(snakes), streaming.NDJSON_MIMETYPE
+        else:
+            chunks, media_type = streaming.json_chunks(snakes, "snakes"), streaming.JSON_MIMETYPE
+        return conditional_response(request, chunks, variant_etag(snapshot.snakes_etag, fields, ndjson),
+                                    snapshot.last_modified, media_type)
+    except (PyMongoError, database.CircuitOpen):
+        raise
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def embed_and_predict(img_array):
+    # Inference output, as (probabilities, embedding, duplicate flag)
+    with metrics.stage("inference"):
+        future = api.inference.submit(img_array)
+        # Shielded: a timeout must not cancel the engine's future, which the
+        # batcher or dispatcher thread still completes
+        return api.split_predictions(await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), api.predict_timeout))
+
+
+async def classify(data, filename=None):
+    """Probabilities for one upload; the event loop never waits on the model."""
+    bytes_key = key_for_bytes(data)
+    predictions = api.prediction_cache.get(bytes_key)
+    if predictions is not None:
+        return predictions
+
+    # A fresh buffer: the executor thread's reusable one could be overwritten
+    # by another request before the engine has copied this image
+    img_array = await run_blocking(api.decode_image, data, np.empty((224, 224, 3), dtype=np.float32))
+
+    pixel_key = key_for_array(img_array) if api.cache_pixel_keys else None
+    predictions = api.prediction_cache.get(pixel_key)
+    if predictions is None:
+        predictions, embedding, duplicate = await embed_and_predict(img_array)
+        if embedding is not None and not duplicate:
+            await run_blocking(api.remember_embeddings, embedding[np.newaxis], predictions[np.newaxis], [filename])
+        api.prediction_cache.set(pixel_key, predictions)
+    api.prediction_cache.set(bytes_key, predictions)
+    return predictions
+
+
+async def predict(request):
+    unavailable = inference_unavailable()
+    if unavailable:
+        return unavailable
+    try:
+        user_id = get_identity(request, optional=True)
+    except AuthError as e:
+        return auth_error(e)
+
+    try:
+        # The multipart body is parsed and checked as it streams in
+        with metrics.stage("receive"):
+            form = await read_form(request)
+            upload = form.get("image")
+            if upload is None or isinstance(upload, str):
+                return JSONResponse({"error": "No image uploaded. Use the 'image' form field."}, status_code=400)
+            data = upload_bytes(upload)
+        filename = api.archiver.archive(data) if api.archiver is not None else None
+
+        tta = request.query_params.get("tta", api.tta_default)
+        if tta not in TTAPolicy.MODES:
+            return JSONResponse({"error": f"tta must be one of {', '.join(TTAPolicy.MODES)}"}, status_code=400)
+
+        predictions = await classify(data, filename)
+        predictions, views = await run_blocking(api.tta_predictions, data, predictions, tta)
+        try:
+            k = int(request.query_params.get("k", 0))
+        except ValueError:
+            k = 0
+        lookup = (await request.app.state.catalog.get()).by_name if k else None
+        result = api.describe_predictions(np.asarray([predictions]), k, lookup)[0]
+
+        if user_id:
+            api.history_writer.enqueue(user_id, [api.make_prediction_record(result["snake"], result["accuracy"])])
+
+        if tta != "off":
+            result["tta_views"] = views
+        with metrics.stage("serialize"):
+            response = JSONResponse(result)
+        return response
+
+    except UploadRejected as e:
+        return upload_rejected(e)
+    except InferenceBusy as e:
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": api.retry_after})
+    except asyncio.TimeoutError:
+        return JSONResponse({"error": "Prediction timed out."}, status_code=504)
+    except (PyMongoError, database.CircuitOpen):
+        # Answered by the database_error and circuit_open handlers
+        raise
+    except Exception as e:
+        logger.exception("Error during prediction: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def predict_batch(request):
+    unavailable = inference_unavailable()
+    if unavailable:
+        return unavailable
+    try:
+        user_id = get_identity(request, optional=True)
+    except AuthError as e:
+        return auth_error(e)
+
+    try:
+        form = await read_form(request, max_files=api.batch_max_images + 1)
+    except UploadRejected as e:
+        return upload_rejected(e)
+    files = [f for f in form.getlist("images") or form.getlist("image") if not isinstance(f, str)]
+    if not files:
+        return JSONResponse({"error": "No images uploaded. Use the 'images' form field."}, status_code=400)
+    if len(files) > api.batch_max_images:
+        return JSONResponse({"error": f"Too many images, the limit is {api.batch_max_images}."}, status_code=400)
+
+    try:
+        k = int(request.query_params.get("k", 3))
+    except ValueError:
+        k = 3
+    k = min(max(k, 1), len(api.class_list))
+
+    try:
+        probabilities, errors = await run_blocking(api.classify_batch, *api.read_uploads(files, upload_bytes))
+        lookup = (await request.app.state.catalog.get()).by_name
+        results, records = api.batch_results([f.filename for f in files], probabilities, errors, k, lookup)
+
+        if user_id and records:
+            api.history_writer.enqueue(user_id, records)
+
+        return JSONResponse({"results": results})
+
+    except UploadRejected as e:
+        return upload_rejected(e)
+    except InferenceBusy as e:
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": api.retry_after})
+    except FutureTimeoutError:
+        return JSONResponse({"error": "Prediction timed out."}, status_code=504)
+    except (PyMongoError, database.CircuitOpen):
+        raise
+    except Exception as e:
+        logger.exception("Error during batch prediction: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def similar(request):
+    unavailable = inference_unavailable()
+    if unavailable:
+        return unavailable
+    if api.embedding_pipeline is None:
+        return JSONResponse({"error": "Similar-image search is disabled on this server."}, status_code=503)
+
+    try:
+        form = await read_form(request)
+    except UploadRejected as e:
+        return upload_rejected(e)
+    upload = form.get("image")
+    if upload is None or isinstance(upload, str):
+        return JSONResponse({"error": "No image uploaded. Use the 'image' form field."}, status_code=400)
+    try:
+        k = int(request.query_params.get("k", 5))
+    except ValueError:
+        k = 5
+    k = min(max(k, 1), 100)
+
+    try:
+        data = upload_bytes(upload)
+        img_array = await run_blocking(api.decode_image, data, np.empty((224, 224, 3), dtype=np.float32))
+        _, embedding, _ = await embed_and_predict(img_array)
+        return JSONResponse({"results": await run_blocking(api.similar_images, embedding, k)})
+    except UploadRejected as e:
+        return upload_rejected(e)
+    except InferenceBusy as e:
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": api.retry_after})
+    except asyncio.TimeoutError:
+        return JSONResponse({"error": "Prediction timed out."}, status_code=504)
+    except Exception as e:
+        logger.exception("Error during similar-image search: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def predict_stats(request):
+    return JSONResponse(api.predict_stats_report())
+
+
+async def health(request):
+    return JSONResponse(api.health_report())
+
+
+async def prometheus_metrics(request):
+    return Response(metrics.registry.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+routes = [
+    Route("/", home, methods=["GET"]),
+    Route("/register", register, methods=["POST"]),
+    Route("/login", login, methods=["POST"]),
+    Route("/account/predictions", get_predictions, methods=["GET"]),
+    Route("/account/changepassword", change_password, methods=["PUT"]),
+    Route("/addsnake", add_snake, methods=["POST"]),
+    Route("/updatesnake/{name}", update_snake, methods=["PUT"]),
+    Route("/deletesnake/{name}", delete_snake, methods=["DELETE"]),
+    Route("/snakelist", snake_list, methods=["GET"]),
+    Route("/searchsnake/{name}", search_snake, methods=["GET"]),
+    Route("/snakes", get_snakes, methods=["GET"]),
+    Route("/predict", predict, methods=["POST"]),
+    Route("/predict/batch", predict_batch, methods=["POST"]),
+    Route("/similar", similar, methods=["POST"]),
+    Route("/predict/stats", predict_stats, methods=["GET"]),
+    Route("/health", health, methods=["GET"]),
+    Route("/metrics", prometheus_metrics, methods=["GET"]),
+]
+
+
+def create_asgi_app(db=None):
+    """Builds the ASGI app. Without `db`, a Motor client for MONGO_URI is
+    created at startup, on the server's event loop."""
+
+    @contextlib.asynccontextmanager
+    async def lifespan(application):
+        client = None
+        if db is None:
+            from motor.motor_asyncio import AsyncIOMotorClient
+
+            client = database.create_client(api.uri, AsyncIOMotorClient,
+                                            listeners=[metrics.CommandMetrics(), api.pool_metrics])
+            application.state.db = client[api.db.name]
+        else:
+            application.state.db = db
+        application.state.catalog = AsyncCatalogCache(
+            database.with_read_preference(application.state.db.snakes, api.catalog_read_preference),
+            breaker=api.catalog_breaker,
+            load_timeout=api.catalog.load_timeout,
+            max_age=api.catalog.max_age,
+            watch_changes=api.catalog.watch_changes,
+        )
+        if os.getenv('ENSURE_INDEXES', 'true').lower() in ('1', 'true', 'yes'):
+            await ensure_indexes_async(application.state.db)
+        if os.getenv('PRELOAD_MODEL', 'true').lower() in ('1', 'true', 'yes'):
+            await run_blocking(api.preload_inference)
+        try:
+            yield
+        finally:
+            application.state.catalog.close()
+            await run_blocking(api.history_writer.close)
+            if client is not None:
+                client.close()
+
+    return Starlette(
+        routes=routes,
+        middleware=[
+            Middleware(RequestMetrics),
+            Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+            Middleware(RequestSizeLimit, max_bytes=api.app.config['MAX_CONTENT_LENGTH']),
+        ],
+        exception_handlers={PyMongoError: database_error, database.CircuitOpen: circuit_open},
+        lifespan=lifespan,
+    )
+
+
+app = create_asgi_app()
@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class InferenceBusy(Exception):
+    """Raised when the inference queue is full; the caller should retry later."""
+
+
+class MicroBatcher:
+    """Collects single images from concurrent requests and runs them through
+    the model as one batch.
+
+    A batch is flushed as soon as it holds `max_batch_size` images or the
+    oldest pending image has waited `max_wait_ms`, whichever comes first.
+    With `max_queue` set, `submit` raises InferenceBusy once that many images
+    are waiting.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=5, max_queue=None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queue = int(max_queue) if max_queue else None
+        self._rejected = 0
+
+        self._closed = False
+        self._reset()
+
+        # The worker thread is started on first use, so a batcher created in a
+        # preloading parent process still works in its forked children
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+        # Batch fill statistics
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._last_batch_size = 0
+        self._fill_counts = [0] * self.max_batch_size
+
+    def submit(self, img_array):
+        """Queue one preprocessed (224, 224, 3) image and return a Future that
+        resolves to its row of class probabilities."""
+        return self._submit([img_array])[0]
+
+    def predict(self, img_array, timeout=None):
+        """Blocking helper around `submit`."""
+        future = self.submit(img_array)
+        try:
+            return future.result(timeout)
+        finally:
+            # An image still queued after a timeout is not run; the caller
+            # may already be reusing its buffer
+            future.cancel()
+
+    def predict_many(self, batch, timeout=None):
+        """Queues every image of an assembled batch and waits at most
+        `timeout` seconds for all of them. The batcher thread runs them, in
+        batches of up to max_batch_size, along with other requests' images."""
+        futures = self._submit(list(batch))
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            return np.stack([
+                future.result(None if deadline is None else max(0.0, deadline - time.monotonic()))
+                for future in futures
+            ])
+        finally:
+            # Images still queued after a timeout are not run
+            for future in futures:
+                future.cancel()
+
+    def _submit(self, images):
+        # All of `images` are queued, or none are. A batch larger than
+        # max_queue is still taken when nothing else is waiting.
+        futures = [Future() for _ in images]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("MicroBatcher is closed")
+            if self.max_queue is not None and self._pending and len(self._pending) + len(images) > self.max_queue:
+                self._rejected += len(images)
+                raise InferenceBusy(f"Inference queue is full ({self.max_queue} images waiting)")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+            self._pending.extend(zip(images, futures))
+            self._cond.notify()
+        return futures
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self._batches
+            return {
+                "mode": "inline",
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "batches": batches,
+                "items": self._items,
+                "last_batch_size": self._last_batch_size,
+                "mean_batch_size": round(self._items / batches, 3) if batches else 0.0,
+                "mean_fill_ratio": round(self._items / (batches * self.max_batch_size), 3) if batches else 0.0,
+                # fill_histogram[i] is the number of batches that held i + 1 images
+                "fill_histogram": list(self._fill_counts),
+                "queue_depth": len(self._pending),
+                "max_queue": self.max_queue,
+                "rejected": self._rejected,
+            }
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None
+
+            # Wait for the batch to fill up, but never longer than max_wait
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # Requests that gave up while queued are left out of the batch
+            batch = [(img, future) for img, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            self._record(len(batch))
+
+            futures = [future for _, future in batch]
+            try:
+                predictions = np.asarray(self.predict_fn(np.stack([img for img, _ in batch])))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for i, future in enumerate(futures):
+                future.set_result(predictions[i])
+
+    def _record(self, size):
+        with self._stats_lock:
+            self._batches += 1
+            self._items += size
+            self._last_batch_size = size
+            self._fill_counts[size - 1] += 1
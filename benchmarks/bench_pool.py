@@ -0,0 +1,86 @@
+"""Connection pool saturation against a real mongod.
+
+For each pool size, --concurrency threads look up user documents by _id,
+as /account/predictions does. Once the threads outnumber the pool they queue for
+a connection: the pool wait and latency percentiles climb and, past
+--wait-queue-timeout-ms, requests fail with WaitQueueTimeoutError instead
+of queueing without limit. --server-ms makes every query take at least that
+long on the server (with $where, so the mongod needs server-side
+JavaScript), which shows saturation with fewer threads.
+
+    python benchmarks/bench_pool.py --uri mongodb://localhost:27017
+    python benchmarks/bench_pool.py --pool-sizes 2 8 32 --concurrency 32 --server-ms 20 --output pool.json
+"""
+import argparse
+import random
+
+from harness import print_table, run_load, save_results, summarize
+
+
+class WaitRecorder:
+    # Stands in for the pool-wait histogram, keeping every wait
+    def __init__(self):
+        self.waits = {}
+
+    def observe(self, seconds, outcome):
+        self.waits.setdefault(outcome, []).append(seconds)
+
+
+def seed(collection, users, history):
+    collection.drop()
+    records = [{"snake": "Cobra", "accuracy": 90.0, "timestamp": f"2024-01-01T00:00:{i % 60:02d}"} for i in range(history)]
+    return collection.insert_many(
+        [{"email": f"pool{i}@example.com", "recent_predictions": records} for i in range(users)]).inserted_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per pool size")
+    parser.add_argument("--wait-queue-timeout-ms", type=int, default=1000)
+    parser.add_argument("--server-ms", type=int, default=0, help="Minimum server-side time per query")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--history", type=int, default=50)
+    parser.add_argument("--output", help="Save the results as JSON")
+    args = parser.parse_args()
+
+    import database
+    import metrics
+
+    setup = database.create_client(args.uri)
+    user_ids = seed(setup.SnakesG1_bench.users, args.users, args.history)
+    setup.close()
+
+    results = {}
+    for pool_size in args.pool_sizes:
+        recorder = WaitRecorder()
+        client = database.create_client(args.uri, listeners=[metrics.PoolMetrics(recorder)], maxPoolSize=pool_size,
+                                        waitQueueTimeoutMS=args.wait_queue_timeout_ms)
+        users = client.SnakesG1_bench.users
+        query_filter = {"$where": f"sleep({args.server_ms}) || true"} if args.server_ms else {}
+
+        def lookup(worker):
+            # Like /account/predictions: one user document by _id
+            users.find_one(dict(query_filter, _id=random.choice(user_ids)), {"recent_predictions": {"$slice": 10}})
+
+        client.admin.command("ping")
+        name = f"pool_{pool_size}"
+        print(f"Running {name}...")
+        results[name] = run_load(lookup, args.concurrency, args.requests)
+        results[name]["pool_wait"] = summarize(recorder.waits.get("ok", []))
+        results[name]["checkout_failures"] = {outcome: len(waits) for outcome, waits in recorder.waits.items() if outcome != "ok"}
+        client.close()
+
+    print_table(results)
+    for name, summary in results.items():
+        wait = summary["pool_wait"]
+        print(f"{name:32} pool wait p50 {wait['p50_ms']} ms, p99 {wait['p99_ms']} ms, "
+              f"failed checkouts {summary['checkout_failures'] or 0}")
+    if args.output:
+        save_results(args.output, "pool", {key: value for key, value in vars(args).items() if key != "output"}, results)
+
+
+if __name__ == "__main__":
+    main()
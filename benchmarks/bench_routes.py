@@ -0,0 +1,167 @@
+"""Latency and throughput of the main routes, run in-process against the Flask app.
+
+The database is mongomock unless --mongo-uri points at a real mongod, and
+the model is a stub returning random probabilities after --stub-latency-ms
+unless --model real is given. Each route is loaded from --concurrency
+threads; the results can be saved with --output and diffed with compare.py.
+
+    python benchmarks/bench_routes.py
+    python benchmarks/bench_routes.py --routes predict snakes --concurrency 16 --requests 2000 --output after.json
+    python benchmarks/bench_routes.py --mongo-uri mongodb://localhost:27017 --model real
+"""
+import argparse
+import io
+import itertools
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+from harness import ROOT, print_table, run_load, save_results
+
+ROUTES = ("predict", "predict_cached", "snakes", "searchsnake", "login", "account_predictions")
+PASSWORD = "benchmark-password"
+
+
+def use_mongomock():
+    # Must run before app is imported, as it creates its client at import time
+    import mongomock
+    import pymongo.mongo_client
+
+    class MockClient(mongomock.MongoClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__()
+
+    pymongo.mongo_client.MongoClient = MockClient
+
+
+def stub_model(api, latency_ms, seed=0):
+    rng = np.random.default_rng(seed)
+    num_classes = len(api.class_list)
+
+    def predict(batch):
+        time.sleep(latency_ms / 1000.0)
+        return rng.dirichlet(np.ones(num_classes), size=len(batch)).astype(np.float32)
+
+    api.model.predict = predict
+
+
+def seed_database(api, users, history):
+    api.db.users.drop()
+    api.db.snakes.drop()
+    api.ensure_indexes(api.db)
+    api.db.snakes.insert_many([
+        {"name": name, "image": f"{name}.jpg", "description": f"About the {name}.", "endemism": "Sri Lanka",
+         "wikiLink": f"https://en.wikipedia.org/wiki/{name.replace(' ', '_')}"}
+        for name in api.class_list
+    ])
+    api.catalog.invalidate()
+
+    hashed = api.password_hasher.hash(PASSWORD)
+    records = [api.make_prediction_record(random.choice(api.class_list), 90.0) for _ in range(history)]
+    result = api.db.users.insert_many([
+        {"email": f"bench{i}@example.com", "password": hashed, "recent_predictions": records} for i in range(users)
+    ])
+    with api.app.app_context():
+        from flask_jwt_extended import create_access_token
+
+        return [create_access_token(identity=str(user_id)) for user_id in result.inserted_ids]
+
+
+def make_requests(api, tokens, image):
+    clients = threading.local()
+    counter = itertools.count()
+
+    def client():
+        if not hasattr(clients, "client"):
+            clients.client = api.app.test_client()
+        return clients.client
+
+    def auth(worker):
+        return {"Authorization": f"Bearer {tokens[worker % len(tokens)]}"}
+
+    def predict(worker):
+        # Bytes after the JPEG end marker are ignored by the decoder but
+        # make every upload miss the prediction cache
+        data = image + str(next(counter)).encode()
+        response = client().post("/predict", content_type="multipart/form-data", headers=auth(worker),
+                                 data={"image": (io.BytesIO(data), "bench.jpg")})
+        return response.status_code == 200
+
+    def predict_cached(worker):
+        response = client().post("/predict", content_type="multipart/form-data",
+                                 data={"image": (io.BytesIO(image), "bench.jpg")})
+        return response.status_code == 200
+
+    def snakes(worker):
+        return client().get("/snakes").status_code == 200
+
+    def searchsnake(worker):
+        return client().get(f"/searchsnake/{random.choice(api.class_list)}").status_code == 200
+
+    def login(worker):
+        response = client().post("/login", json={"email": f"bench{worker % len(tokens)}@example.com", "password": PASSWORD})
+        return response.status_code == 200
+
+    def account_predictions(worker):
+        return client().get("/account/predictions", headers=auth(worker)).status_code == 200
+
+    return {"predict": predict, "predict_cached": predict_cached, "snakes": snakes, "searchsnake": searchsnake,
+            "login": login, "account_predictions": account_predictions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--routes", nargs="+", choices=ROUTES, default=list(ROUTES))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500, help="Requests per route")
+    parser.add_argument("--duration", type=float, help="Seconds per route, instead of --requests")
+    parser.add_argument("--mongo-uri", help="Use this MongoDB instead of mongomock")
+    parser.add_argument("--model", choices=("stub", "real"), default="stub")
+    parser.add_argument("--stub-latency-ms", type=float, default=20.0, help="Forward-pass time of the stub model")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--history", type=int, default=50, help="Predictions already in each user's history")
+    parser.add_argument("--image", default=os.path.join(ROOT, "tests", "test_image1.jpg"))
+    parser.add_argument("--output", help="Save the results as JSON")
+    args = parser.parse_args()
+
+    os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret-key-of-at-least-32-bytes")
+    os.environ.setdefault("CATALOG_CHANGE_STREAM", "false")
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    else:
+        use_mongomock()
+
+    import app as api
+
+    api.app.config["TESTING"] = True
+    api.db = api.client.SnakesG1_bench
+    api.users_collection = api.history_writer.collection = api.db.users
+    api.snakes_collection = api.db.snakes
+    api.catalog.collection = api.db.snakes
+    if args.model == "stub":
+        stub_model(api, args.stub_latency_ms)
+    else:
+        api.create_app()
+
+    tokens = seed_database(api, args.users, args.history)
+    with open(args.image, "rb") as f:
+        requests = make_requests(api, tokens, f.read())
+
+    results = {}
+    for route in args.routes:
+        print(f"Running {route}...")
+        results[route] = run_load(requests[route], args.concurrency, args.requests, args.duration)
+    api.history_writer.close()
+
+    print_table(results)
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key not in ("output", "mongo_uri")}
+        settings["mongo"] = "mongod" if args.mongo_uri else "mongomock"
+        save_results(args.output, "routes", settings, results)
+
+
+if __name__ == "__main__":
+    main()
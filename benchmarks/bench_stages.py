@@ -0,0 +1,95 @@
+"""Micro-benchmarks of the stages of a /predict request, each timed on its own:
+decode (JPEG to 224x224 pixels), preprocess (pixels to model input), forward
+pass (batch of 1 and of --batch-size) and serialize (post-processing and the
+JSON response body).
+
+The model is a stub that returns random probabilities unless --model real
+is given. A synthetic 12 MP photo is decoded too, to show the cost of large
+uploads.
+
+    python benchmarks/bench_stages.py
+    python benchmarks/bench_stages.py --model real --backend tflite --output stages.json
+"""
+import argparse
+import io
+import json
+import os
+
+import numpy as np
+
+from harness import ROOT, print_table, save_results, time_calls
+
+
+def synthetic_photo(size=(4000, 3000)):
+    from PIL import Image
+
+    # Smooth gradients compress like a photo rather than like noise
+    x = np.linspace(0, 255, size[0], dtype=np.float32)
+    y = np.linspace(0, 255, size[1], dtype=np.float32)[:, None]
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1).astype(np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(pixels).save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image", default=os.path.join(ROOT, "tests", "test_image1.jpg"))
+    parser.add_argument("--model", choices=("stub", "real"), default="stub")
+    parser.add_argument("--backend", default=os.getenv("MODEL_BACKEND", "keras"))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--output", help="Save the results as JSON")
+    args = parser.parse_args()
+
+    from keras.applications.mobilenet import preprocess_input
+
+    from imaging import read_pixels
+    from model_runtime import INPUT_SHAPE, class_list, load_runtime, default_runtime_path, warm_up
+    from postprocessing import PostProcessor
+
+    with open(args.image, "rb") as f:
+        data = f.read()
+    photo = synthetic_photo()
+
+    if args.model == "real":
+        runtime = load_runtime(args.backend, default_runtime_path(args.backend))
+        warm_up(runtime, (1, args.batch_size))
+        predict = runtime.predict
+    else:
+        rng = np.random.default_rng(0)
+
+        def predict(batch):
+            return rng.dirichlet(np.ones(len(class_list)), size=len(batch)).astype(np.float32)
+
+    pixels = np.asarray(read_pixels(data), dtype=np.uint8)
+    buffer = np.empty(INPUT_SHAPE, dtype=np.float32)
+    batch = np.zeros((args.batch_size,) + INPUT_SHAPE, dtype=np.float32)
+    postprocessor = PostProcessor(class_list)
+    probabilities = predict(batch[:1])
+
+    def preprocess():
+        buffer[...] = pixels
+        preprocess_input(buffer)
+
+    def serialize():
+        # What /predict does after the forward pass
+        result = postprocessor(probabilities, k=3)[0]
+        json.dumps(result, separators=(",", ":"))
+
+    results = {
+        "decode": time_calls(lambda: np.asarray(read_pixels(data)), args.repeat),
+        "decode_12mp": time_calls(lambda: np.asarray(read_pixels(photo)), max(args.repeat // 10, 5)),
+        "preprocess": time_calls(preprocess, args.repeat),
+        "forward_batch_1": time_calls(lambda: predict(batch[:1]), args.repeat),
+        f"forward_batch_{args.batch_size}": time_calls(lambda: predict(batch), args.repeat),
+        "serialize": time_calls(serialize, args.repeat),
+    }
+
+    print_table(results)
+    if args.output:
+        save_results(args.output, "stages", {key: value for key, value in vars(args).items() if key != "output"}, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Latency versus accuracy of test-time augmentation for K = 1..8 views.
+
+By default the images in tests/ are used. They are unlabelled, so accuracy
+is reported as agreement with the single-view prediction plus the mean top
+probability. With --data-dir (one sub-directory per class, as for
+calibrate.py) real accuracy is reported.
+
+    python benchmarks/bench_tta.py
+    python benchmarks/bench_tta.py --data-dir validation --backend tflite --repeat 5 --output tta.json
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from harness import ROOT, print_table, save_results, summarize
+
+
+def load_images(args):
+    from calibrate import labelled_images
+    from export_model import IMAGE_EXTENSIONS
+    from imaging import decode_image
+    from model_runtime import INPUT_SHAPE
+
+    if args.data_dir:
+        samples = list(labelled_images(args.data_dir))
+    else:
+        samples = [(os.path.join(args.images, name), None) for name in sorted(os.listdir(args.images))
+                   if name.lower().endswith(IMAGE_EXTENSIONS)]
+    images = []
+    for path, _ in samples:
+        with open(path, "rb") as f:
+            images.append(decode_image(f.read(), out=np.empty(INPUT_SHAPE, dtype=np.float32)))
+    return images, [label for _, label in samples]
+
+
+def run(runtime, images, views, repeat):
+    """Merged probabilities of every image and the per-image latencies in seconds."""
+    from tta import augment, merge
+
+    results, latencies = [], []
+    for img_array in images:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            probabilities = merge(runtime.predict(augment(img_array, views)))
+            latencies.append(time.perf_counter() - start)
+        results.append(probabilities)
+    return np.array(results), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", default=os.path.join(ROOT, "tests"), help="Unlabelled images")
+    parser.add_argument("--data-dir", help="Labelled images, one sub-directory per class")
+    parser.add_argument("--backend", default=os.getenv("MODEL_BACKEND", "keras"))
+    parser.add_argument("--model", help="Defaults to the backend's default model file")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per image and K")
+    parser.add_argument("--output", help="Save the results as JSON")
+    args = parser.parse_args()
+
+    from model_runtime import default_runtime_path, load_runtime, warm_up
+    from tta import MAX_VIEWS
+
+    images, labels = load_images(args)
+    if not images:
+        parser.error("No images found")
+    labelled = all(label is not None for label in labels)
+
+    runtime = load_runtime(args.backend, args.model or default_runtime_path(args.backend))
+    warm_up(runtime, range(1, MAX_VIEWS + 1))
+
+    results, baseline = {}, None
+    for views in range(1, MAX_VIEWS + 1):
+        probabilities, latencies = run(runtime, images, views, args.repeat)
+        predicted = probabilities.argmax(axis=1)
+        if baseline is None:
+            baseline = predicted
+        summary = summarize(latencies, elapsed=sum(latencies))
+        summary["mean_top_probability"] = round(float(probabilities.max(axis=1).mean()), 4)
+        if labelled:
+            summary["accuracy"] = round(float((predicted == np.array(labels)).mean()), 4)
+        else:
+            summary["agreement"] = round(float((predicted == baseline).mean()), 4)
+        results[f"tta_{views}_views"] = summary
+
+    print_table(results)
+    quality = "accuracy" if labelled else "agreement"
+    for name, summary in results.items():
+        print(f"{name:32} {quality} {summary[quality]}, mean top probability {summary['mean_top_probability']}")
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key != "output"}
+        save_results(args.output, "tta", dict(settings, images=len(images)), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Compares two saved benchmark runs and flags regressions.
+
+Latencies that grew, or throughput that fell, by more than --threshold
+percent count as regressions, and the script exits with status 1 if there
+are any, so it can gate a change in CI:
+
+    python benchmarks/compare.py before.json after.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+LATENCY_METRICS = ("p50_ms", "p95_ms", "p99_ms")
+
+
+def change(before, after):
+    """Percentage change from `before` to `after`, or None if either is missing."""
+    if before is None or after is None or before == 0:
+        return None
+    return (after - before) / before * 100
+
+
+def compare(before, after, threshold=10.0):
+    """Returns (rows, regressions): a row per benchmark and metric present in
+    both runs, and the subset of them that got worse by more than `threshold`%."""
+    rows, regressions = [], []
+    for name, old in before["results"].items():
+        new = after["results"].get(name)
+        if new is None:
+            continue
+        for metric in LATENCY_METRICS + ("throughput_rps",):
+            delta = change(old.get(metric), new.get(metric))
+            if delta is None:
+                continue
+            row = (name, metric, old[metric], new[metric], delta)
+            rows.append(row)
+            worse = -delta if metric == "throughput_rps" else delta
+            if worse > threshold:
+                regressions.append(row)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Allowed slowdown in percent")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before.get("kind") != after.get("kind"):
+        sys.exit(f"Cannot compare a {before.get('kind')} run with a {after.get('kind')} run")
+
+    rows, regressions = compare(before, after, args.threshold)
+    print(f"{'benchmark':32} {'metric':15} {'before':>10} {'after':>10} {'change':>8}")
+    for name, metric, old, new, delta in rows:
+        flag = "  <-- regression" if (name, metric, old, new, delta) in regressions else ""
+        print(f"{name:32} {metric:15} {old:>10} {new:>10} {delta:>+7.1f}%{flag}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold}%")
+        sys.exit(1)
+    print(f"No regressions over {args.threshold}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Shared helpers for the benchmark scripts: timing, load generation and
+JSON results that compare.py can diff."""
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def summarize(latencies, elapsed=None, errors=0):
+    """Latency percentiles in ms, plus throughput when the wall time is known."""
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    summary = {
+        "count": int(len(latencies)),
+        "errors": int(errors),
+        "mean_ms": round(float(latencies.mean()), 3) if len(latencies) else None,
+    }
+    for p in (50, 95, 99):
+        summary[f"p{p}_ms"] = round(float(np.percentile(latencies, p)), 3) if len(latencies) else None
+    if elapsed:
+        summary["throughput_rps"] = round(len(latencies) / elapsed, 1)
+    return summary
+
+
+def time_calls(fn, repeat=100, warmup=5):
+    """Calls `fn` repeatedly on this thread and summarises the latencies."""
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, elapsed=sum(latencies))
+
+
+def run_load(make_request, concurrency=8, requests=500, duration=None, warmup=10):
+    """Runs `make_request(worker)` from `concurrency` threads, either
+    `requests` times in total or for `duration` seconds, and summarises the
+    latencies. A call counts as an error if it raises or returns False."""
+    for _ in range(warmup):
+        make_request(0)
+
+    lock = threading.Lock()
+    latencies, errors = [], [0]
+    remaining = [requests]
+    deadline = None if duration is None else time.perf_counter() + duration
+
+    def worker(worker_id):
+        while True:
+            if deadline is not None:
+                if time.perf_counter() >= deadline:
+                    return
+            else:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                ok = make_request(worker_id) is not False
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    return summarize(latencies, elapsed=time.perf_counter() - start, errors=errors[0])
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def save_results(path, kind, settings, results):
+    """Writes one run's results; `results` maps a benchmark name to its summary."""
+    with open(path, "w") as f:
+        json.dump({"kind": kind, "environment": environment(), "settings": settings, "results": results}, f, indent=2)
+    print(f"Wrote {path}")
+
+
+def print_table(results):
+    print(f"{'benchmark':32} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'errors':>7}")
+    for name, summary in results.items():
+        print(f"{name:32} {summary['p50_ms']!s:>9} {summary['p95_ms']!s:>9} {summary['p99_ms']!s:>9} "
+              f"{summary.get('throughput_rps', '')!s:>9} {summary['errors']:>7}")
@@ -0,0 +1,81 @@
+"""Fits the temperature used to calibrate the model's probabilities.
+
+The labelled images are read from one sub-directory per class, named as in
+class_list (e.g. validation/Cobra/*.jpg). Use images the model was not
+trained on.
+
+    python calibrate.py --data-dir validation
+    python calibrate.py --data-dir validation --backend tflite --output calibration.json
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from export_model import IMAGE_EXTENSIONS
+from imaging import decode_image
+from model_runtime import INPUT_SHAPE, class_list, load_runtime, default_runtime_path
+from postprocessing import (apply_temperature, expected_calibration_error, fit_temperature,
+                            negative_log_likelihood)
+
+
+def labelled_images(directory):
+    """Yields (path, class index) for every image under a class sub-directory."""
+    for label, name in enumerate(class_list):
+        class_dir = os.path.join(directory, name)
+        if not os.path.isdir(class_dir):
+            continue
+        for filename in sorted(os.listdir(class_dir)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(class_dir, filename), label
+
+
+def predict_all(runtime, samples, batch_size=32):
+    """Probabilities for every sample, run through the model in batches."""
+    probabilities = []
+    batch = np.empty((batch_size,) + INPUT_SHAPE, dtype=np.float32)
+    for start in range(0, len(samples), batch_size):
+        chunk = samples[start:start + batch_size]
+        for i, (path, _) in enumerate(chunk):
+            with open(path, "rb") as f:
+                decode_image(f.read(), out=batch[i])
+        probabilities.append(np.asarray(runtime.predict(batch[:len(chunk)])))
+    return np.concatenate(probabilities)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data-dir", required=True, help="One sub-directory of images per class")
+    parser.add_argument("--backend", default=os.getenv("MODEL_BACKEND", "keras"))
+    parser.add_argument("--model", help="Defaults to the backend's default model file")
+    parser.add_argument("--output", default="calibration.json")
+    args = parser.parse_args()
+
+    samples = list(labelled_images(args.data_dir))
+    if not samples:
+        parser.error(f"No labelled images found in '{args.data_dir}'")
+    labels = np.array([label for _, label in samples])
+
+    runtime = load_runtime(args.backend, args.model or default_runtime_path(args.backend))
+    probabilities = predict_all(runtime, samples)
+    temperature = fit_temperature(probabilities, labels)
+    calibrated = apply_temperature(probabilities, temperature)
+
+    report = {
+        "temperature": round(temperature, 4),
+        "samples": len(samples),
+        "accuracy": round(float((probabilities.argmax(axis=1) == labels).mean()), 4),
+        "nll_before": round(negative_log_likelihood(probabilities, labels), 4),
+        "nll_after": round(negative_log_likelihood(calibrated, labels), 4),
+        "ece_before": round(expected_calibration_error(probabilities, labels), 4),
+        "ece_after": round(expected_calibration_error(calibrated, labels), 4),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print(f"Wrote {args.output}; set CALIBRATION_FILE={args.output} to use it")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from pymongo.errors import PyMongoError
+
+from database import CircuitOpen, request_deadline
+from streaming import dumps
+
+logger = logging.getLogger(__name__)
+
+# Fields of a snake that ?fields= can select
+FIELDS = ("_id", "name", "image", "description", "endemism", "wikiLink")
+
+
+class CatalogSnapshot:
+    """One immutable, pre-serialized view of the snakes collection."""
+
+    def __init__(self, snakes):
+        self.snakes = snakes
+        self.by_name = {snake["name"]: snake for snake in snakes if "name" in snake}
+        self.snakes_body = _dumps({"snakes": snakes})
+        self.list_body = _dumps({"snakes": [{"name": snake["name"]} if "name" in snake else {} for snake in snakes]})
+        self.snakes_etag = hashlib.sha1(self.snakes_body).hexdigest()
+        self.list_etag = hashlib.sha1(self.list_body).hexdigest()
+        # HTTP dates have one-second resolution
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+class CatalogCache:
+    """In-process cache of the snake catalog.
+
+    The collection is read once and kept as ready-to-send JSON bytes for the
+    list endpoints plus a name -> document index. Every write through the API
+    calls `invalidate()`; with `watch_changes` every process also watches the
+    collection for writes made by other workers (see
+    `start_change_stream_listener()`).
+
+    A snapshot older than `max_age` seconds is reloaded, so a worker that
+    misses an invalidation (no change stream, or a write made elsewhere)
+    catches up eventually.
+
+    A reload gets at most `load_timeout` seconds and goes through `breaker`
+    (a database.CircuitBreaker). If it fails, times out or the circuit is
+    open, the previous snapshot is served until the database recovers. A
+    reload cut short by the caller's own request deadline is not counted
+    as a failure.
+    """
+
+    def __init__(self, collection, breaker=None, load_timeout=None, max_age=None, clock=time.monotonic,
+                 watch_changes=False):
+        self.collection = collection
+        self.watch_changes = watch_changes
+        self.breaker = breaker
+        self.load_timeout = load_timeout
+        self.max_age = max_age or None
+        self.clock = clock
+        self._snapshot = None
+        self._loaded_at = None
+        self._stale = None
+        # Bumped by every invalidate(), so a load that overlaps one is not kept
+        self._generation = 0
+        # _lock serializes loads; _state_lock guards the snapshot fields and is
+        # only held briefly, so invalidate() never waits for a slow load
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._listener = None
+        self.loads = 0
+        self.stale_served = 0
+
+        # Threads do not survive fork, so a forked worker starts its own
+        # listener on first use instead of inheriting the parent's
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._listener = None
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+
+    def get(self):
+        if self.watch_changes and self._listener is None:
+            self.start_change_stream_listener()
+        snapshot = self._current()
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._current()
+                if snapshot is None:
+                    with self._state_lock:
+                        generation = self._generation
+                    try:
+                        start = self._before_load()
+                        try:
+                            with request_deadline(self.load_timeout):
+                                snapshot = self._load()
+                        except PyMongoError as e:
+                            self._after_load(start, e)
+                            raise
+                        self._after_load(start)
+                    except (PyMongoError, CircuitOpen) as e:
+                        return self._fallback(e)
+                    self._install(snapshot, generation)
+        return snapshot
+
+    def invalidate(self):
+        # The last snapshot is kept to serve while the database is unavailable
+        with self._state_lock:
+            self._generation += 1
+            self._stale = self._snapshot or self._stale
+            self._snapshot = None
+
+    def _current(self):
+        # The cached snapshot, unless it is older than max_age
+        with self._state_lock:
+            snapshot, loaded_at = self._snapshot, self._loaded_at
+        if snapshot is not None and self.max_age is not None and self.clock() - loaded_at >= self.max_age:
+            return None
+        return snapshot
+
+    def _install(self, snapshot, generation):
+        # A load that overlapped an invalidate() may have read the collection
+        # before the write; it answers its own caller but is not cached
+        with self._state_lock:
+            if generation == self._generation:
+                self._snapshot = snapshot
+                self._loaded_at = self.clock()
+
+    def stats(self):
+        return {
+            "loaded": self._snapshot is not None,
+            "loads": self.loads,
+            "stale_served": self.stale_served,
+            "breaker": self.breaker.stats() if self.breaker is not None else None,
+        }
+
+    def _before_load(self):
+        if self.breaker is not None:
+            self.breaker.before_call()
+        return time.perf_counter()
+
+    def _after_load(self, start, error=None):
+        if self.breaker is None:
+            return
+        elapsed = time.perf_counter() - start
+        if error is not None and error.timeout and self.load_timeout and elapsed < self.load_timeout:
+            # Cut short by a deadline of the caller's that was nearly spent
+            # already (request_deadline keeps the earlier of the two), which
+            # says nothing about the database
+            self.breaker.cancel()
+            return
+        self.breaker.record(elapsed, failed=error is not None)
+
+    def _fallback(self, error):
+        with self._state_lock:
+            stale = self._snapshot or self._stale
+        if stale is None:
+            raise error
+        self.stale_served += 1
+        logger.warning("Serving the cached snake catalog; the database is unavailable or slow")
+        return stale
+
+    def start_change_stream_listener(self):
+        """Invalidates the cache whenever the collection changes, including
+        writes made by other workers. Needs a replica set or sharded cluster.
+        Called by the first get() when `watch_changes` is set."""
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._watch, name="catalog-change-stream", daemon=True)
+                self._listener.start()
+
+    def _load(self):
+        snakes = []
+        for snake in self.collection.find({}):
+            snake["_id"] = str(snake["_id"])
+            snakes.append(snake)
+        self.loads += 1
+        return CatalogSnapshot(snakes)
+
+    def _watch(self):
+        from pymongo.errors import OperationFailure
+
+        delay = 1
+        while True:
+            try:
+                with self.collection.watch() as stream:
+                    # Anything may have changed while the stream was down
+                    self.invalidate()
+                    delay = 1
+                    for _ in stream:
+                        self.invalidate()
+            except OperationFailure as e:
+                logger.warning("Catalog change stream unavailable: %s", e)
+                return
+            except PyMongoError as e:
+                logger.warning("Catalog change stream error, reconnecting: %s", e)
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+
+class AsyncCatalogCache(CatalogCache):
+    """CatalogCache for an async (Motor) collection; `get` is a coroutine.
+    With `watch_changes` the change stream is watched by a task on the
+    event loop instead of a thread."""
+
+    def __init__(self, collection, breaker=None, load_timeout=None, max_age=None, clock=time.monotonic,
+                 watch_changes=False):
+        super().__init__(collection, breaker, load_timeout, max_age, clock, watch_changes)
+        self._async_lock = asyncio.Lock()
+
+    async def get(self):
+        if self.watch_changes and self._listener is None:
+            self.start_change_stream_listener()
+        snapshot = self._current()
+        if snapshot is None:
+            async with self._async_lock:
+                snapshot = self._current()
+                if snapshot is None:
+                    with self._state_lock:
+                        generation = self._generation
+                    try:
+                        start = self._before_load()
+                        try:
+                            with request_deadline(self.load_timeout):
+                                snapshot = await self._load()
+                        except PyMongoError as e:
+                            self._after_load(start, e)
+                            raise
+                        self._after_load(start)
+                    except (PyMongoError, CircuitOpen) as e:
+                        return self._fallback(e)
+                    self._install(snapshot, generation)
+        return snapshot
+
+    def start_change_stream_listener(self):
+        """Invalidates the cache whenever the collection changes, from a task
+        on the running event loop. Called by the first get() when
+        `watch_changes` is set."""
+        if self._listener is None:
+            self._listener = asyncio.get_running_loop().create_task(self._watch())
+
+    def close(self):
+        # Stops the change stream task, if there is one
+        if self._listener is not None:
+            self._listener.cancel()
+
+    async def _watch(self):
+        from pymongo.errors import OperationFailure
+
+        delay = 1
+        while True:
+            try:
+                async with self.collection.watch() as stream:
+                    # Anything may have changed while the stream was down
+                    self.invalidate()
+                    delay = 1
+                    async for _ in stream:
+                        self.invalidate()
+            except OperationFailure as e:
+                logger.warning("Catalog change stream unavailable: %s", e)
+                return
+            except PyMongoError as e:
+                logger.warning("Catalog change stream error, reconnecting: %s", e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    async def _load(self):
+        snakes = []
+        async for snake in self.collection.find({}):
+            snake["_id"] = str(snake["_id"])
+            snakes.append(snake)
+        self.loads += 1
+        return CatalogSnapshot(snakes)
+
+
+def variant_etag(etag, fields=None, ndjson=False):
+    """ETag of a projected or NDJSON rendering of the snapshot tagged `etag`."""
+    variant = f"{etag}|{','.join(fields or ())}|{'ndjson' if ndjson else 'json'}"
+    return hashlib.sha1(variant.encode()).hexdigest()
+
+
+def _dumps(obj):
+    # Compact and key-sorted, like Flask's jsonify
+    return dumps(obj, sort_keys=True) + b"\n"
@@ -0,0 +1,259 @@
+"""Classifies every image in a directory or tar archive, without the web app.
+
+Images are decoded and resized by a pool of worker processes while the
+model runs fixed-size batches in this one, and the results are written as
+they come: to a CSV file, or to a directory of Parquet files when the
+output ends in .parquet (which needs pyarrow). Running the same command
+again skips the images already in the output, so an interrupted run
+resumes where it stopped.
+
+    python classify_archive.py static --output static.csv
+    python classify_archive.py photos.tar.gz --output photos.parquet --backend onnx --batch-size 64
+"""
+import argparse
+import collections
+import csv
+import glob
+import multiprocessing
+import os
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from export_model import IMAGE_EXTENSIONS
+from imaging import preprocess, read_pixels
+from model_runtime import INPUT_SHAPE, class_list, default_runtime_path, load_runtime
+from postprocessing import PostProcessor, load_calibration
+
+COLUMNS = ("name", "snake", "accuracy", "uncertain", "error")
+
+
+def iter_images(path):
+    """Yields (name, source) for every image under a directory or in a tar
+    archive. The source is the file's path, or for a tar member its bytes;
+    the archive is read once, front to back, so it may be compressed."""
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    full_path = os.path.join(root, filename)
+                    yield os.path.relpath(full_path, path), full_path
+        return
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield member.name, archive.extractfile(member).read()
+
+
+def decode(source):
+    """The (224, 224, 3) uint8 pixels of an image path or bytes. Runs in the
+    worker processes, which never import TensorFlow."""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            source = f.read()
+    return np.asarray(read_pixels(source), dtype=np.uint8)
+
+
+def _decode_or_error(source):
+    try:
+        return decode(source), None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+
+
+class CsvOutput:
+    """Appends result rows to a CSV file, flushed after every batch. The
+    names already in the file are `done`; a last line cut short by a crash
+    is dropped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                data = f.read()
+                f.truncate(data.rfind(b"\n") + 1)
+            with open(path, newline="", encoding="utf-8") as f:
+                self.done = {row["name"] for row in csv.DictReader(f)}
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "a", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, COLUMNS)
+        if new:
+            self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetOutput:
+    """Writes result rows to a directory of Parquet files, one per batch.
+    Every file is renamed into place once complete, so a crash loses at
+    most the batch being written, like CsvOutput."""
+
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.path = path
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        os.makedirs(path, exist_ok=True)
+        parts = sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+        self.done = set()
+        for part in parts:
+            self.done.update(self._pq.read_table(part, columns=["name"]).column("name").to_pylist())
+        self._next_part = len(parts)
+
+    def write(self, rows):
+        if not rows:
+            return
+        table = self._pa.table({column: [row[column] for row in rows] for column in COLUMNS})
+        final = os.path.join(self.path, f"part-{self._next_part:05d}.parquet")
+        self._pq.write_table(table, final + ".tmp")
+        os.replace(final + ".tmp", final)
+        self._next_part += 1
+
+    def close(self):
+        pass
+
+
+def open_output(path):
+    if path.endswith(".parquet"):
+        return ParquetOutput(path)
+    return CsvOutput(path)
+
+
+class Throughput:
+    """Images per second overall and over the last reporting interval."""
+
+    def __init__(self, interval=10.0):
+        self.interval = interval
+        self.images = 0
+        self.start = self._last_time = time.perf_counter()
+        self._last_images = 0
+
+    def add(self, count):
+        self.images += count
+        now = time.perf_counter()
+        if now - self._last_time >= self.interval:
+            recent = (self.images - self._last_images) / (now - self._last_time)
+            print(f"{self.images} images, {recent:.1f} images/s (overall {self.rate():.1f})", flush=True)
+            self._last_time, self._last_images = now, self.images
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.images / elapsed if elapsed else 0.0
+
+
+def decoded(images, workers=0, prefetch=None):
+    """Yields (name, pixels, error) for each (name, source), in order.
+
+    With `workers`, images are decoded in that many processes, at most
+    `prefetch` at a time, so decoding keeps running while the caller runs
+    the model and a large archive is never all in memory. With none they
+    are decoded in this process.
+    """
+    if not workers:
+        for name, source in images:
+            yield (name,) + _decode_or_error(source)
+        return
+
+    prefetch = prefetch or workers * 8
+    # Spawned rather than forked, like the inference pool
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = collections.deque()
+        for name, source in images:
+            pending.append((name, pool.submit(_decode_or_error, source)))
+            if len(pending) >= prefetch:
+                name, future = pending.popleft()
+                yield (name,) + future.result()
+        while pending:
+            name, future = pending.popleft()
+            yield (name,) + future.result()
+
+
+def classify(images, runtime, output, postprocessor, batch_size=32, workers=0, throughput=None):
+    """Runs every image not yet in `output` through the model in batches of
+    exactly `batch_size` (the last one padded), writing each batch's rows.
+    Returns the number of images classified."""
+    todo = ((name, source) for name, source in images if name not in output.done)
+    batch = np.zeros((batch_size,) + INPUT_SHAPE, dtype=np.float32)
+    names, rows, total = [], [], 0
+
+    def flush():
+        results = postprocessor(np.asarray(runtime.predict(batch))[:len(names)]) if names else []
+        for name, result in zip(names, results):
+            rows.append({"name": name, "snake": result["snake"], "accuracy": result["accuracy"],
+                         "uncertain": result["uncertain"], "error": None})
+        output.write(rows)
+        if throughput:
+            throughput.add(len(rows))
+        count = len(rows)
+        names.clear()
+        rows.clear()
+        return count
+
+    for name, pixels, error in decoded(todo, workers):
+        if error is not None:
+            rows.append({"name": name, "snake": None, "accuracy": None, "uncertain": None, "error": error})
+            continue
+        preprocess(pixels, out=batch[len(names)])
+        names.append(name)
+        if len(names) == batch_size:
+            total += flush()
+    if names or rows:
+        total += flush()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source", help="A directory of images or a (compressed) tar archive")
+    parser.add_argument("--output", required=True, help="A .csv file, or a .parquet directory")
+    parser.add_argument("--backend", default=os.getenv("MODEL_BACKEND", "keras"))
+    parser.add_argument("--model", default=os.getenv("MODEL_PATH"), help="Defaults to the backend's default model file")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Decoding processes; 0 decodes in the main process")
+    parser.add_argument("--threads", type=int, help="Model threads (tflite and onnx backends)")
+    parser.add_argument("--calibration", default=os.getenv("CALIBRATION_FILE"), help="Temperature file from calibrate.py")
+    parser.add_argument("--uncertain-threshold", type=float,
+                        default=float(os.getenv("PREDICT_UNCERTAIN_THRESHOLD", 0.5)))
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        parser.error(f"'{args.source}' does not exist")
+    try:
+        output = open_output(args.output)
+    except ImportError:
+        parser.error("Parquet output needs pyarrow; pip install pyarrow or write a .csv")
+    if output.done:
+        print(f"Resuming: {len(output.done)} images already in {args.output}")
+
+    kwargs = {"num_threads": args.threads} if args.threads and args.backend in ("tflite", "onnx") else {}
+    runtime = load_runtime(args.backend, args.model or default_runtime_path(args.backend), **kwargs)
+    postprocessor = PostProcessor(
+        class_list,
+        temperature=load_calibration(args.calibration)['temperature'] if args.calibration else 1.0,
+        uncertain_threshold=args.uncertain_threshold,
+    )
+
+    throughput = Throughput()
+    try:
+        classify(iter_images(args.source), runtime, output, postprocessor, args.batch_size, args.workers, throughput)
+    finally:
+        output.close()
+        elapsed = time.perf_counter() - throughput.start
+        print(f"Classified {throughput.images} images in {elapsed:.1f}s ({throughput.rate():.1f} images/s); "
+              f"results in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""MongoDB client settings, per-request deadlines and a circuit breaker.
+
+Pool size and timeouts come from the MONGO_* settings, so the sync client
+in app.py, the Motor client in asgi.py and the benchmarks all agree.
+"""
+import os
+import threading
+import time
+
+import pymongo
+from pymongo.mongo_client import MongoClient
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from pymongo.server_api import ServerApi
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+def _milliseconds(name, default):
+    # 0 turns a limit off
+    value = int(os.getenv(name, default))
+    return value or None
+
+
+def client_options():
+    """MongoClient keyword arguments from the MONGO_* settings.
+
+    A request that finds all MONGO_MAX_POOL_SIZE connections in use waits
+    at most MONGO_WAIT_QUEUE_TIMEOUT_MS for one instead of queueing without
+    limit, so a saturated pool fails fast rather than piling up requests.
+    """
+    options = {
+        "maxPoolSize": int(os.getenv('MONGO_MAX_POOL_SIZE', 100)),
+        "minPoolSize": int(os.getenv('MONGO_MIN_POOL_SIZE', 0)),
+        "maxIdleTimeMS": _milliseconds('MONGO_MAX_IDLE_TIME_MS', 0),
+        "waitQueueTimeoutMS": _milliseconds('MONGO_WAIT_QUEUE_TIMEOUT_MS', 1000),
+        "connectTimeoutMS": _milliseconds('MONGO_CONNECT_TIMEOUT_MS', 5000),
+        "socketTimeoutMS": _milliseconds('MONGO_SOCKET_TIMEOUT_MS', 10000),
+        "serverSelectionTimeoutMS": _milliseconds('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000),
+        "retryReads": os.getenv('MONGO_RETRY_READS', 'true').lower() in ('1', 'true', 'yes'),
+        "retryWrites": os.getenv('MONGO_RETRY_WRITES', 'true').lower() in ('1', 'true', 'yes'),
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+
+def create_client(uri, client_class=MongoClient, listeners=(), **overrides):
+    """A client for `uri` with the configured pool and timeouts. It connects
+    on first use, so it is safe to create before a forking server starts
+    its workers. `client_class` may be Motor's AsyncIOMotorClient."""
+    options = dict(client_options(), **overrides)
+    return client_class(uri, server_api=ServerApi('1'), connect=False, event_listeners=list(listeners), **options)
+
+
+def request_deadline(seconds):
+    """Context manager giving every database call inside it, together, at
+    most `seconds` (None or 0: only the client's own timeouts). Calls past
+    the deadline raise a PyMongoError whose `timeout` is true."""
+    return pymongo.timeout(seconds or None)
+
+
+def read_preference(name, max_staleness_seconds=-1):
+    """A read preference by its MongoDB name, e.g. "secondaryPreferred".
+    Secondaries more than `max_staleness_seconds` (at least 90, or -1 for
+    no limit) behind the primary are not read from."""
+    if name not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference {name!r}, use one of {', '.join(READ_PREFERENCES)}")
+    if name == "primary":
+        return Primary()
+    return READ_PREFERENCES[name](max_staleness=max_staleness_seconds)
+
+
+def with_read_preference(collection, preference):
+    """`collection` reading with `preference`; unchanged for the default primary."""
+    if preference == Primary():
+        return collection
+    return collection.with_options(read_preference=preference)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling the database while the circuit is open."""
+
+
+class CircuitBreaker:
+    """Stops calling a failing or slow dependency for a while.
+
+    After `failure_threshold` failures in a row, where a call slower than
+    `slow_call_seconds` counts as a failure even if it succeeded, the
+    circuit opens and calls raise CircuitOpen for `reset_seconds`. Then one
+    trial call is let through: if it succeeds the circuit closes, otherwise
+    it opens again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0, slow_call_seconds=None, clock=time.monotonic):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_seconds = reset_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return "closed"
+        if self.clock() - self._opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        """Raises CircuitOpen unless a call may go ahead now."""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return
+            self.rejected += 1
+        raise CircuitOpen("The database is unavailable or too slow; try again shortly")
+
+    def record(self, elapsed=None, failed=False):
+        """Reports how a call let through by before_call went."""
+        slow = self.slow_call_seconds is not None and elapsed is not None and elapsed > self.slow_call_seconds
+        with self._lock:
+            trial, self._trial_running = self._trial_running, False
+            if not (failed or slow):
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if trial or self._failures >= self.failure_threshold:
+                if self._opened_at is None or trial:
+                    self.opened += 1
+                self._opened_at = self.clock()
+
+    def cancel(self):
+        """Reports that a call let through by before_call ended in a way that
+        says nothing about the dependency, such as the caller's own deadline
+        running out first."""
+        with self._lock:
+            self._trial_running = False
+
+    def call(self, fn, *args, **kwargs):
+        self.before_call()
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record(time.perf_counter() - start, failed=True)
+            raise
+        self.record(time.perf_counter() - start)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self._state(),
+                "consecutive_failures": self._failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
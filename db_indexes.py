@@ -0,0 +1,128 @@
+"""Creates the MongoDB indexes the API relies on and checks the route queries use them.
+
+    python db_indexes.py                  # create the indexes
+    python db_indexes.py --explain        # also fail if a route query does a COLLSCAN
+    python db_indexes.py --explain --uri mongodb://localhost:27017 --db SnakesG1_test
+"""
+import argparse
+import logging
+import os
+import sys
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+import history
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    "users": [("email_unique", [("email", ASCENDING)], {"unique": True})],
+    "snakes": [("name_unique", [("name", ASCENDING)], {"unique": True})],
+}
+
+# The lookup each route makes, as (route, collection, filter), or with an
+# aggregation pipeline instead of the filter. /snakes and /snakelist read
+# the whole catalog by design, so they are not listed.
+ROUTE_QUERIES = [
+    ("POST /register", "users", {"email": "user@example.com"}),
+    ("POST /login", "users", {"email": "user@example.com"}),
+    ("GET /account/predictions", "users", history.records_pipeline(str(ObjectId()), 50)),
+    ("GET /account/predictions", "users", {"_id": ObjectId()}),
+    ("PUT /account/changepassword", "users", {"_id": ObjectId()}),
+    ("HistoryWriter (POST /predict)", "users", {"_id": ObjectId()}),
+    ("POST /addsnake", "snakes", {"name": "Cobra"}),
+    ("PUT /updatesnake/<name>", "snakes", {"name": "Cobra"}),
+    ("DELETE /deletesnake/<name>", "snakes", {"name": "Cobra"}),
+    ("GET /searchsnake/<name>", "snakes", {"name": "Cobra"}),
+]
+
+
+def ensure_indexes(db):
+    """Creates the unique indexes on users.email and snakes.name. Safe to run
+    on every startup; existing indexes are left alone.
+
+    Registration and /addsnake rely on these indexes alone to reject
+    duplicates, so a failure (typically existing duplicates) is raised
+    rather than letting the app start without them.
+    """
+    for collection_name, indexes in INDEXES.items():
+        for name, keys, options in indexes:
+            try:
+                db[collection_name].create_index(keys, name=name, **options)
+            except PyMongoError as e:
+                logger.error("Could not create index %s.%s: %s", collection_name, name, e)
+                raise
+
+
+async def ensure_indexes_async(db):
+    """`ensure_indexes` for an async (Motor) database."""
+    for collection_name, indexes in INDEXES.items():
+        for name, keys, options in indexes:
+            try:
+                await db[collection_name].create_index(keys, name=name, **options)
+            except PyMongoError as e:
+                logger.error("Could not create index %s.%s: %s", collection_name, name, e)
+                raise
+
+
+def find_collscans(plan):
+    """Returns the COLLSCAN stages in an explain() query plan, leaving out
+    the plans the query planner rejected."""
+    stages = []
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            stages.append(plan)
+        for key, value in plan.items():
+            if key != "rejectedPlans":
+                stages.extend(find_collscans(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_collscans(value))
+    return stages
+
+
+def check_query_plans(db):
+    """Explains each route's query and returns the routes that scan a whole collection."""
+    failures = []
+    for route, collection_name, query in ROUTE_QUERIES:
+        # Planned only, not run; the same command form for both kinds
+        if isinstance(query, list):
+            command = {"aggregate": collection_name, "pipeline": query, "cursor": {}}
+            description = f"{collection_name}.aggregate({query[0]}, ...)"
+        else:
+            command = {"find": collection_name, "filter": query}
+            description = f"{collection_name}.find({query})"
+        explain = db.command("explain", command, verbosity="queryPlanner")
+        scans = find_collscans(explain)
+        print(f"{'COLLSCAN' if scans else 'ok':10} {route:30} {description}")
+        if scans:
+            failures.append(route)
+    return failures
+
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo.mongo_client import MongoClient
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uri", default=os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="SnakesG1")
+    parser.add_argument("--explain", action="store_true", help="check the query plan of every route")
+    args = parser.parse_args()
+
+    with MongoClient(args.uri) as client:
+        db = client[args.db]
+        ensure_indexes(db)
+        print("Indexes are in place.")
+        if args.explain:
+            failures = check_query_plans(db)
+            if failures:
+                print("Collection scans in:", ", ".join(failures))
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
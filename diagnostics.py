@@ -0,0 +1,48 @@
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def _proc_kb(path, fields):
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                if name in fields:
+                    values[name] = int(rest.split()[0])
+    except OSError:
+        pass
+    return values
+
+
+def memory_stats():
+    """Memory use of this process in MB.
+
+    `pss_mb` counts pages shared with other processes (e.g. model weights
+    inherited from a preloading master) proportionally, so summing it over
+    all workers gives their real combined footprint. Fields the platform
+    cannot report are omitted.
+    """
+    stats = {"pid": os.getpid()}
+
+    status = _proc_kb("/proc/self/status", ("VmRSS", "VmHWM"))
+    if "VmRSS" in status:
+        stats["rss_mb"] = round(status["VmRSS"] / 1024, 1)
+    if "VmHWM" in status:
+        stats["peak_rss_mb"] = round(status["VmHWM"] / 1024, 1)
+    elif resource is not None:
+        # ru_maxrss is in KB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats["peak_rss_mb"] = round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+    rollup = _proc_kb("/proc/self/smaps_rollup", ("Pss", "Shared_Clean", "Shared_Dirty"))
+    if "Pss" in rollup:
+        stats["pss_mb"] = round(rollup["Pss"] / 1024, 1)
+        stats["shared_mb"] = round((rollup.get("Shared_Clean", 0) + rollup.get("Shared_Dirty", 0)) / 1024, 1)
+
+    return stats
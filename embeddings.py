@@ -0,0 +1,331 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: one writing process per store
+    fcntl = None
+
+
+def normalize(vectors):
+    """Scales each row to unit length, so a dot product is the cosine similarity."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class FeatureExtractor:
+    """The Keras model split before its classification head.
+
+    The head starts at the last Dense layer; `embed` runs everything before
+    it and returns the penultimate activations, `classify` runs the head on
+    those.
+    """
+
+    def __init__(self, keras_model):
+        import keras
+
+        layers = keras_model.layers
+        head_start = max(i for i, layer in enumerate(layers) if isinstance(layer, keras.layers.Dense))
+        self.backbone = keras.Model(keras_model.inputs, layers[head_start].input)
+        self.dim = int(layers[head_start].input.shape[-1])
+
+        # The head's layers applied to a new input, so it runs on embeddings
+        inputs = outputs = keras.Input(shape=(self.dim,))
+        for layer in layers[head_start:]:
+            outputs = layer(outputs)
+        self.head = keras.Model(inputs, outputs)
+
+    @classmethod
+    def from_runtime(cls, runtime):
+        keras_model = getattr(runtime, "keras_model", None)
+        if keras_model is None:
+            raise ValueError(f"Embeddings need the keras or tf-function backend, not '{runtime.name}'")
+        return cls(keras_model)
+
+    def embed(self, batch):
+        return np.asarray(self.backbone(np.asarray(batch, dtype=np.float32), training=False))
+
+    def classify(self, embeddings):
+        return np.asarray(self.head(np.asarray(embeddings, dtype=np.float32), training=False))
+
+
+class EmbeddingStore:
+    """Append-only store of unit-length float16 embeddings on disk.
+
+    Vectors, the probabilities they were classified with and a JSON line
+    describing each image are appended to three files in `directory` and
+    read back through a memory map, so workers sharing the directory see
+    each other's images. Appends take a file lock where the OS has one.
+
+    Searches are a brute-force matrix product until the store holds
+    `ivf_min_items` vectors; then an IVF index (spherical k-means centroids
+    with inverted lists) is trained in this process and `nprobe` lists are
+    searched per query. The index is retrained whenever the store has grown
+    fourfold since, and new vectors are assigned to their list as they
+    arrive.
+    """
+
+    # Rows converted to float32 at a time during a brute-force scan
+    CHUNK_ROWS = 65536
+
+    def __init__(self, directory, num_classes, ivf_min_items=20000, nprobe=8):
+        self.directory = directory
+        self.num_classes = int(num_classes)
+        self.ivf_min_items = int(ivf_min_items)
+        self.nprobe = int(nprobe)
+        os.makedirs(directory, exist_ok=True)
+        self._vectors_path = os.path.join(directory, "embeddings.f16")
+        self._probabilities_path = os.path.join(directory, "probabilities.f16")
+        self._items_path = os.path.join(directory, "items.jsonl")
+        self._config_path = os.path.join(directory, "store.json")
+
+        self.dim = None
+        self._read_config()
+
+        self._lock = threading.RLock()
+        self._count = 0
+        self._vectors = None
+        self._probabilities = None
+        self._items = []
+        self._items_offset = 0
+
+        self._centroids = None
+        self._trained_count = 0
+        self._lists = None
+        self._assigned = 0
+        self.searches = 0
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return self._count
+
+    def add(self, embeddings, probabilities, items):
+        """Appends embeddings (normalised here), their probabilities and a
+        dict per image. Returns the new items' positions."""
+        vectors = normalize(embeddings).astype(np.float16)
+        probabilities = np.asarray(probabilities, dtype=np.float16).reshape(len(vectors), self.num_classes)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self._config_path, "w") as f:
+                    json.dump({"dim": self.dim, "num_classes": self.num_classes}, f)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional embeddings, got {vectors.shape[1]}")
+
+            with open(self._items_path, "a") as items_file:
+                if fcntl is not None:
+                    fcntl.flock(items_file, fcntl.LOCK_EX)
+                try:
+                    start = os.path.getsize(self._vectors_path) // (self.dim * 2) if os.path.exists(self._vectors_path) else 0
+                    with open(self._vectors_path, "ab") as f:
+                        f.write(vectors.tobytes())
+                    with open(self._probabilities_path, "ab") as f:
+                        f.write(probabilities.tobytes())
+                    items_file.write("".join(json.dumps(item) + "\n" for item in items))
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(items_file, fcntl.LOCK_UN)
+            return list(range(start, start + len(vectors)))
+
+    def search(self, queries, k=5):
+        """The k most similar stored vectors to each query, as (positions,
+        cosine similarities), both shaped (len(queries), k). Missing results
+        are -1 with similarity -inf."""
+        queries = normalize(queries)
+        with self._lock:
+            self._refresh()
+            self.searches += 1
+            if self._count == 0:
+                return (np.full((len(queries), k), -1, dtype=np.int64),
+                        np.full((len(queries), k), -np.inf, dtype=np.float32))
+            if self._count >= self.ivf_min_items:
+                self._update_index()
+                return self._search_ivf(queries, k)
+            return self._search_rows(queries, k, np.arange(self._count))
+
+    def items(self, positions):
+        with self._lock:
+            self._refresh()
+            return [dict(self._items[i], id=int(i)) for i in positions]
+
+    def probabilities(self, positions):
+        with self._lock:
+            self._refresh()
+            return np.asarray(self._probabilities[np.asarray(positions)], dtype=np.float32)
+
+    def stats(self):
+        with self._lock:
+            self._refresh()
+            return {
+                "items": self._count,
+                "dim": self.dim,
+                "index": "ivf" if self._centroids is not None else "brute-force",
+                "ivf_lists": 0 if self._centroids is None else len(self._centroids),
+                "searches": self.searches,
+                "disk_mb": round(self._count * ((self.dim or 0) + self.num_classes) * 2 / 1e6, 2),
+            }
+
+    def _refresh(self):
+        # Maps in whatever this or another process has appended since
+        if self.dim is None:
+            self._read_config()
+        if self.dim is None or not os.path.exists(self._vectors_path):
+            return
+        count = min(os.path.getsize(self._vectors_path) // (self.dim * 2),
+                    os.path.getsize(self._probabilities_path) // (self.num_classes * 2))
+        if count == self._count:
+            return
+
+        with open(self._items_path) as f:
+            f.seek(self._items_offset)
+            while len(self._items) < count:
+                line = f.readline()
+                if not line.endswith("\n"):
+                    # Still being written
+                    break
+                self._items.append(json.loads(line))
+                self._items_offset = f.tell()
+        count = min(count, len(self._items))
+        if count == 0:
+            return
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float16, mode="r", shape=(count, self.dim))
+        self._probabilities = np.memmap(self._probabilities_path, dtype=np.float16, mode="r",
+                                        shape=(count, self.num_classes))
+        self._count = count
+
+    def _read_config(self):
+        if os.path.exists(self._config_path):
+            with open(self._config_path) as f:
+                self.dim = json.load(f)["dim"]
+
+    def _search_rows(self, queries, k, rows):
+        # Exact search over the given rows, a chunk at a time
+        best_rows = np.full((len(queries), 0), -1, dtype=np.int64)
+        best_sims = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        for start in range(0, len(rows), self.CHUNK_ROWS):
+            chunk = rows[start:start + self.CHUNK_ROWS]
+            sims = queries @ np.asarray(self._vectors[chunk], dtype=np.float32).T
+            best_rows = np.hstack([best_rows, np.broadcast_to(chunk, sims.shape)])
+            best_sims = np.hstack([best_sims, sims])
+            if best_sims.shape[1] > k:
+                top = np.argpartition(-best_sims, k - 1, axis=1)[:, :k]
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+                best_sims = np.take_along_axis(best_sims, top, axis=1)
+
+        order = np.argsort(-best_sims, axis=1, kind="stable")
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_sims = np.take_along_axis(best_sims, order, axis=1)
+        if best_rows.shape[1] < k:
+            missing = k - best_rows.shape[1]
+            best_rows = np.hstack([best_rows, np.full((len(queries), missing), -1, dtype=np.int64)])
+            best_sims = np.hstack([best_sims, np.full((len(queries), missing), -np.inf, dtype=np.float32)])
+        return best_rows, best_sims
+
+    def _update_index(self):
+        if self._centroids is None or self._count >= 4 * self._trained_count:
+            self._train()
+        elif self._assigned < self._count:
+            self._assign(self._assigned, self._count)
+
+    def _train(self, iterations=10, seed=0):
+        # Spherical k-means on a sample of the stored vectors
+        nlist = max(1, int(4 * np.sqrt(self._count)))
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(self._vectors[np.sort(rng.choice(self._count, min(self._count, 64 * nlist), replace=False))],
+                            dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=nlist) == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize(sums)
+
+        self._centroids = centroids
+        self._trained_count = self._count
+        self._lists = [[] for _ in range(nlist)]
+        self._assigned = 0
+        self._assign(0, self._count)
+
+    def _assign(self, start, stop):
+        for chunk_start in range(start, stop, self.CHUNK_ROWS):
+            chunk_stop = min(chunk_start + self.CHUNK_ROWS, stop)
+            labels = np.argmax(np.asarray(self._vectors[chunk_start:chunk_stop], dtype=np.float32) @ self._centroids.T, axis=1)
+            order = np.argsort(labels, kind="stable")
+            bounds = np.searchsorted(labels[order], np.arange(len(self._centroids) + 1))
+            for c in np.flatnonzero(np.diff(bounds)):
+                self._lists[c].append(chunk_start + order[bounds[c]:bounds[c + 1]])
+        self._assigned = stop
+
+    def _search_ivf(self, queries, k):
+        nprobe = min(self.nprobe, len(self._centroids))
+        probes = np.argpartition(-(queries @ self._centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        rows_out, sims_out = [], []
+        for query, lists in zip(queries, probes):
+            chunks = [chunk for c in lists for chunk in self._lists[c]]
+            rows = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+            found_rows, found_sims = self._search_rows(query[None], k, rows)
+            rows_out.append(found_rows[0])
+            sims_out.append(found_sims[0])
+        return np.array(rows_out), np.array(sims_out)
+
+
+class EmbeddingPipeline:
+    """Model predictions that also return each image's embedding, for the
+    inference engine.
+
+    Every batch goes through the backbone once. Images whose embedding
+    matches a stored one with cosine similarity of at least
+    `dedupe_threshold` reuse that image's probabilities; only the rest go
+    through the classification head. Each output row holds the
+    probabilities, the unit-length embedding and a duplicate flag; `split`
+    takes them apart again.
+    """
+
+    def __init__(self, runtime, store, dedupe_threshold=0.98):
+        self.runtime = runtime
+        self.store = store
+        self.dedupe_threshold = float(dedupe_threshold)
+        self._extractor = None
+        self._lock = threading.Lock()
+        self.deduplicated = 0
+
+    @property
+    def extractor(self):
+        if self._extractor is None:
+            with self._lock:
+                if self._extractor is None:
+                    self._extractor = FeatureExtractor.from_runtime(self.runtime.load())
+        return self._extractor
+
+    def predict(self, batch):
+        raw = self.extractor.embed(batch)
+        embeddings = normalize(raw)
+        probabilities = np.empty((len(raw), self.store.num_classes), dtype=np.float32)
+
+        duplicate = np.zeros(len(raw), dtype=bool)
+        if self.dedupe_threshold <= 1.0 and len(self.store):
+            positions, similarities = self.store.search(embeddings, 1)
+            duplicate = similarities[:, 0] >= self.dedupe_threshold
+            if duplicate.any():
+                probabilities[duplicate] = self.store.probabilities(positions[duplicate, 0])
+                self.deduplicated += int(duplicate.sum())
+        if not duplicate.all():
+            probabilities[~duplicate] = self.extractor.classify(raw[~duplicate])
+
+        return np.hstack([probabilities, embeddings, duplicate[:, None].astype(np.float32)])
+
+    def split(self, rows):
+        """(probabilities, embeddings, duplicate flags) of one row or a batch of rows."""
+        rows = np.asarray(rows)
+        classes = self.store.num_classes
+        return rows[..., :classes], rows[..., classes:-1], rows[..., -1] > 0.5
+
+    def stats(self):
+        return dict(self.store.stats(), deduplicated=self.deduplicated, dedupe_threshold=self.dedupe_threshold)
@@ -0,0 +1,91 @@
+"""Converts the Keras model into exports for the faster model runtimes.
+
+Examples:
+
+    python export_model.py --format tflite --quantize float16
+    python export_model.py --format tflite --quantize int8 --calibration-dir static
+    python export_model.py --format onnx
+"""
+import argparse
+import os
+
+import numpy as np
+
+from imaging import decode_image
+from model_runtime import DEFAULT_MODEL_PATH, INPUT_SHAPE
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def calibration_images(directory, limit=200):
+    """Yields preprocessed images used to calibrate int8 quantization."""
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+    for name in names[:limit]:
+        with open(os.path.join(directory, name), "rb") as f:
+            yield decode_image(f.read(), out=np.empty(INPUT_SHAPE, dtype=np.float32))
+
+
+def export_tflite(keras_model, output, quantize="none", calibration_dir="tests"):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if quantize == "dynamic":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantize == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == "int8":
+        images = list(calibration_images(calibration_dir))
+        if not images:
+            raise ValueError(f"No calibration images found in '{calibration_dir}'")
+
+        def representative_dataset():
+            for img_array in images:
+                yield [img_array[np.newaxis]]
+
+        # Full integer kernels; inputs and outputs stay float32 so callers
+        # do not need to know how the model was quantized
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    with open(output, "wb") as f:
+        f.write(converter.convert())
+
+
+def export_onnx(keras_model, output):
+    import tensorflow as tf
+    import tf2onnx
+
+    signature = (tf.TensorSpec((None,) + INPUT_SHAPE, tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(keras_model, input_signature=signature, output_path=output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Keras .h5 model to convert")
+    parser.add_argument("--format", choices=("tflite", "onnx"), default="tflite")
+    parser.add_argument("--quantize", choices=("none", "dynamic", "float16", "int8"), default="none",
+                        help="TFLite only")
+    parser.add_argument("--calibration-dir", default="tests",
+                        help="Images used to calibrate int8 quantization")
+    parser.add_argument("--output", help="Defaults to the model name with the new extension")
+    args = parser.parse_args()
+
+    from keras.models import load_model
+
+    keras_model = load_model(args.model)
+    output = args.output or os.path.splitext(args.model)[0] + "." + args.format
+
+    if args.format == "tflite":
+        export_tflite(keras_model, output, args.quantize, args.calibration_dir)
+    else:
+        if args.quantize != "none":
+            parser.error("--quantize is only supported for TFLite exports")
+        export_onnx(keras_model, output)
+
+    print(f"Wrote {output} ({os.path.getsize(output) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
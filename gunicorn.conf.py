@@ -0,0 +1,51 @@
+# Production server settings: `gunicorn -c gunicorn.conf.py`
+#
+# The app is imported once in the master process (preload_app). With the
+# tflite and onnx backends the model is loaded there too, and forked workers
+# share its weights copy-on-write instead of each loading their own copy.
+# TensorFlow does not support forking once its runtime has started, so the
+# keras and tf-function models are loaded by each worker after the fork.
+import gc
+import os
+
+preload_model_in_master = os.getenv("MODEL_BACKEND", "keras") in ("tflite", "onnx")
+
+# preload_model=None leaves it to the PRELOAD_MODEL setting
+wsgi_app = f"app:create_app(preload_model={None if preload_model_in_master else False}, warm_up=False)"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far into the permanent generation so the
+    # garbage collector in the workers never touches (and copies) those pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    from diagnostics import memory_stats
+
+    # Warm up after the fork so graph tracing does not start threads in the
+    # master; TensorFlow models are only loaded now, in the worker
+    if app.inference_enabled and app.inference_mode != "pool":
+        if app.model.loaded:
+            app.model.warm_up()
+        elif os.getenv("PRELOAD_MODEL", "true").lower() in ("1", "true", "yes"):
+            app.model.load()
+    # Each web worker gets its own inference pool
+    if app.inference_enabled and app.inference_mode == "pool":
+        app.inference.start()
+    server.log.info("Worker %s ready: %s", worker.pid, memory_stats())
+
+
+def worker_exit(server, worker):
+    import app
+
+    # Write out prediction history that is still queued
+    app.history_writer.close()
+    # Stop this worker's inference processes and free their shared memory
+    if app.inference_mode == "pool":
+        app.inference.close()
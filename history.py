@@ -0,0 +1,275 @@
+import base64
+import logging
+import os
+import queue
+import threading
+import time
+
+from bson import ObjectId
+
+import metrics
+from streaming import project
+
+RECORD_FIELDS = ("snake", "accuracy", "timestamp")
+
+logger = logging.getLogger(__name__)
+
+
+def push_update(predictions, limit):
+    """Update that appends prediction records to a user's history, keeping
+    only the newest `limit` so the user document stays bounded. Records
+    queued by concurrent requests can arrive out of order, so the history
+    is kept sorted by timestamp."""
+    return {"$push": {"recent_predictions": {"$each": predictions, "$sort": {"timestamp": 1}, "$slice": -limit}}}
+
+
+def encode_cursor(timestamp, skip):
+    """Opaque cursor pointing after the `skip`-th record stamped `timestamp`."""
+    return base64.urlsafe_b64encode(f"{timestamp}|{skip}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Returns (timestamp, skip); raises ValueError for a malformed cursor."""
+    try:
+        timestamp, skip = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        return timestamp, int(skip)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def records_pipeline(user_id, limit, cursor=None, fields=None):
+    """Aggregation returning one page of a user's history, newest first, as
+    one result document per record so a cursor can stream them in batches.
+    Nothing else from the user document (in particular not the password) is
+    returned, and only `fields` of each record (plus the timestamp, which
+    the next cursor needs).
+
+    The page holds up to `limit` + 1 records so the caller can tell whether
+    another page follows. An empty page and an unknown user both yield
+    nothing.
+    """
+    pipeline = [
+        {"$match": {"_id": ObjectId(user_id)}},
+        {"$unwind": {"path": "$recent_predictions", "includeArrayIndex": "position"}},
+        {"$project": {"_id": 0, "record": "$recent_predictions", "position": 1}},
+    ]
+    skip = 0
+    if cursor is not None:
+        # Everything stamped at or before the cursor's timestamp starts with
+        # the `skip` records already returned
+        timestamp, skip = decode_cursor(cursor)
+        pipeline.append({"$match": {"record.timestamp": {"$lte": timestamp}}})
+
+    # Sorted here rather than relying on the stored order; records sharing a
+    # timestamp stay in the order they were written
+    pipeline.append({"$sort": {"record.timestamp": -1, "position": -1}})
+    if skip:
+        pipeline.append({"$skip": skip})
+    pipeline += [
+        {"$limit": limit + 1},
+        {"$replaceRoot": {"newRoot": "$record"}},
+    ]
+    if fields is not None:
+        pipeline.append({"$project": {field: 1 for field in set(fields) | {"timestamp"}}})
+    return pipeline
+
+
+class PageStream:
+    """Turns the results of records_pipeline into the records to send,
+    remembering what the page's next cursor depends on."""
+
+    def __init__(self, limit, cursor=None, fields=None):
+        self.limit = limit
+        self.cursor = cursor
+        self.fields = fields
+        self.page = []
+
+    def accept(self, record):
+        """The record as it should be sent, or None if it is not part of the page."""
+        if "timestamp" not in record:
+            return None
+        self.page.append(record)
+        if len(self.page) > self.limit:
+            # The extra record only shows that another page follows
+            return None
+        return project(record, self.fields)
+
+    def next_cursor(self):
+        return next_cursor(self.page, self.limit, self.cursor)
+
+
+def next_cursor(page, limit, cursor=None):
+    """Cursor for the page after `page` (records newest first, as
+    records_pipeline returns them), or None if it was the last one."""
+    if len(page) <= limit:
+        return None
+    timestamp = page[limit - 1]["timestamp"]
+    skip = sum(1 for prediction in page[:limit] if prediction["timestamp"] == timestamp)
+    if cursor is not None:
+        previous_timestamp, previous_skip = decode_cursor(cursor)
+        if previous_timestamp == timestamp:
+            # The whole page shared the timestamp the previous cursor stopped at
+            skip += previous_skip
+    return encode_cursor(timestamp, skip)
+
+
+class HistoryWriter:
+    """Writes prediction history in the background.
+
+    `enqueue` returns immediately; a writer thread groups queued records by
+    user into one `bulk_write` of `$push`/`$each` updates, flushing when
+    `batch_size` records are waiting or `flush_interval` seconds after the
+    first one arrived. Once `max_queue` records are waiting, new records are
+    dropped and counted rather than slowing down the request.
+    """
+
+    def __init__(self, collection, limit=100, batch_size=100, flush_interval=0.5, max_queue=10000):
+        self.collection = collection
+        self.limit = limit
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.max_queue = int(max_queue)
+        self._reset()
+
+        # The writer thread is started on first use and again in forked children
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}
+        # Records enqueued but not yet written; bounded by max_queue
+        self._queued = 0
+        self._thread = None
+
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.flushes = 0
+        self._flush_seconds = 0.0
+        self._last_flush_seconds = 0.0
+        self._max_flush_seconds = 0.0
+
+    def enqueue(self, user_id, predictions):
+        """Queues prediction records for a user. Returns False if they were dropped."""
+        self._start()
+        with self._lock:
+            if self._queued + len(predictions) > self.max_queue:
+                self.dropped += len(predictions)
+                return False
+            self._queue.put_nowait((user_id, predictions))
+            self._queued += len(predictions)
+            self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        return True
+
+    def has_pending(self, user_id):
+        with self._lock:
+            return user_id in self._pending
+
+    def flush(self, timeout=None):
+        """Writes everything queued so far and waits for it. Returns False on timeout."""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=10):
+        """Flushes the queue and stops the writer thread. A later `enqueue`
+        starts a new one."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queued,
+                "max_queue": self.max_queue,
+                "written": self.written,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "flushes": self.flushes,
+                "last_flush_ms": round(self._last_flush_seconds * 1000, 2),
+                "mean_flush_ms": round(self._flush_seconds * 1000 / self.flushes, 2) if self.flushes else 0.0,
+                "max_flush_ms": round(self._max_flush_seconds * 1000, 2),
+            }
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        batch, waiters = [], []
+        records = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            stop = item is None
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+            elif item:
+                batch.append(item)
+                records += len(item[1])
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch and (stop or waiters or item is False or records >= self.batch_size):
+                self._write(batch)
+                batch, records, deadline = [], 0, None
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+            if stop:
+                return
+
+    def _write(self, batch):
+        from pymongo import UpdateOne
+
+        # One update per user, keeping each user's records in arrival order
+        by_user = {}
+        for user_id, predictions in batch:
+            by_user.setdefault(user_id, []).extend(predictions)
+        count = sum(len(predictions) for predictions in by_user.values())
+
+        start = time.perf_counter()
+        try:
+            operations = [
+                UpdateOne({"_id": ObjectId(user_id)}, push_update(predictions, self.limit))
+                for user_id, predictions in by_user.items()
+            ]
+            self.collection.bulk_write(operations, ordered=False)
+            failed = False
+        except Exception as e:
+            logger.error("Error writing prediction history: %s", e)
+            failed = True
+        elapsed = time.perf_counter() - start
+        metrics.STAGE_SECONDS.observe(elapsed, "mongo_write")
+
+        with self._lock:
+            for user_id, _ in batch:
+                self._pending[user_id] -= 1
+                if not self._pending[user_id]:
+                    del self._pending[user_id]
+            self._queued -= count
+            self.flushes += 1
+            self._flush_seconds += elapsed
+            self._last_flush_seconds = elapsed
+            self._max_flush_seconds = max(self._max_flush_seconds, elapsed)
+            if failed:
+                self.errors += 1
+                self.dropped += count
+            else:
+                self.written += count
@@ -0,0 +1,87 @@
+import io
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from uploads import UploadRejected, check_image
+
+TARGET_SIZE = (224, 224)
+
+_buffers = threading.local()
+
+
+def get_buffer():
+    """Returns this thread's reusable (224, 224, 3) float32 input buffer."""
+    buf = getattr(_buffers, "array", None)
+    if buf is None:
+        buf = _buffers.array = np.empty(TARGET_SIZE + (3,), dtype=np.float32)
+    return buf
+
+
+def read_pixels(data):
+    """Decodes uploaded image bytes into a (224, 224) RGB PIL image.
+
+    Only JPEG, PNG and WebP images of at most Image.MAX_IMAGE_PIXELS are
+    decoded; anything else raises UploadRejected. JPEGs are opened in draft
+    mode so libjpeg scales them down by a power of two while decoding, which
+    keeps a 12 MP photo to well under a megapixel in memory and is much
+    cheaper than decoding the full photo and resizing afterwards.
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.UnidentifiedImageError:
+        raise UploadRejected("The upload is not a readable image", 415)
+    except Image.DecompressionBombError as e:
+        raise UploadRejected(str(e), 413)
+    check_image(img, Image.MAX_IMAGE_PIXELS)
+    img.draft("RGB", TARGET_SIZE)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if img.size != TARGET_SIZE:
+        # Nearest neighbour matches keras' image.load_img default
+        img = img.resize(TARGET_SIZE, Image.NEAREST)
+    return img
+
+
+def decode_image(data, out=None):
+    """Decodes uploaded image bytes into a preprocessed MobileNet input,
+    written into `out` (or this thread's reusable buffer) and returned."""
+    return preprocess(read_pixels(data), out)
+
+
+def preprocess(img, out=None):
+    """Scales the pixels of a read_pixels() image into a MobileNet input."""
+    # Imported here so that loading this module does not pull in TensorFlow
+    from keras.applications.mobilenet import preprocess_input
+
+    if out is None:
+        out = get_buffer()
+    out[...] = np.asarray(img, dtype=np.uint8)
+    return preprocess_input(out)
+
+
+class UploadArchiver:
+    """Saves raw uploads to disk in the background, off the request path."""
+
+    def __init__(self, directory="static", max_workers=1):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload-archiver")
+
+    def archive(self, data):
+        """Schedules `data` to be written and returns the filename it will get."""
+        filename = str(uuid.uuid4()) + ".jpg"
+        self._executor.submit(self._write, os.path.join(self.directory, filename), data)
+        return filename
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _write(path, data):
+        with open(path, "wb") as f:
+            f.write(data)
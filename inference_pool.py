@@ -0,0 +1,320 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from batching import InferenceBusy
+from model_runtime import INPUT_SHAPE, class_list, load_runtime, warm_up, default_runtime_path
+
+logger = logging.getLogger(__name__)
+
+
+class InferencePool:
+    """Runs the model in a pool of dedicated worker processes.
+
+    Requests write their preprocessed tensor into a slot of a shared-memory
+    input block and hand the slot number to the workers, so images are never
+    pickled. Each worker drains up to `max_batch_size` queued slots into one
+    forward pass and writes the probabilities into a shared output block.
+
+    There are `max_queue` slots. When they are all taken, `submit` raises
+    InferenceBusy instead of queueing more work.
+
+    Workers note which slots they are running in a shared owner block. A
+    worker that dies (killed, or out of memory) is replaced, and the
+    requests in its slots fail instead of holding their slots forever.
+    A worker can die after taking a slot but before marking it, so a slot
+    still in flight after `max_in_flight` seconds is failed and freed too.
+    Every hand-over carries a ticket, and a late result for a slot that has
+    since been reclaimed is dropped.
+
+    With `local=True` the workers are threads of this process running
+    `runtime_factory()`, and the blocks are ordinary arrays. That stand-in
+    exercises the same slot, batching and backpressure logic in tests.
+    """
+
+    # Seconds between checks that every worker is still alive
+    health_interval = 1.0
+
+    def __init__(self, backend="keras", path=None, num_workers=2, cores_per_worker=None,
+                 intra_op_threads=1, max_queue=64, max_batch_size=8, max_in_flight=120.0, local=False,
+                 runtime_factory=None):
+        self.backend = backend
+        self.path = path or default_runtime_path(backend)
+        self.num_workers = max(1, int(num_workers))
+        self.cores_per_worker = cores_per_worker
+        self.intra_op_threads = intra_op_threads
+        self.max_queue = max(1, int(max_queue))
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_in_flight = max_in_flight
+        self.local = local
+        self.runtime_factory = runtime_factory
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._rejected = 0
+        self._completed = 0
+        self._restarted = 0
+        self._reclaimed = 0
+        self._next_ticket = 0
+
+    def start(self):
+        """Starts the workers. Called automatically by the first `submit`; a
+        pool inherited through fork is restarted in the child."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+            input_shape = (self.max_queue,) + INPUT_SHAPE
+            output_shape = (self.max_queue, len(class_list))
+            self._free = list(range(self.max_queue))
+            self._futures = {}
+            # slot -> (ticket, submit time) of the request it was handed over for
+            self._claims = {}
+
+            if self.local:
+                self._shm = []
+                self._inputs = np.zeros(input_shape, dtype=np.float32)
+                self._outputs = np.zeros(output_shape, dtype=np.float32)
+                self._owners = np.zeros(self.max_queue, dtype=np.int32)
+                self._tasks = queue.Queue()
+                self._results = queue.Queue()
+            else:
+                # Spawned rather than forked, so each worker starts TensorFlow cleanly
+                self._ctx = multiprocessing.get_context("spawn")
+                self._shm = [
+                    shared_memory.SharedMemory(create=True, size=int(np.prod(input_shape)) * 4),
+                    shared_memory.SharedMemory(create=True, size=int(np.prod(output_shape)) * 4),
+                    shared_memory.SharedMemory(create=True, size=self.max_queue * 4),
+                ]
+                self._inputs = np.ndarray(input_shape, dtype=np.float32, buffer=self._shm[0].buf)
+                self._outputs = np.ndarray(output_shape, dtype=np.float32, buffer=self._shm[1].buf)
+                self._owners = np.ndarray((self.max_queue,), dtype=np.int32, buffer=self._shm[2].buf)
+                self._owners[:] = 0
+                self._tasks = self._ctx.Queue()
+                self._results = self._ctx.Queue()
+                # The shared memory outlives the process unless it is unlinked
+                atexit.register(self.close)
+
+            self._workers = [self._start_worker(i) for i in range(self.num_workers)]
+            self._dispatcher = threading.Thread(target=self._dispatch, name="inference-dispatcher", daemon=True)
+            self._dispatcher.start()
+
+    def _start_worker(self, index):
+        # Worker `index` marks the slots it runs with index + 1 in the owner block
+        if self.local:
+            worker = threading.Thread(target=_serve, args=(self.runtime_factory(), self._inputs, self._outputs,
+                                                           self._tasks, self._results, self.max_batch_size,
+                                                           self._owners, index + 1),
+                                      name=f"inference-{index}", daemon=True)
+        else:
+            worker = self._ctx.Process(target=_worker_main,
+                                       args=(self.backend, self.path, self._worker_cores(index), self.intra_op_threads,
+                                             [shm.name for shm in self._shm], self._inputs.shape, self._outputs.shape,
+                                             self._tasks, self._results, self.max_batch_size, index + 1),
+                                       name=f"inference-{index}", daemon=True)
+        worker.start()
+        return worker
+
+    def submit(self, img_array):
+        """Queue one preprocessed (224, 224, 3) image and return a Future that
+        resolves to its row of class probabilities."""
+        return self._submit([img_array])[0]
+
+    def predict(self, img_array, timeout=None):
+        return self.submit(img_array).result(timeout)
+
+    def predict_many(self, batch, timeout=None):
+        """Classifies a whole batch; the workers pick it up as one or more
+        forward passes. A batch larger than max_queue is sent in parts, each
+        once the one before has finished."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        rows = []
+        for start in range(0, len(batch), self.max_queue):
+            for future in self._submit(batch[start:start + self.max_queue]):
+                rows.append(future.result(None if deadline is None else max(0.0, deadline - time.monotonic())))
+        return np.stack(rows)
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        self._pid = None
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        self._dispatcher.join()
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._futures) if self._pid == os.getpid() else 0
+            return {
+                "mode": "local" if self.local else "processes",
+                "workers": self.num_workers,
+                "max_batch_size": self.max_batch_size,
+                "max_queue": self.max_queue,
+                "queue_depth": in_flight,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "restarted_workers": self._restarted,
+                "reclaimed_slots": self._reclaimed,
+            }
+
+    def _submit(self, images):
+        self.start()
+        with self._lock:
+            if len(self._free) < len(images):
+                self._rejected += len(images)
+                raise InferenceBusy(f"Inference queue is full ({self.max_queue} images in flight)")
+            slots = [self._free.pop() for _ in images]
+            tasks = []
+            futures = []
+            now = time.monotonic()
+            for slot, img_array in zip(slots, images):
+                self._inputs[slot] = img_array
+                self._next_ticket += 1
+                self._claims[slot] = (self._next_ticket, now)
+                tasks.append((slot, self._next_ticket))
+                futures.append(Future())
+                # Running from the start, so a caller that gives up cannot
+                # cancel it and the dispatcher can always complete it
+                futures[-1].set_running_or_notify_cancel()
+                self._futures[slot] = futures[-1]
+        for task in tasks:
+            self._tasks.put(task)
+        return futures
+
+    def _dispatch(self):
+        next_check = time.monotonic() + self.health_interval
+        while True:
+            try:
+                message = self._results.get(timeout=self.health_interval)
+            except queue.Empty:
+                message = ()
+            if message is None:
+                return
+            if message:
+                slots, tickets, error = message
+                with self._lock:
+                    self._finish(slots, RuntimeError(error) if error is not None else None, tickets)
+            if time.monotonic() >= next_check:
+                self._replace_dead_workers()
+                self._reclaim_stale_slots()
+                next_check = time.monotonic() + self.health_interval
+
+    def _finish(self, slots, error=None, tickets=None):
+        # Completes the futures of `slots` and frees them; called with the lock
+        # held. With `tickets`, slots handed over again since are skipped.
+        for i, slot in enumerate(slots):
+            if tickets is not None and self._claims.get(slot, (None,))[0] != tickets[i]:
+                continue
+            future = self._futures.pop(slot, None)
+            if future is None:
+                continue
+            del self._claims[slot]
+            if error is None:
+                future.set_result(self._outputs[slot].copy())
+            else:
+                future.set_exception(error)
+            self._owners[slot] = 0
+            self._free.append(slot)
+            self._completed += 1
+
+    def _replace_dead_workers(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            for index, worker in enumerate(self._workers):
+                if worker.is_alive():
+                    continue
+                exitcode = getattr(worker, "exitcode", None)
+                logger.error("Inference worker %s exited (%s); restarting it", index, exitcode)
+                lost = [slot for slot in self._futures if self._owners[slot] == index + 1]
+                self._finish(lost, RuntimeError(f"Inference worker exited with code {exitcode}"))
+                self._workers[index] = self._start_worker(index)
+                self._restarted += 1
+
+    def _reclaim_stale_slots(self):
+        if not self.max_in_flight:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            cutoff = time.monotonic() - self.max_in_flight
+            stale = [slot for slot, (_, submitted) in self._claims.items() if submitted < cutoff]
+            if stale:
+                logger.error("Reclaiming %s inference slots in flight for over %s s", len(stale), self.max_in_flight)
+                self._finish(stale, FutureTimeoutError(f"Inference did not answer within {self.max_in_flight} s"))
+                self._reclaimed += len(stale)
+
+    def _worker_cores(self, index):
+        if not self.cores_per_worker or not hasattr(os, "sched_setaffinity"):
+            return None
+        cpu_count = os.cpu_count() or 1
+        start = index * self.cores_per_worker
+        return sorted({(start + i) % cpu_count for i in range(self.cores_per_worker)})
+
+
+def _serve(runtime, inputs, outputs, tasks, results, max_batch_size, owners, owner):
+    # Worker loop: batch whatever is queued, up to max_batch_size slots. Each
+    # task is a (slot, ticket) pair and the tickets go back with the results.
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        # Marked as soon as taken, so the pool knows what to fail if this worker dies
+        owners[task[0]] = owner
+        slots, tickets = [task[0]], [task[1]]
+        stop = False
+        while len(slots) < max_batch_size:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                stop = True
+                break
+            owners[task[0]] = owner
+            slots.append(task[0])
+            tickets.append(task[1])
+
+        try:
+            outputs[slots] = runtime.predict(inputs[slots])
+            results.put((slots, tickets, None))
+        except Exception as e:
+            results.put((slots, tickets, str(e)))
+        if stop:
+            return
+
+
+def _worker_main(backend, path, cores, intra_op_threads, shm_names, input_shape, output_shape,
+                 tasks, results, max_batch_size, owner):
+    if cores:
+        os.sched_setaffinity(0, cores)
+    if intra_op_threads:
+        # Must be set before TensorFlow starts its thread pools
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(intra_op_threads)
+        os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+        os.environ["OMP_NUM_THREADS"] = str(intra_op_threads)
+
+    input_shm, output_shm, owner_shm = [shared_memory.SharedMemory(name=name) for name in shm_names]
+    inputs = np.ndarray(input_shape, dtype=np.float32, buffer=input_shm.buf)
+    outputs = np.ndarray(output_shape, dtype=np.float32, buffer=output_shm.buf)
+    owners = np.ndarray((input_shape[0],), dtype=np.int32, buffer=owner_shm.buf)
+
+    kwargs = {"num_threads": intra_op_threads} if backend in ("tflite", "onnx") else {}
+    runtime = load_runtime(backend, path, **kwargs)
+    warm_up(runtime, (1, max_batch_size))
+    _serve(runtime, inputs, outputs, tasks, results, max_batch_size, owners, owner)
@@ -0,0 +1,53 @@
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s [%(process)d]: %(message)s"
+
+_listener = None
+# Whether _listener's writer thread is running in this process
+_running = False
+
+
+def configure_logging(level="INFO", stream=None):
+    """Sends log records through a queue to a background thread that writes
+    them out, so logging never blocks a request on stdout or stderr.
+
+    Safe to call more than once; later calls only change the level. The
+    writer thread is restarted in forked children.
+    """
+    global _listener, _running
+    root = logging.getLogger()
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    if _listener is not None:
+        return
+
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    _listener = QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    _running = True
+    root.addHandler(QueueHandler(records))
+    atexit.register(_stop)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_restart)
+
+
+def _restart():
+    # Only the forking thread survives a fork; a new listener on the same
+    # queue and handlers starts a new writer
+    global _listener, _running
+    _listener = QueueListener(_listener.queue, *_listener.handlers,
+                              respect_handler_level=_listener.respect_handler_level)
+    _listener.start()
+    _running = True
+
+
+def _stop():
+    global _running
+    if _listener is not None and _running:
+        _running = False
+        _listener.stop()
@@ -0,0 +1,288 @@
+"""In-process metrics in the Prometheus text format, served on /metrics.
+
+Histograms time each stage of a prediction request, HTTP requests and
+MongoDB commands; gauges are read from the inference engine and history
+writer when the metrics are scraped. Every worker process keeps its own
+numbers, so with several gunicorn or uvicorn workers each scrape sees
+one of them.
+"""
+import bisect
+import contextlib
+import contextvars
+import math
+import os
+import threading
+import time
+
+from pymongo import monitoring
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from half a millisecond to ten seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, one series per label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        # label values -> [count per bucket (+Inf last), sum]
+        self._series = {}
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *labelvalues):
+        """Context manager observing the seconds its block takes."""
+        return _Timer(self, labelvalues)
+
+    def count(self, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            return sum(series[0]) if series else 0
+
+    def render(self):
+        with self._lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+        lines = []
+        for labelvalues, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A value read when the metrics are rendered. `fn` returns a number,
+    or a dict of label values -> number when the gauge has labels; None
+    leaves a series out."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def reset(self):
+        pass
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        values = value if isinstance(value, dict) else {(): value}
+        return [
+            f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}"
+            for labelvalues, value in sorted(values.items()) if value is not None
+        ]
+
+
+class _Timer:
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, *self.labelvalues)
+
+
+class Registry:
+    """The metrics of this process. Counts inherited through fork are cleared
+    in the child, so a preloading master's warm-up is not reported by every
+    worker."""
+
+    def __init__(self):
+        self._metrics = {}
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.reset)
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, fn, labelnames=()):
+        return self.register(Gauge(name, help, fn, labelnames))
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "snake_stage_seconds", "Time spent in each stage of handling a request.", ("stage",))
+REQUEST_SECONDS = registry.histogram(
+    "snake_http_request_seconds", "HTTP request latency by route, method and status.", ("route", "method", "status"))
+MONGO_COMMAND_SECONDS = registry.histogram(
+    "snake_mongodb_command_seconds", "MongoDB command latency by command and collection.",
+    ("command", "collection", "outcome"))
+POOL_WAIT_SECONDS = registry.histogram(
+    "snake_mongodb_pool_wait_seconds", "Time spent waiting for a pooled MongoDB connection.", ("outcome",))
+BATCH_SIZE = registry.histogram(
+    "snake_inference_batch_size", "Images per model forward pass.", buckets=(1, 2, 4, 8, 16, 32, 64))
+
+# Stage timings of the request being handled, for its Server-Timing header
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def start_request_timings():
+    """Starts collecting the stage timings of the current request and returns
+    the dict they are added to."""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Times a block as one stage of the current request, in the stage
+    histogram and in the request's own timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def server_timing(timings):
+    """A Server-Timing header value for a request's stage timings."""
+    return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items())
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """PyMongo command listener recording each command's latency under its
+    collection. Pass it to MongoClient(event_listeners=[...])."""
+
+    def __init__(self, histogram=MONGO_COMMAND_SECONDS):
+        self.histogram = histogram
+        self._collections = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if not isinstance(target, str):
+            # getMore names its collection separately; admin commands have none
+            target = event.command.get("collection", "")
+        self._collections[(event.connection_id, event.request_id)] = target
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+    def _finish(self, event, outcome):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        self.histogram.observe(event.duration_micros / 1e6, event.command_name, collection, outcome)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """PyMongo pool listener recording how long each connection checkout
+    waited, and counting the connections in use. A saturated pool shows up
+    as long waits and "timeout" outcomes."""
+
+    def __init__(self, histogram=POOL_WAIT_SECONDS):
+        self.histogram = histogram
+        self.checked_out = 0
+        self._lock = threading.Lock()
+        self._started = threading.local()
+
+    def connection_check_out_started(self, event):
+        # Checkouts run on the thread that needs the connection
+        self._started.time = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self._finish("ok")
+        with self._lock:
+            self.checked_out += 1
+
+    def connection_check_out_failed(self, event):
+        self._finish(event.reason)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def _finish(self, outcome):
+        started = getattr(self._started, "time", None)
+        if started is not None:
+            self._started.time = None
+            self.histogram.observe(time.perf_counter() - started, outcome)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
@@ -0,0 +1,209 @@
+import os
+import logging
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Define your list of snake classes
+class_list = ["Cobra", "Common Krait", "Hump nosed pit viper", "Python", "Rat snake", "Russell's viper", "Saw Scaled Viper"]
+
+INPUT_SHAPE = (224, 224, 3)
+
+DEFAULT_MODEL_PATH = "mobilenet-ft.h5"
+
+
+class KerasRuntime:
+    """Plain Keras `model.predict`."""
+
+    name = "keras"
+
+    def __init__(self, path=DEFAULT_MODEL_PATH):
+        from keras.models import load_model
+
+        self.path = path
+        self.keras_model = load_model(path)
+
+    def predict(self, batch):
+        return self.keras_model.predict(batch, verbose=0)
+
+
+class TFFunctionRuntime:
+    """The Keras model wrapped in a `tf.function` with a fixed input signature.
+
+    The graph is traced once for any batch size, and each call skips the
+    per-call setup that `model.predict` does.
+    """
+
+    name = "tf-function"
+
+    def __init__(self, path=DEFAULT_MODEL_PATH):
+        import tensorflow as tf
+        from keras.models import load_model
+
+        self.path = path
+        self.keras_model = load_model(path)
+        keras_model = self.keras_model
+
+        @tf.function(input_signature=[tf.TensorSpec((None,) + INPUT_SHAPE, tf.float32)])
+        def forward(x):
+            return keras_model(x, training=False)
+
+        self._forward = forward
+        self._tf = tf
+
+    def predict(self, batch):
+        return self._forward(self._tf.convert_to_tensor(batch, dtype=self._tf.float32)).numpy()
+
+
+class TFLiteRuntime:
+    """A TFLite interpreter, for float32, float16 or int8 exports made by
+    export_model.py. Uses `tflite_runtime` when installed and falls back to
+    `tf.lite`."""
+
+    name = "tflite"
+
+    def __init__(self, path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self.path = path
+        self._interpreter = Interpreter(model_path=path, num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = int(self._input["shape"][0])
+        # The interpreter holds mutable tensor state, so calls are serialised
+        self._lock = threading.Lock()
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        with self._lock:
+            if len(batch) != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input["index"], (len(batch),) + INPUT_SHAPE)
+                self._interpreter.allocate_tensors()
+                self._input = self._interpreter.get_input_details()[0]
+                self._output = self._interpreter.get_output_details()[0]
+                self._batch_size = len(batch)
+
+            self._interpreter.set_tensor(self._input["index"], _quantize(batch, self._input))
+            self._interpreter.invoke()
+            return _dequantize(self._interpreter.get_tensor(self._output["index"]), self._output)
+
+
+class OnnxRuntime:
+    """An ONNX Runtime CPU session, for exports made by export_model.py."""
+
+    name = "onnx"
+
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self._session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self._input_name = self._session.get_inputs()[0].name
+
+    def predict(self, batch):
+        return self._session.run(None, {self._input_name: np.asarray(batch, dtype=np.float32)})[0]
+
+
+RUNTIMES = {
+    KerasRuntime.name: KerasRuntime,
+    TFFunctionRuntime.name: TFFunctionRuntime,
+    TFLiteRuntime.name: TFLiteRuntime,
+    OnnxRuntime.name: OnnxRuntime,
+}
+
+
+def load_runtime(backend="keras", path=DEFAULT_MODEL_PATH, **kwargs):
+    """Loads the model behind the named backend."""
+    try:
+        runtime_class = RUNTIMES[backend]
+    except KeyError:
+        raise ValueError(f"Unknown model backend '{backend}', choose one of {', '.join(RUNTIMES)}")
+    return runtime_class(path, **kwargs)
+
+
+class LazyRuntime:
+    """Loads the runtime on first use instead of at import time.
+
+    Call `load()` explicitly to load it up front, e.g. in a preloading
+    gunicorn master so forked workers share the weights copy-on-write.
+    """
+
+    def __init__(self, backend="keras", path=None, warmup_batch_sizes=None, **kwargs):
+        self.backend = backend
+        self.path = path or default_runtime_path(backend)
+        self.warmup_batch_sizes = warmup_batch_sizes
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self._kwargs = kwargs
+        self._runtime = None
+        self._lock = threading.RLock()
+
+    @property
+    def loaded(self):
+        return self._runtime is not None
+
+    def load(self, warmup=True):
+        if self._runtime is None:
+            with self._lock:
+                if self._runtime is None:
+                    start = time.perf_counter()
+                    runtime = load_runtime(self.backend, self.path, **self._kwargs)
+                    self.load_seconds = time.perf_counter() - start
+                    logger.info("Loaded %s model from %s in %.2fs", self.backend, self.path, self.load_seconds)
+                    self._runtime = runtime
+        if warmup:
+            self.warm_up()
+        return self._runtime
+
+    def warm_up(self):
+        if self.warmup_batch_sizes and self.warmup_seconds is None:
+            with self._lock:
+                if self.warmup_seconds is None:
+                    self.warmup_seconds = warm_up(self.load(warmup=False), self.warmup_batch_sizes)
+                    logger.info("Model warm-up (%s) took %.2fs", self.backend, self.warmup_seconds)
+
+    def predict(self, batch):
+        return self.load().predict(batch)
+
+
+def warm_up(runtime, batch_sizes=(1,)):
+    """Runs dummy batches through the runtime so graph tracing and memory
+    allocation happen before the first real request. Returns the seconds spent."""
+    start = time.perf_counter()
+    for batch_size in batch_sizes:
+        runtime.predict(np.zeros((batch_size,) + INPUT_SHAPE, dtype=np.float32))
+    return time.perf_counter() - start
+
+
+def default_runtime_path(backend):
+    """The model file a backend loads when MODEL_PATH is not set."""
+    if backend == TFLiteRuntime.name:
+        return os.path.splitext(DEFAULT_MODEL_PATH)[0] + ".tflite"
+    if backend == OnnxRuntime.name:
+        return os.path.splitext(DEFAULT_MODEL_PATH)[0] + ".onnx"
+    return DEFAULT_MODEL_PATH
+
+
+def _quantize(batch, details):
+    scale, zero_point = details.get("quantization", (0.0, 0))
+    if details["dtype"] == np.float32 or not scale:
+        return batch.astype(details["dtype"], copy=False)
+    info = np.iinfo(details["dtype"])
+    return np.clip(np.round(batch / scale + zero_point), info.min, info.max).astype(details["dtype"])
+
+
+def _dequantize(output, details):
+    scale, zero_point = details.get("quantization", (0.0, 0))
+    if output.dtype == np.float32 or not scale:
+        return output.astype(np.float32, copy=False)
+    return (output.astype(np.float32) - zero_point) * scale
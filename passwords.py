@@ -0,0 +1,135 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+
+class AuthBusy(Exception):
+    """Raised when too many password hashes are already queued; the caller should retry later."""
+
+
+def hash_rounds(hashed):
+    """The cost factor a bcrypt hash was made with, e.g. 12 for "$2b$12$..."."""
+    try:
+        return int(hashed.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Runs bcrypt on a small dedicated thread pool.
+
+    bcrypt releases the GIL, so hashing on `max_workers` threads uses at most
+    that many cores however many requests arrive, and the request threads
+    just wait. At most `max_pending` hashes may be running or queued; beyond
+    that `submit` raises AuthBusy so a burst of logins is shed instead of
+    queueing behind itself.
+    """
+
+    def __init__(self, rounds=12, max_workers=2, max_pending=16):
+        self.rounds = int(rounds)
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max(self.max_workers, int(max_pending))
+        self._reset()
+
+        # Pool threads do not survive a fork; children start their own
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.hashed = 0
+        self.checked = 0
+        self.rehashed = 0
+        self.rejected = 0
+
+    def submit(self, func, *args):
+        """Runs func(*args) on the pool and returns its Future."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise AuthBusy(f"Too many authentication requests ({self.max_pending} in progress)")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="bcrypt")
+            self._pending += 1
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def submit_hash(self, password):
+        return self.submit(self._hash, password)
+
+    def submit_check(self, hashed, password):
+        return self.submit(self._check, hashed, password)
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost, as a str."""
+        return self.submit_hash(password).result()
+
+    def check(self, hashed, password):
+        return self.submit_check(hashed, password).result()
+
+    def needs_rehash(self, hashed):
+        """True if `hashed` was made with a different cost factor than the configured one."""
+        return hash_rounds(hashed) != self.rounds
+
+    def rehash_in_background(self, password, on_done):
+        """Hashes `password` at the configured cost and passes the hash to
+        `on_done`. Best effort: skipped when the pool is busy."""
+
+        def finished(future):
+            if future.exception() is None:
+                with self._lock:
+                    self.rehashed += 1
+                try:
+                    on_done(future.result())
+                except Exception as e:
+                    logger.error("Error storing rehashed password: %s", e)
+
+        try:
+            self.submit_hash(password).add_done_callback(finished)
+        except AuthBusy:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rounds": self.rounds,
+                "workers": self.max_workers,
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "hashed": self.hashed,
+                "checked": self.checked,
+                "rehashed": self.rehashed,
+                "rejected": self.rejected,
+            }
+
+    def _hash(self, password):
+        hashed = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(self.rounds)).decode("utf-8")
+        with self._lock:
+            self.hashed += 1
+        return hashed
+
+    def _check(self, hashed, password):
+        try:
+            result = bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+        except ValueError:
+            # Not a bcrypt hash
+            result = False
+        with self._lock:
+            self.checked += 1
+        return result
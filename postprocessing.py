@@ -0,0 +1,125 @@
+import json
+
+import numpy as np
+
+# Smallest probability taken the log of, so a hard 0 does not become -inf
+_EPSILON = 1e-12
+
+
+def log_probabilities(probabilities):
+    """log(p) of softmax outputs, which equals the logits up to a per-row constant."""
+    return np.log(np.clip(np.asarray(probabilities, dtype=np.float64), _EPSILON, 1.0))
+
+
+def softmax(logits):
+    """Softmax over the last axis."""
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def apply_temperature(probabilities, temperature=1.0):
+    """Temperature-scales an (N, C) batch of softmax outputs.
+
+    Dividing log(p) by the temperature and applying softmax again is the
+    same as scaling the logits.
+    """
+    if temperature == 1.0:
+        return np.asarray(probabilities, dtype=np.float64)
+    return softmax(log_probabilities(probabilities) / temperature)
+
+
+def top_k(probabilities, k):
+    """Indices and values of the k most likely classes of each row, most likely first."""
+    probabilities = np.asarray(probabilities)
+    k = min(max(int(k), 1), probabilities.shape[1])
+    indices = np.argpartition(-probabilities, k - 1, axis=1)[:, :k]
+    values = np.take_along_axis(probabilities, indices, axis=1)
+    order = np.argsort(-values, axis=1, kind="stable")
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+def negative_log_likelihood(probabilities, labels):
+    probabilities = np.asarray(probabilities)
+    picked = probabilities[np.arange(len(labels)), np.asarray(labels)]
+    return float(-np.log(np.clip(picked, _EPSILON, 1.0)).mean())
+
+
+def expected_calibration_error(probabilities, labels, bins=10):
+    """Gap between confidence and accuracy, averaged over confidence bins."""
+    probabilities = np.asarray(probabilities)
+    confidence = probabilities.max(axis=1)
+    correct = probabilities.argmax(axis=1) == np.asarray(labels)
+    bin_ids = np.minimum((confidence * bins).astype(int), bins - 1)
+    counts = np.bincount(bin_ids, minlength=bins)
+    gaps = np.abs(np.bincount(bin_ids, confidence - correct, minlength=bins))
+    return float(gaps.sum() / max(counts.sum(), 1))
+
+
+def fit_temperature(probabilities, labels, low=0.05, high=20.0, steps=200):
+    """The temperature minimising the negative log-likelihood of held-out
+    labels, searched on a log-spaced grid and refined by golden-section search."""
+    grid = np.geomspace(low, high, steps)
+    losses = [negative_log_likelihood(apply_temperature(probabilities, t), labels) for t in grid]
+    best = int(np.argmin(losses))
+    a, b = grid[max(best - 1, 0)], grid[min(best + 1, steps - 1)]
+
+    ratio = (np.sqrt(5) - 1) / 2
+    for _ in range(40):
+        c, d = b - ratio * (b - a), a + ratio * (b - a)
+        if negative_log_likelihood(apply_temperature(probabilities, c), labels) < \
+                negative_log_likelihood(apply_temperature(probabilities, d), labels):
+            b = d
+        else:
+            a = c
+    return float((a + b) / 2)
+
+
+def load_calibration(path):
+    """Reads the {"temperature": ...} file written by calibrate.py."""
+    with open(path) as f:
+        return json.load(f)
+
+
+class PostProcessor:
+    """Turns batches of model probabilities into API results.
+
+    Probabilities are temperature-scaled and ranked for the whole batch at
+    once. A result is flagged uncertain when its top class is less likely
+    than `uncertain_threshold`.
+    """
+
+    def __init__(self, class_names, temperature=1.0, uncertain_threshold=0.0):
+        self.class_names = list(class_names)
+        self.temperature = float(temperature)
+        self.uncertain_threshold = float(uncertain_threshold)
+
+    def __call__(self, probabilities, k=1, lookup=None):
+        """One result per row of `probabilities`: the top class as "snake" and
+        "accuracy" (a percentage), "uncertain", and the k most likely classes
+        as "top_k", each with its entry from `lookup` (class name -> catalog
+        document) as "details" when a lookup is given."""
+        probabilities = np.asarray(probabilities)
+        if len(probabilities) == 0:
+            return []
+        calibrated = apply_temperature(probabilities, self.temperature)
+        indices, values = top_k(calibrated, k)
+        uncertain = values[:, 0] < self.uncertain_threshold
+        accuracy = np.round(values[:, 0] * 100, 2)
+        rounded = np.round(values, 4)
+
+        results = []
+        for row in range(len(calibrated)):
+            ranked = []
+            for index, probability in zip(indices[row], rounded[row]):
+                name = self.class_names[index]
+                entry = {"snake": name, "probability": float(probability)}
+                if lookup is not None:
+                    entry["details"] = lookup.get(name)
+                ranked.append(entry)
+            results.append({
+                "snake": ranked[0]["snake"],
+                "accuracy": float(accuracy[row]),
+                "uncertain": bool(uncertain[row]),
+                "top_k": ranked,
+            })
+        return results
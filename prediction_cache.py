@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def key_for_bytes(data):
+    """Cache key for the raw uploaded file."""
+    return "b:" + hashlib.sha256(data).hexdigest()
+
+
+def key_for_array(img_array):
+    """Cache key for a decoded pixel tensor, so re-encoded copies of the same
+    photo share an entry."""
+    return "p:" + hashlib.sha256(np.ascontiguousarray(img_array).data).hexdigest()
+
+
+class RedisBackend:
+    """Shared cache backend so several workers can reuse each other's hits.
+
+    Needs the optional `redis` package and a reachable server, e.g. a local
+    `redis-server` started with default settings.
+    """
+
+    def __init__(self, url, prefix="snakegenius:prediction:"):
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self._redis.get(self.prefix + key)
+        if raw is None:
+            return None
+        return np.frombuffer(raw, dtype=np.float32)
+
+    def set(self, key, probabilities, ttl):
+        data = np.asarray(probabilities, dtype=np.float32).tobytes()
+        if ttl:
+            self._redis.setex(self.prefix + key, int(ttl), data)
+        else:
+            self._redis.set(self.prefix + key, data)
+
+
+class PredictionCache:
+    """Bounded LRU cache of prediction probability vectors with TTL eviction.
+
+    Values are the full probability vector over `class_list`. When a shared
+    `backend` is configured it is consulted on local misses and written
+    through on every `set`.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, backend=None):
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl_seconds)
+        self.backend = backend
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.backend_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.backend_errors = 0
+
+    def get(self, key):
+        if key is None or self.max_entries <= 0:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, probabilities = entry
+                if self.ttl and expires_at < now:
+                    del self._entries[key]
+                    self.expirations += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return probabilities
+
+        probabilities = self._backend_get(key)
+        with self._lock:
+            if probabilities is None:
+                self.misses += 1
+                return None
+            self.backend_hits += 1
+            self._store(key, probabilities, now)
+        return probabilities
+
+    def set(self, key, probabilities):
+        if key is None or self.max_entries <= 0:
+            return
+        probabilities = np.array(probabilities, dtype=np.float32)
+        probabilities.setflags(write=False)
+        with self._lock:
+            self._store(key, probabilities, time.monotonic())
+        if self.backend is not None:
+            try:
+                self.backend.set(key, probabilities, self.ttl)
+            except Exception as e:
+                self.backend_errors += 1
+                logger.warning("Prediction cache backend error: %s", e)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.backend_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "backend_hits": self.backend_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.backend_hits) / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "backend_errors": self.backend_errors,
+                "shared_backend": self.backend is not None,
+            }
+
+    def _store(self, key, probabilities, now):
+        self._entries[key] = (now + self.ttl, probabilities)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _backend_get(self, key):
+        if self.backend is None:
+            return None
+        try:
+            probabilities = self.backend.get(key)
+        except Exception as e:
+            self.backend_errors += 1
+            logger.warning("Prediction cache backend error: %s", e)
+            return None
+        if probabilities is not None:
+            probabilities = np.array(probabilities, dtype=np.float32)
+            probabilities.setflags(write=False)
+        return probabilities
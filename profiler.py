@@ -0,0 +1,64 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread every `interval` seconds from a
+    background thread and counts identical stacks.
+
+    The profiled thread is never interrupted, so a request costs only the
+    GIL time the sampler takes. `collapsed()` gives the counts in the folded
+    format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005, max_depth=64):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self.duration = 0.0
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.duration = time.perf_counter() - self._started
+        return self
+
+    def collapsed(self):
+        """One line per distinct stack, root first: "a;b;c <samples>"."""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self._stacks.most_common())
+
+    def top(self, n=10):
+        """The functions most often on top of the stack, with their share of samples."""
+        own = collections.Counter()
+        for stack, count in self._stacks.items():
+            own[stack[-1]] += count
+        return [(frame, round(count / self.samples, 3)) for frame, count in own.most_common(n)]
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self._stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
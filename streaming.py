@@ -0,0 +1,149 @@
+"""Fast JSON encoding and streamed JSON / NDJSON bodies for list endpoints.
+
+Lists are encoded one item at a time and sent in chunks of about
+CHUNK_BYTES, so neither the whole list nor its whole encoding has to be
+held in memory, and the first bytes leave before the last item is read.
+"""
+import json
+from datetime import date, datetime
+
+import numpy as np
+from bson import ObjectId
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library encoder
+    orjson = None
+
+JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+FORMATS = ("json", "ndjson")
+CHUNK_BYTES = 64 * 1024
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj, sort_keys=False):
+    """Compact UTF-8 JSON bytes, with orjson when it is installed. ObjectIds
+    are written as their hex strings, so documents need no copying first."""
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, default=_default, option=option)
+    return json.dumps(obj, default=_default, sort_keys=sort_keys, separators=(",", ":"),
+                      ensure_ascii=False).encode("utf-8")
+
+
+def parse_fields(value, allowed):
+    """The fields named by a comma-separated `fields=` parameter, or None for
+    all of them. Raises ValueError for a field not in `allowed`."""
+    if value is None:
+        return None
+    fields = list(dict.fromkeys(field.strip() for field in value.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown or not fields:
+        raise ValueError(f"Unknown fields: {', '.join(unknown) or value!r}. Choose from {', '.join(allowed)}")
+    return fields
+
+
+def project(document, fields):
+    """`document` with only `fields`, or unchanged when fields is None."""
+    if fields is None:
+        return document
+    return {field: document[field] for field in fields if field in document}
+
+
+def wants_ndjson(format=None, accept=""):
+    """Whether to answer in NDJSON: asked for with format=ndjson, or by an
+    Accept header naming NDJSON but not JSON. Raises ValueError for an
+    unknown format."""
+    if format is not None:
+        if format not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        return format == "ndjson"
+    accept = accept or ""
+    return NDJSON_MIMETYPE in accept and JSON_MIMETYPE not in accept
+
+
+class ListEncoder:
+    """Encodes a list response one item at a time: {"<key>": [...]} or, with
+    key None, NDJSON. add() returns a chunk once about `chunk_bytes` are
+    buffered, and finish() the rest."""
+
+    def __init__(self, key=None, chunk_bytes=CHUNK_BYTES):
+        self.key = key
+        self.chunk_bytes = chunk_bytes
+        self.count = 0
+        self._buffer = bytearray() if key is None else bytearray(b"{" + dumps(key) + b":[")
+
+    def add(self, item):
+        if self.key is None:
+            self._buffer += dumps(item) + b"\n"
+        else:
+            self._buffer += (b"," if self.count else b"") + dumps(item)
+        self.count += 1
+        if len(self._buffer) >= self.chunk_bytes:
+            return self._flush()
+        return None
+
+    def finish(self, extra=None):
+        """The rest of the body. `extra` holds further top-level fields, or in
+        NDJSON a last line, when not empty."""
+        if self.key is None:
+            if extra:
+                self._buffer += dumps(extra) + b"\n"
+        else:
+            self._buffer += b"]"
+            for name, value in (extra or {}).items():
+                self._buffer += b"," + dumps(name) + b":" + dumps(value)
+            self._buffer += b"}\n"
+        return self._flush()
+
+    def _flush(self):
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
+        return chunk
+
+
+def json_chunks(items, key, trailer=None, chunk_bytes=CHUNK_BYTES):
+    """Yields {"<key>": [items...], ...} in chunks. `trailer` is called after
+    the last item and returns further top-level fields, such as a cursor
+    that depends on what was sent."""
+    return _chunks(items, ListEncoder(key, chunk_bytes), trailer)
+
+
+def ndjson_chunks(items, trailer=None, chunk_bytes=CHUNK_BYTES):
+    """Yields one JSON document per line, in chunks. A non-empty trailer
+    dict is sent as the last line."""
+    return _chunks(items, ListEncoder(None, chunk_bytes), trailer)
+
+
+def _chunks(items, encoder, trailer):
+    for item in items:
+        chunk = encoder.add(item)
+        if chunk:
+            yield chunk
+    chunk = encoder.finish(trailer() if trailer else None)
+    if chunk:
+        yield chunk
+
+
+async def async_chunks(items, key=None, trailer=None, chunk_bytes=CHUNK_BYTES):
+    """json_chunks (or with key None, ndjson_chunks) of an async iterator."""
+    encoder = ListEncoder(key, chunk_bytes)
+    async for item in items:
+        chunk = encoder.add(item)
+        if chunk:
+            yield chunk
+    chunk = encoder.finish(trailer() if trailer else None)
+    if chunk:
+        yield chunk
@@ -1,5 +1,6 @@
 import pytest
-from app import app, db, users_collection, snakes_collection
+from app import app, db, users_collection, snakes_collection, prediction_cache, catalog
+from db_indexes import ensure_indexes
 from flask_jwt_extended import create_access_token
 import json
 from datetime import datetime
@@ -9,11 +10,14 @@ import io
 @pytest.fixture
 def client():
     app.config['TESTING'] = True
+    ensure_indexes(db)  # Dropping the collections drops their indexes too
     with app.test_client() as client:
         yield client
     # Clean up the test database after each test
     db.users.drop()
     db.snakes.drop()
+    prediction_cache.clear()
+    catalog.invalidate()
 
 # Test Home Route
 def test_home(client):
@@ -21,6 +25,15 @@ def test_home(client):
     assert response.status_code == 200
     assert b"Snake Prediction API is running!" in response.data
 
+# Test Health Route
+def test_health(client):
+    response = client.get('/health')
+    assert response.status_code == 200
+    json_data = json.loads(response.data)
+    assert json_data['startup']['import_seconds'] > 0
+    assert 'loaded' in json_data['model']
+    assert json_data['memory']['pid'] > 0
+
 # Test User Registration
 def test_register(client):
     data = {
@@ -70,6 +83,44 @@ def test_login_invalid_credentials(client):
     assert response.status_code == 401
     assert b"Invalid credentials" in response.data
 
+# Test Login Upgrades Hashes Made With Another Cost Factor
+def test_login_rehashes_password(client):
+    from passwords import PasswordHasher, hash_rounds
+    import time
+
+    old_hash = PasswordHasher(rounds=4).hash("password123")
+    users_collection.insert_one({"email": "test@test.com", "password": old_hash, "recent_predictions": []})
+
+    response = client.post('/login', json={"email": "test@test.com", "password": "password123"})
+    assert response.status_code == 200
+
+    # The new hash is stored in the background
+    deadline = time.time() + 10
+    while users_collection.find_one({"email": "test@test.com"})['password'] == old_hash and time.time() < deadline:
+        time.sleep(0.05)
+    new_hash = users_collection.find_one({"email": "test@test.com"})['password']
+    assert hash_rounds(new_hash) == hash_rounds(PasswordHasher().hash("x"))
+    assert client.post('/login', json={"email": "test@test.com", "password": "password123"}).status_code == 200
+
+# Test Login Is Shed When Password Hashing Is Saturated
+def test_login_auth_busy(client, monkeypatch):
+    from passwords import PasswordHasher
+    import threading
+
+    client.post('/register', json={"email": "test@test.com", "password": "password123"})
+
+    # The only slot is taken by another request
+    hasher = PasswordHasher(max_workers=1, max_pending=1)
+    gate = threading.Event()
+    pending = hasher.submit(gate.wait, 5)
+    monkeypatch.setattr("app.password_hasher", hasher)
+
+    response = client.post('/login', json={"email": "test@test.com", "password": "password123"})
+    assert response.status_code == 429
+    assert 'Retry-After' in response.headers
+    gate.set()
+    pending.result(timeout=5)
+
 # Test Add Snake
 def test_add_snake(client):
     data = {
@@ -160,6 +211,54 @@ def test_get_snakes(client):
     json_data = json.loads(response.data)
     assert any(snake['name'] == "Test Get Snake" for snake in json_data['snakes'])
 
+# Test Projected And NDJSON Snake Lists
+def test_get_snakes_fields(client):
+    snakes_collection.insert_one({
+        "name": "Fields Snake",
+        "image": "https://example.com/fields.jpg",
+        "description": "Description for fields test",
+        "endemism": "Not Endemic",
+        "wikiLink": "https://en.wikipedia.org/wiki/Fields_Snake"
+    })
+
+    response = client.get('/snakes?fields=name')
+    assert response.status_code == 200
+    assert {"name": "Fields Snake"} in json.loads(response.data)['snakes']
+    response = client.get('/snakes?fields=name', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+    response = client.get('/snakes?fields=name,image', headers={'Accept': 'application/x-ndjson'})
+    assert response.mimetype == 'application/x-ndjson'
+    assert {"name": "Fields Snake", "image": "https://example.com/fields.jpg"} in map(json.loads, response.data.splitlines())
+
+    assert client.get('/snakes?fields=password').status_code == 400
+    assert client.get('/snakes?format=xml').status_code == 400
+
+# Test Catalog Conditional GET
+def test_get_snakes_not_modified(client):
+    client.post('/addsnake', json={
+        "name": "Cached Snake",
+        "image": "https://example.com/cached.jpg",
+        "description": "Description for cache test",
+        "endemism": "Not Endemic",
+        "wikiLink": "https://en.wikipedia.org/wiki/Cached_Snake"
+    })
+
+    response = client.get('/snakes')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.headers['Last-Modified']
+
+    response = client.get('/snakes', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    # Writes through the API invalidate the cached catalog
+    client.delete('/deletesnake/Cached Snake')
+    response = client.get('/snakes', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    json_data = json.loads(response.data)
+    assert not any(snake['name'] == "Cached Snake" for snake in json_data['snakes'])
+
 # Test Search Snake with Non-existent Snake
 def test_search_snake_not_found(client):
     response = client.get('/searchsnake/Nonexistent Snake')
@@ -185,6 +284,114 @@ def test_predict(client, monkeypatch):
     assert json_data['accuracy'] == 50.0
 
 
+# Test Predict With Top-k Classes Joined To The Catalog
+def test_predict_top_k(client, monkeypatch):
+    def mock_predict(*args, **kwargs):
+        return [[0.05, 0.05, 0.05, 0.05, 0.4, 0.35, 0.05]]  # Near-tie between "Rat snake" and "Russell's viper"
+
+    monkeypatch.setattr("app.model.predict", mock_predict)
+    snakes_collection.insert_one({"name": "Russell's viper", "image": "viper.jpg", "description": "Venomous",
+                                  "endemism": "Asia", "wikiLink": "https://en.wikipedia.org/wiki/Russell%27s_viper"})
+
+    with open('tests/test_image1.jpg', 'rb') as img:
+        data = {'image': (img, 'test_image.jpg')}
+        response = client.post('/predict?k=2', content_type='multipart/form-data', data=data)
+
+    assert response.status_code == 200
+    json_data = json.loads(response.data)
+    assert json_data['snake'] == 'Rat snake'
+    assert json_data['uncertain']
+    assert [entry['snake'] for entry in json_data['top_k']] == ['Rat snake', "Russell's viper"]
+    assert json_data['top_k'][0]['details'] is None
+    assert json_data['top_k'][1]['details']['endemism'] == 'Asia'
+
+
+# Test Predict With Adaptive Test-Time Augmentation
+def test_predict_tta(client, monkeypatch):
+    calls = []
+
+    def mock_predict(batch, *args, **kwargs):
+        calls.append(len(batch))
+        return [[0.1, 0.1, 0.1, 0.1, 0.4, 0.1, 0.1]] * len(batch)  # Low-confidence "Rat snake"
+
+    monkeypatch.setattr("app.model.predict", mock_predict)
+    monkeypatch.setattr("app.tta_policy.views", 4)
+
+    with open('tests/test_image1.jpg', 'rb') as img:
+        data = {'image': (img, 'test_image.jpg')}
+        response = client.post('/predict?tta=auto', content_type='multipart/form-data', data=data)
+
+    assert response.status_code == 200
+    json_data = json.loads(response.data)
+    assert json_data['snake'] == 'Rat snake'
+    assert json_data['tta_views'] == 4
+    assert calls == [1, 3]  # The single view, then the other views in one batch
+
+    with open('tests/test_image1.jpg', 'rb') as img:
+        data = {'image': (img, 'test_image.jpg')}
+        response = client.post('/predict?tta=sometimes', content_type='multipart/form-data', data=data)
+    assert response.status_code == 400
+
+
+# Test Similar-Image Search Over Earlier Predictions
+def test_similar(client, monkeypatch, tmp_path):
+    from embeddings import EmbeddingPipeline, EmbeddingStore
+    import numpy as np
+
+    class FakeExtractor:
+        def embed(self, batch):
+            return np.asarray(batch).mean(axis=(1, 2))
+
+        def classify(self, embeddings):
+            return np.tile([0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1], (len(embeddings), 1))
+
+    pipeline = EmbeddingPipeline(None, EmbeddingStore(str(tmp_path), 7))
+    pipeline._extractor = FakeExtractor()
+    monkeypatch.setattr("app.embedding_pipeline", pipeline)
+
+    for name in ('tests/test_image.jpg', 'tests/test_image1.jpg'):
+        with open(name, 'rb') as img:
+            response = client.post('/predict', content_type='multipart/form-data', data={'image': (img, 'photo.jpg')})
+        assert json.loads(response.data)['snake'] == 'Rat snake'
+
+    with open('tests/test_image1.jpg', 'rb') as img:
+        response = client.post('/similar?k=2', content_type='multipart/form-data', data={'image': (img, 'photo.jpg')})
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+    assert [result['id'] for result in results] == [1, 0]
+    assert results[0]['similarity'] == 1.0
+    assert results[0]['snake'] == 'Rat snake'
+
+# Test Similar-Image Search When Embeddings Are Off
+def test_similar_disabled(client):
+    with open('tests/test_image1.jpg', 'rb') as img:
+        response = client.post('/similar', content_type='multipart/form-data', data={'image': (img, 'photo.jpg')})
+    assert response.status_code == 503
+
+
+# Test Uploads That Are Not Images Are Rejected
+def test_predict_rejects_non_image(client):
+    data = {'image': (io.BytesIO(b"%PDF-1.7 not an image" * 10), 'document.pdf')}
+    response = client.post('/predict', content_type='multipart/form-data', data=data)
+    assert response.status_code == 415
+
+# Test Upload Size And Pixel Limits
+def test_predict_upload_limits(client, monkeypatch):
+    monkeypatch.setattr("app.max_upload_bytes", 1024)
+    with open('tests/test_image1.jpg', 'rb') as img:
+        data = {'image': (img, 'test_image.jpg')}
+        response = client.post('/predict', content_type='multipart/form-data', data=data)
+    assert response.status_code == 413
+
+    monkeypatch.setattr("app.max_upload_bytes", 10 * 1024 * 1024)
+    monkeypatch.setattr("PIL.Image.MAX_IMAGE_PIXELS", 100)
+    with open('tests/test_image1.jpg', 'rb') as img:
+        data = {'image': (img, 'test_image.jpg')}
+        response = client.post('/predict', content_type='multipart/form-data', data=data)
+    assert response.status_code == 413
+    assert b"pixels" in response.data
+
+
 # Test Save Prediction
 def test_save_prediction(client):
     # Register and login a user
@@ -224,6 +431,100 @@ def test_predict_without_jwt(client):
     assert json_data['accuracy'] is not None
 
 
+# Test Batch Prediction
+def test_predict_batch(client, monkeypatch):
+    def mock_predict(batch, *args, **kwargs):
+        return [[0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1]] * len(batch)  # Mock prediction for "Rat snake"
+
+    monkeypatch.setattr("app.model.predict", mock_predict)
+
+    client.post('/register', json={"email": "test@test.com", "password": "password123"})
+    login_response = client.post('/login', json={"email": "test@test.com", "password": "password123"})
+    token = json.loads(login_response.data)['token']
+
+    with open('tests/test_image.jpg', 'rb') as img, open('tests/test_image1.jpg', 'rb') as img1:
+        data = {'images': [(img, 'test_image.jpg'), (img1, 'test_image1.jpg')]}
+        response = client.post('/predict/batch?k=2', content_type='multipart/form-data', data=data, headers={'Authorization': f'Bearer {token}'})
+
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+    assert [result['filename'] for result in results] == ['test_image.jpg', 'test_image1.jpg']
+    for result in results:
+        assert result['snake'] == 'Rat snake'
+        assert result['accuracy'] == 50.0
+        assert len(result['top_k']) == 2
+        assert result['top_k'][0]['snake'] == 'Rat snake'
+
+    # Both predictions are saved to the user's history
+    response = client.get('/account/predictions', headers={'Authorization': f'Bearer {token}'})
+    assert len(json.loads(response.data)['recent_predictions']) == 2
+
+
+# Test A Non-Image In A Batch Only Fails That Image
+def test_predict_batch_mixed_formats(client, monkeypatch):
+    monkeypatch.setattr("app.model.predict", lambda batch, *args, **kwargs: [[0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1]] * len(batch))
+
+    with open('tests/test_image.jpg', 'rb') as img:
+        data = {'images': [(img, 'test_image.jpg'), (io.BytesIO(b"not an image, " * 100), 'notes.txt')]}
+        response = client.post('/predict/batch', content_type='multipart/form-data', data=data)
+
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+    assert results[0]['snake'] == 'Rat snake'
+    assert 'error' not in results[0]
+    assert results[1]['filename'] == 'notes.txt'
+    assert results[1]['error'].startswith("Could not read image: Unsupported image format")
+
+    # A single non-image upload is still refused outright
+    response = client.post('/predict', content_type='multipart/form-data',
+                           data={'image': (io.BytesIO(b"not an image, " * 100), 'notes.txt')})
+    assert response.status_code == 415
+
+
+# Test Batch Prediction Without Images
+def test_predict_batch_without_images(client):
+    response = client.post('/predict/batch', content_type='multipart/form-data', data={})
+    assert response.status_code == 400
+
+
+# Test Predict When Inference Is Disabled
+def test_predict_inference_disabled(client, monkeypatch):
+    monkeypatch.setattr("app.inference_enabled", False)
+    with open('tests/test_image1.jpg', 'rb') as img:
+        data = {'image': (img, 'test_image.jpg')}
+        response = client.post('/predict', content_type='multipart/form-data', data=data)
+    assert response.status_code == 503
+
+
+# Test Predict When The Inference Queue Is Full
+def test_predict_inference_busy(client, monkeypatch):
+    from inference_pool import InferencePool
+    import numpy as np
+    import threading
+
+    gate = threading.Event()
+
+    class BlockedRuntime:
+        def predict(self, batch):
+            gate.wait(5)
+            return np.zeros((len(batch), 7))
+
+    # The only slot is taken by another request
+    pool = InferencePool(local=True, runtime_factory=BlockedRuntime, max_queue=1)
+    pending = pool.submit(np.zeros((224, 224, 3), dtype=np.float32))
+    monkeypatch.setattr("app.inference", pool)
+
+    with open('tests/test_image1.jpg', 'rb') as img:
+        data = {'image': (img, 'test_image.jpg')}
+        response = client.post('/predict', content_type='multipart/form-data', data=data)
+    assert response.status_code == 503
+    assert 'Retry-After' in response.headers
+
+    gate.set()
+    pending.result(timeout=5)
+    pool.close()
+
+
 # Test Account Recent Predictions
 def test_get_predictions(client):
     # Register and login a user
@@ -242,6 +543,52 @@ def test_get_predictions(client):
     assert len(json_data['recent_predictions']) > 0
     assert json_data['recent_predictions'][0]['snake'] == "cobra"
 
+# Test Paginated Recent Predictions
+def test_get_predictions_paginated(client):
+    client.post('/register', json={"email": "test@test.com", "password": "password123"})
+    login_response = client.post('/login', json={"email": "test@test.com", "password": "password123"})
+    token = json.loads(login_response.data)['token']
+
+    predictions = [{"snake": "cobra", "accuracy": 90.0, "timestamp": f"2024-08-27T12:34:5{i}"} for i in range(5)]
+    users_collection.update_one({"email": "test@test.com"}, {"$push": {"recent_predictions": {"$each": predictions}}})
+
+    headers = {'Authorization': f'Bearer {token}'}
+    response = client.get('/account/predictions?limit=3', headers=headers)
+    assert response.status_code == 200
+    first_page = json.loads(response.data)
+    assert len(first_page['recent_predictions']) == 3
+    assert 'password' not in first_page
+
+    # Newest first
+    assert [p['timestamp'] for p in first_page['recent_predictions']] == [p['timestamp'] for p in predictions[:1:-1]]
+
+    response = client.get(f"/account/predictions?limit=3&cursor={first_page['next_cursor']}", headers=headers)
+    second_page = json.loads(response.data)
+    assert [p['timestamp'] for p in second_page['recent_predictions']] == [p['timestamp'] for p in predictions[1::-1]]
+    assert second_page['next_cursor'] is None
+
+# Test Projected And NDJSON Recent Predictions
+def test_get_predictions_fields(client):
+    client.post('/register', json={"email": "test@test.com", "password": "password123"})
+    login_response = client.post('/login', json={"email": "test@test.com", "password": "password123"})
+    token = json.loads(login_response.data)['token']
+
+    predictions = [{"snake": "cobra", "accuracy": 90.0, "timestamp": f"2024-08-27T12:34:5{i}"} for i in range(3)]
+    users_collection.update_one({"email": "test@test.com"}, {"$push": {"recent_predictions": {"$each": predictions}}})
+
+    headers = {'Authorization': f'Bearer {token}'}
+    response = client.get('/account/predictions?limit=2&fields=snake', headers=headers)
+    page = json.loads(response.data)
+    assert page['recent_predictions'] == [{"snake": "cobra"}, {"snake": "cobra"}]
+    assert page['next_cursor']
+
+    response = client.get('/account/predictions?format=ndjson', headers=headers)
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.data.splitlines()]
+    assert lines[:-1] == predictions[::-1] and lines[-1] == {"next_cursor": None}
+
+    assert client.get('/account/predictions?fields=password', headers=headers).status_code == 400
+
 # Test Change Password
 def test_change_password(client):
     # Register and login a user
@@ -275,4 +622,47 @@ def test_change_password_incorrect_old_password(client):
     headers = {'Authorization': f'Bearer {token}'}
     response = client.put('/account/changepassword', json=change_password_data, headers=headers)
     assert response.status_code == 401
-    assert b"Invalid credentials" in response.data
\ No newline at end of file
+    assert b"Invalid credentials" in response.data
+
+# Test Metrics Route Reports Stage Timings
+def test_metrics(client, monkeypatch):
+    monkeypatch.setattr("app.model.predict", lambda *args, **kwargs: [[0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1]])
+    with open('tests/test_image1.jpg', 'rb') as img:
+        response = client.post('/predict', content_type='multipart/form-data', data={'image': (img, 'test_image.jpg')})
+    assert 'decode;dur=' in response.headers['Server-Timing']
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    text = response.get_data(as_text=True)
+    for stage in ('receive', 'decode', 'preprocess', 'inference', 'forward', 'serialize'):
+        assert f'snake_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'snake_http_request_seconds_count{route="/predict",method="POST",status="200"}' in text
+    assert 'snake_inference_queue_depth ' in text
+
+# Test A Request Is Profiled Only With The Right Token
+def test_profile_header(client, monkeypatch, tmp_path):
+    monkeypatch.setattr("app.profile_token", "secret")
+    monkeypatch.setattr("app.profile_dir", str(tmp_path))
+
+    assert 'X-Profile-Id' not in client.get('/snakes', headers={'X-Profile': 'wrong'}).headers
+    response = client.get('/snakes', headers={'X-Profile': 'secret'})
+    assert (tmp_path / (response.headers['X-Profile-Id'] + '.folded')).exists()
+
+# Test Database Timeouts Answer 504
+def test_database_timeout(client, monkeypatch):
+    from pymongo.errors import ExecutionTimeout
+
+    def timed_out(*args, **kwargs):
+        raise ExecutionTimeout("operation exceeded time limit", 50)
+
+    monkeypatch.setattr(db.users, "find_one", timed_out)
+    response = client.post('/login', json={"email": "test@test.com", "password": "password123"})
+    assert response.status_code == 504
+
+    # Also after inference, rather than the prediction route's generic 500
+    monkeypatch.setattr("app.model.predict", lambda *args, **kwargs: [[0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1]])
+    monkeypatch.setattr("app.catalog.get", timed_out)
+    with open('tests/test_image1.jpg', 'rb') as img:
+        response = client.post('/predict?k=3', content_type='multipart/form-data', data={'image': (img, 'test_image1.jpg')})
+    assert response.status_code == 504
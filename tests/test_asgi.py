@@ -0,0 +1,184 @@
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("starlette")
+pytest.importorskip("httpx")
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+from starlette.testclient import TestClient
+from flask_jwt_extended import create_access_token
+
+import app as api
+from asgi import create_asgi_app
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('PRELOAD_MODEL', 'false')
+    database = mongomock_motor.AsyncMongoMockClient()['SnakesG1_asgi_test']
+    with TestClient(create_asgi_app(database)) as client:
+        yield client
+    api.prediction_cache.clear()
+
+def add_cobra(client):
+    return client.post('/addsnake', json={
+        "name": "Cobra",
+        "image": "cobra.jpg",
+        "description": "Venomous snake",
+        "endemism": "Asia",
+        "wikiLink": "https://en.wikipedia.org/wiki/Cobra"
+    })
+
+# Test Home Route
+def test_home(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    assert "Snake Prediction API is running!" in response.text
+
+# Test Register, Duplicate Register and Login
+def test_register_and_login(client):
+    data = {"email": "test@test.com", "password": "password123"}
+    assert client.post('/register', json=data).status_code == 201
+
+    response = client.post('/register', json=data)
+    assert response.status_code == 400
+    assert response.json()['error'] == "Email is already registered"
+
+    response = client.post('/login', json=data)
+    assert response.status_code == 200
+    assert response.json()['token']
+
+    response = client.post('/login', json={"email": "test@test.com", "password": "wrong"})
+    assert response.status_code == 401
+
+# Test Tokens From The Flask Server Are Accepted
+def test_flask_token_accepted(client):
+    client.post('/register', json={"email": "test@test.com", "password": "password123"})
+    user_id = client.post('/login', json={"email": "test@test.com", "password": "password123"}).json()['user_id']
+
+    with api.app.app_context():
+        token = create_access_token(identity=user_id)
+    response = client.get('/account/predictions', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    assert response.json() == {"recent_predictions": [], "next_cursor": None}
+
+# Test Missing And Invalid Tokens
+def test_invalid_token(client):
+    assert client.get('/account/predictions').status_code == 401
+    response = client.get('/account/predictions', headers={'Authorization': 'Bearer not-a-token'})
+    assert response.status_code == 401
+
+# Test Snake Catalog Routes
+def test_snake_catalog(client):
+    assert add_cobra(client).status_code == 201
+    assert add_cobra(client).status_code == 400
+
+    response = client.get('/snakes')
+    assert response.status_code == 200
+    assert response.json()['snakes'][0]['name'] == 'Cobra'
+    response = client.get('/snakes', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+    assert client.get('/snakelist').json() == {"snakes": [{"name": "Cobra"}]}
+    assert client.get('/searchsnake/Cobra').json()['snake']['endemism'] == 'Asia'
+    assert client.get('/searchsnake/Python').status_code == 404
+
+    assert client.delete('/deletesnake/Cobra').status_code == 200
+    assert client.get('/snakes').json() == {"snakes": []}
+
+# Test Projected Lists And Streamed History
+def test_streamed_lists(client):
+    add_cobra(client)
+    assert client.get('/snakes?fields=name').json() == {"snakes": [{"name": "Cobra"}]}
+    response = client.get('/snakes?format=ndjson')
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+    assert response.text.count('\n') == 1
+
+    client.post('/register', json={"email": "stream@test.com", "password": "password123"})
+    token = client.post('/login', json={"email": "stream@test.com", "password": "password123"}).json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+    assert client.get('/account/predictions', headers=headers).json() == {"recent_predictions": [], "next_cursor": None}
+    assert client.get('/account/predictions?fields=nope', headers=headers).status_code == 400
+
+# Test Predict Route
+def test_predict(client, monkeypatch):
+    def mock_predict(*args, **kwargs):
+        return [[0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1]]  # Mock prediction for "Rat snake"
+
+    monkeypatch.setattr("app.model.predict", mock_predict)
+
+    with open('tests/test_image1.jpg', 'rb') as img:
+        response = client.post('/predict', files={'image': ('test_image.jpg', img, 'image/jpeg')})
+
+    assert response.status_code == 200
+    assert response.json() == {"snake": "Rat snake", "accuracy": 50.0}
+
+# Test A Timed Out Prediction Does Not Stall The Next One
+def test_predict_after_timeout(client, monkeypatch):
+    release = threading.Event()
+
+    def slow_then_fast(batch):
+        release.wait(5)
+        return np.tile([[0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1]], (len(batch), 1))
+
+    monkeypatch.setattr("app.model.predict", slow_then_fast)
+    monkeypatch.setattr(api, "predict_timeout", 0.05)
+    with open('tests/test_image.jpg', 'rb') as img:
+        response = client.post('/predict', files={'image': ('test_image.jpg', img, 'image/jpeg')})
+    assert response.status_code == 504
+
+    release.set()
+    monkeypatch.setattr(api, "predict_timeout", 5)
+    with open('tests/test_image1.jpg', 'rb') as img:
+        response = client.post('/predict', files={'image': ('test_image1.jpg', img, 'image/jpeg')})
+    assert response.json() == {"snake": "Rat snake", "accuracy": 50.0}
+
+# Test Predict Without An Image
+def test_predict_without_image(client):
+    response = client.post('/predict', files={'other': ('a.txt', b'x', 'text/plain')})
+    assert response.status_code == 400
+
+# Test Predict When Inference Is Disabled
+def test_predict_inference_disabled(client, monkeypatch):
+    monkeypatch.setattr("app.inference_enabled", False)
+    with open('tests/test_image1.jpg', 'rb') as img:
+        response = client.post('/predict', files={'image': ('test_image.jpg', img, 'image/jpeg')})
+    assert response.status_code == 503
+
+# Test Oversized Requests Are Cut Off
+def test_request_size_limit(client, monkeypatch):
+    monkeypatch.setattr("app.max_upload_bytes", 1024)
+    with open('tests/test_image1.jpg', 'rb') as img:
+        response = client.post('/predict', files={'image': ('test_image.jpg', img, 'image/jpeg')})
+    assert response.status_code == 413
+
+# Test A Non-Image In A Batch Only Fails That Image, Like The Flask App
+def test_predict_batch_mixed_formats(client, monkeypatch):
+    monkeypatch.setattr("app.model.predict", lambda batch, *args, **kwargs: [[0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1]] * len(batch))
+    with open('tests/test_image.jpg', 'rb') as img:
+        files = [('images', ('test_image.jpg', img, 'image/jpeg')), ('images', ('notes.txt', b"not an image, " * 100, 'text/plain'))]
+        response = client.post('/predict/batch', files=files)
+
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert results[0]['snake'] == 'Rat snake'
+    assert results[1]['error'].startswith("Could not read image: Unsupported image format")
+
+    # An oversized file still rejects the whole request while it arrives
+    monkeypatch.setattr("app.max_upload_bytes", 1024)
+    with open('tests/test_image.jpg', 'rb') as img:
+        response = client.post('/predict/batch', files=[('images', ('test_image.jpg', img, 'image/jpeg'))])
+    assert response.status_code == 413
+
+# Test Metrics Route And Server-Timing
+def test_metrics(client, monkeypatch):
+    monkeypatch.setattr("app.model.predict", lambda *args, **kwargs: [[0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1]])
+    with open('tests/test_image1.jpg', 'rb') as img:
+        response = client.post('/predict', files={'image': ('test_image.jpg', img, 'image/jpeg')})
+    assert 'decode;dur=' in response.headers['Server-Timing']
+
+    client.get('/searchsnake/Cobra')
+    text = client.get('/metrics').text
+    assert 'snake_stage_seconds_count{stage="inference"}' in text
+    assert 'route="/searchsnake/{name}",method="GET",status="404"' in text
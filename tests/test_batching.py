@@ -0,0 +1,148 @@
+import threading
+
+import numpy as np
+import pytest
+
+from batching import MicroBatcher
+
+
+def fake_predict(batch):
+    # One row per image; the row encodes the image's first pixel value
+    return np.stack([np.full(7, img[0, 0, 0]) for img in batch])
+
+
+def make_image(value):
+    return np.full((224, 224, 3), value, dtype=np.float32)
+
+
+# Test that each caller gets its own row back
+def test_results_are_routed_to_their_request():
+    batcher = MicroBatcher(fake_predict, max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(make_image(i)) for i in range(4)]
+    results = [future.result(timeout=5) for future in futures]
+    batcher.close()
+
+    for i, result in enumerate(results):
+        assert result[0] == i
+
+
+# Test that concurrent requests share a model call
+def test_concurrent_requests_are_batched():
+    calls = []
+
+    def predict_fn(batch):
+        calls.append(len(batch))
+        return fake_predict(batch)
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=8, max_wait_ms=200)
+    threads = [threading.Thread(target=batcher.predict, args=(make_image(i),)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+
+    assert sum(calls) == 8
+    assert len(calls) < 8
+    stats = batcher.stats()
+    assert stats['items'] == 8
+    assert stats['batches'] == len(calls)
+    assert sum(stats['fill_histogram']) == len(calls)
+
+
+# Test that a lone request is flushed after max wait
+def test_single_request_is_flushed_after_max_wait():
+    batcher = MicroBatcher(fake_predict, max_batch_size=32, max_wait_ms=1)
+    result = batcher.predict(make_image(3))
+    batcher.close()
+
+    assert result[0] == 3
+    assert batcher.stats()['last_batch_size'] == 1
+
+
+# Test that model errors are raised in the submitting request
+def test_model_errors_propagate():
+    def failing_predict(batch):
+        raise ValueError("model exploded")
+
+    batcher = MicroBatcher(failing_predict, max_batch_size=2, max_wait_ms=1)
+    with pytest.raises(ValueError):
+        batcher.predict(make_image(0))
+    batcher.close()
+
+
+# Test that a request cancelled while queued is skipped and the batcher keeps running
+def test_cancelled_request_is_skipped():
+    gate = threading.Event()
+    calls = []
+
+    def predict_fn(batch):
+        gate.wait(5)
+        calls.append(len(batch))
+        return fake_predict(batch)
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=1, max_wait_ms=1)
+    first = batcher.submit(make_image(1))
+    queued = batcher.submit(make_image(2))
+    assert queued.cancel()
+    gate.set()
+
+    assert first.result(timeout=5)[0] == 1
+    assert batcher.predict(make_image(3), timeout=5)[0] == 3
+    batcher.close()
+    assert calls == [1, 1]
+
+
+# Test an image whose predict() timed out is not run afterwards
+def test_predict_timeout_cancels_queued_image():
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+
+    gate = threading.Event()
+    calls = []
+
+    def predict_fn(batch):
+        gate.wait(5)
+        calls.append([int(img[0, 0, 0]) for img in batch])
+        return fake_predict(batch)
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=1, max_wait_ms=1)
+    first = batcher.submit(make_image(1))
+    with pytest.raises(FutureTimeoutError):
+        batcher.predict(make_image(2), timeout=0.05)
+    gate.set()
+
+    assert first.result(timeout=5)[0] == 1
+    assert batcher.predict(make_image(3), timeout=5)[0] == 3
+    batcher.close()
+    assert calls == [[1], [3]]
+
+
+# Test whole batches go through the queue, with its backpressure and timeout
+def test_predict_many_uses_the_queue():
+    from batching import InferenceBusy
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+
+    gate = threading.Event()
+    calls = []
+
+    def predict_fn(batch):
+        gate.wait(5)
+        calls.append(len(batch))
+        return fake_predict(batch)
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=4, max_wait_ms=1, max_queue=4)
+    waiting = batcher.submit(make_image(9))
+    with pytest.raises(FutureTimeoutError):
+        batcher.predict_many(np.stack([make_image(i) for i in range(2)]), timeout=0.05)
+    queued = batcher.submit(make_image(8))
+    with pytest.raises(InferenceBusy):
+        batcher.predict_many(np.stack([make_image(i) for i in range(4)]), timeout=5)
+    gate.set()
+    waiting.result(timeout=5)
+    queued.result(timeout=5)
+
+    # An idle batcher takes a batch larger than max_queue
+    predictions = batcher.predict_many(np.stack([make_image(i) for i in range(6)]), timeout=5)
+    batcher.close()
+    assert list(predictions[:, 0]) == [0, 1, 2, 3, 4, 5]
+    assert max(calls) <= 4
@@ -0,0 +1,195 @@
+import json
+
+import pytest
+
+from catalog import CatalogCache
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def collection():
+    collection = mongomock.MongoClient().db.snakes
+    collection.insert_many([
+        {"name": "Cobra", "description": "Hooded", "endemism": "Not Endemic"},
+        {"name": "Python", "description": "Constrictor", "endemism": "Not Endemic"},
+    ])
+    return collection
+
+
+# Test the catalog is read once and served from memory
+def test_catalog_is_cached(collection):
+    catalog = CatalogCache(collection)
+    snapshot = catalog.get()
+    assert catalog.get() is snapshot
+    assert catalog.loads == 1
+
+    snakes = json.loads(snapshot.snakes_body)['snakes']
+    assert {snake['name'] for snake in snakes} == {"Cobra", "Python"}
+    assert all(isinstance(snake['_id'], str) for snake in snakes)
+    assert json.loads(snapshot.list_body) == {"snakes": [{"name": "Cobra"}, {"name": "Python"}]}
+    assert snapshot.by_name["Cobra"]["description"] == "Hooded"
+
+
+# Test invalidation reloads the catalog and changes the ETag
+def test_invalidate(collection):
+    catalog = CatalogCache(collection)
+    before = catalog.get()
+
+    collection.insert_one({"name": "Rat snake"})
+    assert catalog.get() is before
+
+    catalog.invalidate()
+    after = catalog.get()
+    assert "Rat snake" in after.by_name
+    assert after.snakes_etag != before.snakes_etag
+    assert catalog.loads == 2
+
+
+# Test a load that overlaps an invalidation is not cached
+def test_invalidate_during_load(collection, monkeypatch):
+    catalog = CatalogCache(collection)
+    find = collection.find
+
+    def find_then_write(*args, **kwargs):
+        snakes = list(find(*args, **kwargs))
+        # A write lands after the collection was read
+        collection.insert_one({"name": "Rat snake"})
+        catalog.invalidate()
+        return snakes
+
+    monkeypatch.setattr(collection, "find", find_then_write)
+    assert "Rat snake" not in catalog.get().by_name
+    monkeypatch.setattr(collection, "find", find)
+    assert "Rat snake" in catalog.get().by_name
+    assert catalog.loads == 2
+
+
+# Test a snapshot older than max_age is reloaded
+def test_max_age(collection):
+    now = [0.0]
+    catalog = CatalogCache(collection, max_age=60, clock=lambda: now[0])
+    before = catalog.get()
+    collection.insert_one({"name": "Rat snake"})
+
+    now[0] = 59
+    assert catalog.get() is before
+    now[0] = 61
+    assert "Rat snake" in catalog.get().by_name
+    assert catalog.loads == 2
+
+
+# Test the change stream listener starts on first use in each process
+def test_change_stream_listener_per_process(collection, monkeypatch):
+    started = []
+    catalog = CatalogCache(collection, watch_changes=True)
+    monkeypatch.setattr(catalog, "_watch", lambda: started.append(True))
+
+    catalog.get()
+    catalog.get()
+    catalog._listener.join(5)
+    assert started == [True]
+
+    # A forked worker does not inherit the parent's thread, and starts its own
+    catalog._after_fork()
+    catalog.get()
+    catalog._listener.join(5)
+    assert started == [True, True]
+
+
+# Test the async cache watches the change stream from a task on the event loop
+def test_async_change_stream_listener():
+    import asyncio
+    from catalog import AsyncCatalogCache
+
+    class Collection:
+        def __init__(self):
+            self.names = ["Cobra"]
+            self.changed = None
+
+        async def find(self, query):
+            for name in list(self.names):
+                yield {"_id": name, "name": name}
+
+        def watch(self):
+            collection = self
+
+            class Stream:
+                async def __aenter__(self):
+                    return self
+
+                async def __aexit__(self, *exc):
+                    return False
+
+                def __aiter__(self):
+                    return self
+
+                async def __anext__(self):
+                    await collection.changed.wait()
+                    collection.changed.clear()
+                    return {"operationType": "insert"}
+
+            return Stream()
+
+    async def run():
+        collection = Collection()
+        collection.changed = asyncio.Event()
+        catalog = AsyncCatalogCache(collection, watch_changes=True)
+        assert list((await catalog.get()).by_name) == ["Cobra"]
+
+        collection.names.append("Python")
+        collection.changed.set()
+        for _ in range(100):
+            await asyncio.sleep(0)
+        assert list((await catalog.get()).by_name) == ["Cobra", "Python"]
+        catalog.close()
+
+    asyncio.run(run())
+
+
+# Test the last snapshot is served while the database fails, and the circuit opens
+def test_stale_catalog_served_when_database_fails(collection, monkeypatch):
+    from pymongo.errors import AutoReconnect
+    from database import CircuitBreaker, CircuitOpen
+
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    catalog = CatalogCache(collection, breaker=breaker)
+    before = catalog.get()
+
+    def unavailable(*args, **kwargs):
+        raise AutoReconnect("primary down")
+
+    monkeypatch.setattr(collection, "find", unavailable)
+    catalog.invalidate()
+    assert catalog.get() is before
+    assert catalog.get() is before
+    assert breaker.state == "open"
+    assert catalog.get() is before
+    assert catalog.stale_served == 3
+
+    # With nothing cached yet the error reaches the caller
+    with pytest.raises(CircuitOpen):
+        CatalogCache(collection, breaker=breaker).get()
+
+
+# Test a load cut short by the caller's own deadline does not open the circuit
+def test_spent_request_deadline_is_not_a_failure(collection, monkeypatch):
+    from pymongo.errors import ExecutionTimeout
+    from database import CircuitBreaker
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+    catalog = CatalogCache(collection, breaker=breaker, load_timeout=10)
+
+    def timed_out(*args, **kwargs):
+        raise ExecutionTimeout("operation exceeded time limit", 50)
+
+    monkeypatch.setattr(collection, "find", timed_out)
+    with pytest.raises(ExecutionTimeout):
+        catalog.get()
+    assert breaker.state == "closed"
+
+    # A load that used up its own load_timeout still counts
+    catalog.load_timeout = 1e-9
+    with pytest.raises(ExecutionTimeout):
+        catalog.get()
+    assert breaker.state == "open"
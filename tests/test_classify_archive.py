@@ -0,0 +1,114 @@
+import csv
+import io
+import os
+import tarfile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import classify_archive
+from model_runtime import class_list
+from postprocessing import PostProcessor
+
+
+class FakeRuntime:
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict(self, batch):
+        self.batch_sizes.append(len(batch))
+        probabilities = np.full((len(batch), len(class_list)), 0.1, dtype=np.float32)
+        probabilities[:, 0] = 0.4
+        return probabilities
+
+
+def jpeg_bytes(color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (300, 200), color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def make_images(directory, count):
+    os.makedirs(os.path.join(directory, "sub"), exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(directory, "sub" if i % 2 else "", f"{i:02d}.jpg"), "wb") as f:
+            f.write(jpeg_bytes((i * 20, 0, 0)))
+    with open(os.path.join(directory, "broken.jpg"), "wb") as f:
+        f.write(b"not an image")
+
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+# Test images are classified in fixed-size batches and recorded with their errors
+def test_classify_directory(tmp_path):
+    make_images(tmp_path / "images", 5)
+    output = classify_archive.CsvOutput(str(tmp_path / "out.csv"))
+    runtime = FakeRuntime()
+    count = classify_archive.classify(classify_archive.iter_images(str(tmp_path / "images")), runtime, output,
+                                      PostProcessor(class_list), batch_size=4)
+    output.close()
+
+    assert count == 6
+    assert runtime.batch_sizes == [4, 4]
+    rows = {row["name"]: row for row in read_rows(tmp_path / "out.csv")}
+    assert set(rows) == {"broken.jpg", "00.jpg", "02.jpg", "04.jpg", os.path.join("sub", "01.jpg"), os.path.join("sub", "03.jpg")}
+    assert rows["00.jpg"]["snake"] == class_list[0]
+    assert rows["broken.jpg"]["error"] and not rows["broken.jpg"]["snake"]
+
+
+# Test a second run only classifies what the first one did not finish
+def test_resume(tmp_path):
+    make_images(tmp_path / "images", 4)
+    path = str(tmp_path / "out.csv")
+    output = classify_archive.CsvOutput(path)
+    output.write([{"name": "00.jpg", "snake": "Cobra", "accuracy": 40.0, "uncertain": True, "error": None}])
+    output.close()
+    with open(path, "a") as f:
+        f.write("02.jpg,Cob")  # Cut short by a crash
+
+    output = classify_archive.CsvOutput(path)
+    assert output.done == {"00.jpg"}
+    count = classify_archive.classify(classify_archive.iter_images(str(tmp_path / "images")), FakeRuntime(), output,
+                                      PostProcessor(class_list), batch_size=2)
+    output.close()
+    assert count == 4
+    assert sorted(row["name"] for row in read_rows(path)) == sorted(
+        ["00.jpg", "02.jpg", "broken.jpg", os.path.join("sub", "01.jpg"), os.path.join("sub", "03.jpg")])
+
+
+# Test tar archives are read as a stream and decoded in worker processes
+def test_tar_with_workers(tmp_path):
+    path = tmp_path / "images.tar.gz"
+    with tarfile.open(path, "w:gz") as archive:
+        for i in range(3):
+            data = jpeg_bytes((0, i * 50, 0))
+            info = tarfile.TarInfo(f"photos/{i}.jpg")
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    names = [name for name, _ in classify_archive.iter_images(str(path))]
+    assert names == ["photos/0.jpg", "photos/1.jpg", "photos/2.jpg"]
+    results = list(classify_archive.decoded(classify_archive.iter_images(str(path)), workers=2, prefetch=2))
+    assert [name for name, _, _ in results] == names
+    assert all(pixels.shape == (224, 224, 3) and error is None for _, pixels, error in results)
+
+
+# Test Parquet output is written as one complete file per batch and read back on resume
+def test_parquet_output(tmp_path):
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "out.parquet")
+    output = classify_archive.open_output(path)
+    rows = [{"name": f"{i}.jpg", "snake": "Cobra", "accuracy": 50.0, "uncertain": False, "error": None}
+            for i in range(3)]
+    output.write(rows[:2])
+    # Written before close, so a crash here keeps the first batch
+    assert sorted(os.listdir(path)) == ["part-00000.parquet"]
+    output.write(rows[2:])
+    output.write([])
+    output.close()
+    assert sorted(os.listdir(path)) == ["part-00000.parquet", "part-00001.parquet"]
+    assert classify_archive.open_output(path).done == {"0.jpg", "1.jpg", "2.jpg"}
@@ -0,0 +1,74 @@
+import pytest
+from pymongo import _csot
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+from database import CircuitBreaker, CircuitOpen, client_options, read_preference, request_deadline
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# Test Pool And Timeout Settings Come From The Environment
+def test_client_options(monkeypatch):
+    monkeypatch.setenv('MONGO_MAX_POOL_SIZE', '20')
+    monkeypatch.setenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', '250')
+    monkeypatch.setenv('MONGO_SOCKET_TIMEOUT_MS', '0')
+    options = client_options()
+    assert options['maxPoolSize'] == 20
+    assert options['waitQueueTimeoutMS'] == 250
+    assert 'socketTimeoutMS' not in options
+    assert options['retryReads'] is True
+
+# Test Read Preferences By Name
+def test_read_preference():
+    assert read_preference('primary') == Primary()
+    assert read_preference('secondaryPreferred', 120) == SecondaryPreferred(max_staleness=120)
+    with pytest.raises(ValueError):
+        read_preference('fastest')
+
+# Test The Request Deadline Is Applied To PyMongo Operations
+def test_request_deadline():
+    with request_deadline(2.5):
+        assert _csot.get_timeout() == 2.5
+        with request_deadline(10):
+            assert _csot.remaining() <= 2.5
+    with request_deadline(0):
+        assert _csot.get_timeout() is None
+
+# Test The Circuit Opens After Repeated Failures And Closes After A Good Trial
+def test_circuit_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=10, clock=clock)
+
+    def fail():
+        raise RuntimeError("down")
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            breaker.call(fail)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen):
+        breaker.call(lambda: "never called")
+
+    clock.now = 10
+    assert breaker.state == "half-open"
+    with pytest.raises(RuntimeError):
+        breaker.call(fail)
+    assert breaker.state == "open"
+
+    clock.now = 20
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.stats() == {"state": "closed", "consecutive_failures": 0, "opened": 2, "rejected": 1}
+
+# Test Slow Calls Count As Failures
+def test_circuit_breaker_slow_calls():
+    breaker = CircuitBreaker(failure_threshold=1, slow_call_seconds=0.5)
+    breaker.record(elapsed=0.1)
+    assert breaker.state == "closed"
+    breaker.record(elapsed=0.8)
+    assert breaker.state == "open"
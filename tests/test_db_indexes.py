@@ -0,0 +1,61 @@
+import pytest
+
+from db_indexes import check_query_plans, ensure_indexes, find_collscans
+
+mongomock = pytest.importorskip("mongomock")
+from pymongo.errors import DuplicateKeyError
+
+
+# Test the unique indexes reject duplicates
+def test_ensure_indexes_enforces_uniqueness():
+    db = mongomock.MongoClient().db
+    ensure_indexes(db)
+    ensure_indexes(db)  # Running it again is harmless
+
+    db.users.insert_one({"email": "test@test.com"})
+    with pytest.raises(DuplicateKeyError):
+        db.users.insert_one({"email": "test@test.com"})
+
+    db.snakes.insert_one({"name": "Cobra"})
+    with pytest.raises(DuplicateKeyError):
+        db.snakes.insert_one({"name": "Cobra"})
+
+
+# Test existing duplicates stop startup instead of leaving duplicates unchecked
+def test_ensure_indexes_fails_on_duplicates():
+    from pymongo.errors import PyMongoError
+
+    db = mongomock.MongoClient().db
+    db.users.insert_many([{"email": "test@test.com"}, {"email": "test@test.com"}])
+    with pytest.raises(PyMongoError):
+        ensure_indexes(db)
+
+
+# Test collection scans are found anywhere in a query plan
+def test_find_collscans():
+    index_plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "email_unique"}}
+    scan_plan = {"stage": "SUBPLAN", "inputStage": {"stage": "OR", "inputStages": [index_plan, {"stage": "COLLSCAN"}]}}
+
+    assert find_collscans(index_plan) == []
+    assert find_collscans(scan_plan) == [{"stage": "COLLSCAN"}]
+
+    # Plans the query planner rejected are not what the route runs
+    assert find_collscans({"queryPlanner": {"winningPlan": index_plan, "rejectedPlans": [{"stage": "COLLSCAN"}]}}) == []
+
+
+# Test the history aggregate is explained as an aggregate, not as a find
+def test_check_query_plans_explains_aggregates():
+    commands = []
+
+    class Database:
+        def command(self, name, command, verbosity):
+            commands.append(command)
+            plan = {"stage": "COLLSCAN"} if "snakes" in command.values() else {"stage": "IXSCAN"}
+            return {"queryPlanner": {"winningPlan": plan}}
+
+    failures = check_query_plans(Database())
+    assert "DELETE /deletesnake/<name>" in failures
+    assert not any("predictions" in route for route in failures)
+    aggregates = [command for command in commands if "aggregate" in command]
+    assert [command["aggregate"] for command in aggregates] == ["users"]
+    assert "_id" in aggregates[0]["pipeline"][0]["$match"]
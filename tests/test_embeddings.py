@@ -0,0 +1,98 @@
+import numpy as np
+
+from embeddings import EmbeddingPipeline, EmbeddingStore, normalize
+
+NUM_CLASSES = 3
+
+
+class FakeExtractor:
+    """Embeds an image as its mean pixel per channel; the head counts its calls."""
+
+    def __init__(self):
+        self.classified = 0
+
+    def embed(self, batch):
+        return np.asarray(batch).mean(axis=(1, 2))
+
+    def classify(self, embeddings):
+        self.classified += len(embeddings)
+        return np.tile([0.2, 0.7, 0.1], (len(embeddings), 1))
+
+
+def make_pipeline(tmp_path, **kwargs):
+    pipeline = EmbeddingPipeline(None, EmbeddingStore(str(tmp_path), NUM_CLASSES, **kwargs))
+    pipeline._extractor = FakeExtractor()
+    return pipeline
+
+
+def add_random(store, count, dim=16, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(count, dim))
+    store.add(vectors, np.full((count, NUM_CLASSES), 1 / NUM_CLASSES), [{"n": i} for i in range(count)])
+    return normalize(vectors)
+
+
+# Test brute-force search returns the nearest stored vectors
+def test_store_search(tmp_path):
+    store = EmbeddingStore(str(tmp_path), NUM_CLASSES)
+    vectors = add_random(store, 100)
+
+    positions, similarities = store.search(vectors[[3, 42]], k=3)
+    assert positions[:, 0].tolist() == [3, 42]
+    np.testing.assert_allclose(similarities[:, 0], 1.0, atol=1e-3)
+    assert (np.diff(similarities, axis=1) <= 0).all()
+    assert store.items([42]) == [{"n": 42, "id": 42}]
+
+    # Fewer stored vectors than k
+    positions, similarities = EmbeddingStore(str(tmp_path / "empty"), NUM_CLASSES).search(vectors[:1], k=2)
+    assert positions.tolist() == [[-1, -1]]
+
+
+# Test another store on the same directory sees the appended vectors
+def test_store_is_shared_on_disk(tmp_path):
+    add_random(EmbeddingStore(str(tmp_path), NUM_CLASSES), 10)
+    reader = EmbeddingStore(str(tmp_path), NUM_CLASSES)
+    assert len(reader) == 10
+    add_random(EmbeddingStore(str(tmp_path), NUM_CLASSES), 5, seed=1)
+    assert len(reader) == 15
+    assert reader.stats()["dim"] == 16
+
+
+# Test the IVF index finds the same neighbours as brute force
+def test_store_ivf_search(tmp_path):
+    store = EmbeddingStore(str(tmp_path), NUM_CLASSES, ivf_min_items=500, nprobe=4)
+    # Clustered data, as image embeddings are
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(10, 16)) * 5
+    vectors = centers[rng.integers(0, 10, 2000)] + rng.normal(size=(2000, 16))
+    store.add(vectors, np.zeros((2000, NUM_CLASSES)), [{}] * 2000)
+
+    queries = vectors[:50] + rng.normal(size=(50, 16)) * 0.1
+    positions, _ = store.search(queries, k=1)
+    assert store.stats()["index"] == "ivf"
+    assert (positions[:, 0] == np.arange(50)).mean() >= 0.9
+
+    # Vectors added after training are found too
+    store.add(vectors[:1] * 2 + 1, np.zeros((1, NUM_CLASSES)), [{}])
+    positions, _ = store.search(vectors[:1] * 2 + 1, k=1)
+    assert positions[0, 0] == 2000
+
+
+# Test near-identical images reuse the stored prediction instead of the head
+def test_pipeline_dedupe(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    images = np.zeros((2, 8, 8, 3), dtype=np.float32)
+    images[0, ..., 0] = 1  # Red
+    images[1, ..., 2] = 1  # Blue
+
+    rows = pipeline.predict(images)
+    probabilities, embeddings, duplicate = pipeline.split(rows)
+    assert probabilities.shape == (2, NUM_CLASSES)
+    assert embeddings.shape == (2, 3)
+    assert not duplicate.any()
+    pipeline.store.add(embeddings[:1], [[0.9, 0.05, 0.05]], [{"snake": "Cobra"}])
+
+    probabilities, _, duplicate = pipeline.split(pipeline.predict(images))
+    assert duplicate.tolist() == [True, False]
+    np.testing.assert_allclose(probabilities[0], [0.9, 0.05, 0.05], atol=1e-3)
+    assert pipeline._extractor.classified == 3
+    assert pipeline.stats()["deduplicated"] == 1
@@ -0,0 +1,152 @@
+import time
+
+import pytest
+
+import history
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def users():
+    return mongomock.MongoClient().db.users
+
+
+def add_user(users, timestamps):
+    predictions = [{"snake": "Cobra", "accuracy": 90.0, "timestamp": ts} for ts in timestamps]
+    return users.insert_one({"email": "test@test.com", "password": "hash", "recent_predictions": predictions}).inserted_id
+
+
+def read_all(users, user_id, limit):
+    pages, cursor = [], None
+    while True:
+        page = list(users.aggregate(history.records_pipeline(str(user_id), limit, cursor)))
+        pages.append(page[:limit])
+        cursor = history.next_cursor(page, limit, cursor)
+        if cursor is None:
+            return pages
+
+
+# Test the history is capped at the newest records
+def test_push_update_keeps_newest(users):
+    user_id = add_user(users, [])
+    for i in range(5):
+        users.update_one({"_id": user_id}, history.push_update([{"timestamp": str(i)}], 3))
+    predictions = users.find_one({"_id": user_id})['recent_predictions']
+    assert [p['timestamp'] for p in predictions] == ['2', '3', '4']
+
+
+# Test paging through the history returns every record once, newest first
+def test_pages_cover_history(users):
+    timestamps = ['2024-01-01T00:00:0%d' % i for i in range(7)]
+    user_id = add_user(users, timestamps)
+
+    pages = read_all(users, user_id, 3)
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [p['timestamp'] for page in pages for p in page] == timestamps[::-1]
+
+
+# Test records written out of order are still paged by timestamp
+def test_pages_sorted_by_timestamp(users):
+    user_id = add_user(users, ['b', 'd'])
+    users.update_one({"_id": user_id}, history.push_update([{"timestamp": "c"}, {"timestamp": "a"}], 10))
+    assert [p['timestamp'] for p in users.find_one({"_id": user_id})['recent_predictions']] == ['a', 'b', 'c', 'd']
+
+    users.update_one({"_id": user_id}, {"$push": {"recent_predictions": {"timestamp": "0"}}})
+    pages = read_all(users, user_id, 2)
+    assert [p['timestamp'] for page in pages for p in page] == ['d', 'c', 'b', 'a', '0']
+
+
+# Test records sharing a timestamp are not skipped at page boundaries
+def test_pages_with_equal_timestamps(users):
+    timestamps = ['a', 'b', 'b', 'b', 'b', 'c']
+    user_id = add_user(users, timestamps)
+
+    pages = read_all(users, user_id, 2)
+    assert [p['timestamp'] for page in pages for p in page] == timestamps[::-1]
+
+
+# Test the page never includes the password
+def test_page_excludes_password(users):
+    user_id = add_user(users, ['a'])
+    records = list(users.aggregate(history.records_pipeline(str(user_id), 10)))
+    assert [set(record) for record in records] == [{'snake', 'accuracy', 'timestamp'}]
+
+
+# Test malformed cursors are rejected
+def test_invalid_cursor():
+    with pytest.raises(ValueError):
+        history.decode_cursor('not a cursor')
+
+
+# Test queued records are grouped into one bulk write
+def test_history_writer_batches_writes(users):
+    first = add_user(users, [])
+    second = users.insert_one({"email": "other@test.com", "recent_predictions": []}).inserted_id
+
+    writer = history.HistoryWriter(users, limit=10, batch_size=100, flush_interval=60)
+    for i in range(3):
+        writer.enqueue(str(first), [{"timestamp": str(i)}])
+    writer.enqueue(str(second), [{"timestamp": "x"}, {"timestamp": "y"}])
+    assert writer.has_pending(str(first))
+
+    assert writer.flush(timeout=5)
+    assert not writer.has_pending(str(first))
+    assert [p['timestamp'] for p in users.find_one({"_id": first})['recent_predictions']] == ['0', '1', '2']
+    assert len(users.find_one({"_id": second})['recent_predictions']) == 2
+
+    stats = writer.stats()
+    assert stats['written'] == 5
+    assert stats['flushes'] == 1
+    writer.close()
+
+
+# Test records are flushed on their own after the flush interval
+def test_history_writer_flushes_on_interval(users):
+    user_id = add_user(users, [])
+    writer = history.HistoryWriter(users, flush_interval=0.01)
+    writer.enqueue(str(user_id), [{"timestamp": "a"}])
+    for _ in range(100):
+        if writer.stats()['written']:
+            break
+        time.sleep(0.01)
+    assert writer.stats()['written'] == 1
+    writer.close()
+
+
+# Test records are dropped, not blocked on, when the queue is full
+def test_history_writer_drops_when_full(users):
+    user_id = add_user(users, [])
+    writer = history.HistoryWriter(users, max_queue=1)
+    writer._start = lambda: None  # Keep the writer thread from draining the queue
+
+    assert writer.enqueue(str(user_id), [{"timestamp": "a"}])
+    assert not writer.enqueue(str(user_id), [{"timestamp": "b"}])
+    assert writer.stats()['dropped'] == 1
+
+
+# Test the queue limit counts records, not enqueue calls
+def test_history_writer_limit_counts_records(users):
+    user_id = add_user(users, [])
+    writer = history.HistoryWriter(users, max_queue=3)
+    writer._start = lambda: None
+
+    assert not writer.enqueue(str(user_id), [{"timestamp": t} for t in "abcd"])
+    assert writer.enqueue(str(user_id), [{"timestamp": t} for t in "abc"])
+    assert not writer.enqueue(str(user_id), [{"timestamp": "d"}])
+    assert writer.stats()['queue_depth'] == 3
+    assert writer.stats()['dropped'] == 5
+
+
+# Test closing the writer writes out the queue
+def test_history_writer_close_flushes(users):
+    user_id = add_user(users, [])
+    writer = history.HistoryWriter(users, flush_interval=60)
+    writer.enqueue(str(user_id), [{"timestamp": "a"}])
+    writer.close()
+    assert len(users.find_one({"_id": user_id})['recent_predictions']) == 1
+
+    # A closed writer starts again on the next record
+    writer.enqueue(str(user_id), [{"timestamp": "b"}])
+    writer.close()
+    assert len(users.find_one({"_id": user_id})['recent_predictions']) == 2
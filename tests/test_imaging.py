@@ -0,0 +1,40 @@
+import numpy as np
+from keras.preprocessing import image
+from keras.applications.mobilenet import preprocess_input
+
+from imaging import decode_image, get_buffer, UploadArchiver
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# Test decoding straight from upload bytes
+def test_decode_image_shape_and_range():
+    img_array = decode_image(read_bytes('tests/test_image.jpg'))
+    assert img_array.shape == (224, 224, 3)
+    assert img_array.dtype == np.float32
+    assert img_array.min() >= -1.0 and img_array.max() <= 1.0
+
+
+# Test that the in-memory path stays close to the old load_img path
+def test_decode_image_matches_load_img():
+    expected = preprocess_input(image.img_to_array(image.load_img('tests/test_image1.jpg', target_size=(224, 224))))
+    img_array = decode_image(read_bytes('tests/test_image1.jpg'), out=np.empty((224, 224, 3), dtype=np.float32))
+    assert np.abs(img_array - expected).mean() < 0.15
+
+
+# Test that the per-thread buffer is reused between calls
+def test_decode_image_reuses_buffer():
+    first = decode_image(read_bytes('tests/test_image.jpg'))
+    second = decode_image(read_bytes('tests/test_image1.jpg'))
+    assert first is second is get_buffer()
+
+
+# Test opt-in upload archival
+def test_upload_archiver_writes_file(tmp_path):
+    archiver = UploadArchiver(str(tmp_path))
+    filename = archiver.archive(b'image bytes')
+    archiver.close()
+    assert (tmp_path / filename).read_bytes() == b'image bytes'
@@ -0,0 +1,148 @@
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import numpy as np
+import pytest
+
+from batching import InferenceBusy
+from inference_pool import InferencePool
+from model_runtime import class_list
+
+
+class EchoRuntime:
+    """Returns each image's first pixel value in every column."""
+
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.batch_sizes = []
+
+    def predict(self, batch):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.batch_sizes.append(len(batch))
+        return np.repeat(batch[:, 0, 0, :1], len(class_list), axis=1)
+
+
+def make_image(value):
+    return np.full((224, 224, 3), value, dtype=np.float32)
+
+
+# Test that each request gets its own result back
+def test_local_pool_routes_results():
+    pool = InferencePool(local=True, runtime_factory=EchoRuntime, num_workers=2, max_queue=8)
+    futures = [pool.submit(make_image(i)) for i in range(8)]
+    results = [future.result(timeout=5) for future in futures]
+    pool.close()
+
+    for i, result in enumerate(results):
+        assert result.shape == (len(class_list),)
+        assert result[0] == i
+    assert pool.stats()['completed'] == 8
+
+
+# Test that queued images are batched by the worker
+def test_local_pool_batches_queued_images():
+    gate = threading.Event()
+    runtime = EchoRuntime(gate)
+    pool = InferencePool(local=True, runtime_factory=lambda: runtime, num_workers=1, max_queue=8, max_batch_size=4)
+
+    futures = [pool.submit(make_image(i)) for i in range(5)]
+    gate.set()
+    for future in futures:
+        future.result(timeout=5)
+    pool.close()
+
+    assert sum(runtime.batch_sizes) == 5
+    assert max(runtime.batch_sizes) <= 4
+    assert len(runtime.batch_sizes) < 5
+
+
+# Test that a full queue is rejected instead of waiting
+def test_local_pool_backpressure():
+    gate = threading.Event()
+    pool = InferencePool(local=True, runtime_factory=lambda: EchoRuntime(gate), num_workers=1, max_queue=2)
+
+    futures = [pool.submit(make_image(i)) for i in range(2)]
+    with pytest.raises(InferenceBusy):
+        pool.submit(make_image(3))
+    assert pool.stats()['rejected'] == 1
+
+    # Slots are released once the work completes
+    gate.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert pool.predict(make_image(4), timeout=5)[0] == 4
+    pool.close()
+
+
+# Test that a whole batch can be submitted at once
+def test_local_pool_predict_many():
+    pool = InferencePool(local=True, runtime_factory=EchoRuntime, max_queue=4)
+    predictions = pool.predict_many(np.stack([make_image(i) for i in range(3)]), timeout=5)
+    pool.close()
+    assert list(predictions[:, 0]) == [0, 1, 2]
+
+
+# Test that a caller giving up cannot cancel a slot the workers still complete
+def test_local_pool_survives_abandoned_request():
+    gate = threading.Event()
+    pool = InferencePool(local=True, runtime_factory=lambda: EchoRuntime(gate), num_workers=1, max_queue=2)
+
+    abandoned = pool.submit(make_image(1))
+    assert not abandoned.cancel()
+    gate.set()
+    assert pool.predict(make_image(2), timeout=5)[0] == 2
+    assert abandoned.result(timeout=5)[0] == 1
+    pool.close()
+
+
+# Test a batch larger than the queue is sent in parts instead of rejected
+def test_local_pool_predict_many_larger_than_queue():
+    pool = InferencePool(local=True, runtime_factory=EchoRuntime, max_queue=2)
+    predictions = pool.predict_many(np.stack([make_image(i) for i in range(5)]), timeout=5)
+    pool.close()
+    assert list(predictions[:, 0]) == [0, 1, 2, 3, 4]
+    assert pool.stats()['rejected'] == 0
+
+
+class WorkerDied(BaseException):
+    """Ends a local worker thread the way a crash ends a worker process."""
+
+
+# Test a dead worker's requests fail, their slots are freed and the worker is replaced
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_local_pool_replaces_dead_worker():
+    runtimes = []
+
+    def factory():
+        runtime = EchoRuntime()
+        if not runtimes:
+            def crash(batch):
+                raise WorkerDied()
+            runtime.predict = crash
+        runtimes.append(runtime)
+        return runtime
+
+    pool = InferencePool(local=True, runtime_factory=factory, num_workers=1, max_queue=1)
+    pool.health_interval = 0.05
+    with pytest.raises(RuntimeError):
+        pool.predict(make_image(1), timeout=5)
+    assert pool.predict(make_image(2), timeout=5)[0] == 2
+    assert pool.stats()['restarted_workers'] == 1
+    pool.close()
+
+
+# Test a slot whose worker never answers is failed and freed, and its late result is dropped
+def test_local_pool_reclaims_stale_slot():
+    gate = threading.Event()
+    pool = InferencePool(local=True, runtime_factory=lambda: EchoRuntime(gate), num_workers=1, max_queue=1,
+                         max_in_flight=0.1)
+    pool.health_interval = 0.05
+    with pytest.raises(FutureTimeoutError):
+        pool.predict(make_image(1), timeout=5)
+    assert pool.stats()['reclaimed_slots'] == 1
+
+    fresh = pool.submit(make_image(2))
+    gate.set()
+    assert fresh.result(timeout=5)[0] == 2
+    pool.close()
@@ -0,0 +1,76 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from metrics import Histogram, Registry, CommandMetrics, stage, start_request_timings, server_timing, STAGE_SECONDS
+from profiler import SamplingProfiler
+
+# Test Histogram Buckets Are Cumulative In The Text Format
+def test_histogram_render():
+    histogram = Histogram("test_seconds", "Test.", ("stage",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "decode")
+    histogram.observe(0.5, "decode")
+    histogram.observe(5, "decode")
+
+    lines = histogram.render()
+    assert 'test_seconds_bucket{stage="decode",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="decode",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{stage="decode",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="decode"} 5.55' in lines
+    assert 'test_seconds_count{stage="decode"} 3' in lines
+
+# Test Registry Output, Gauges And Reset
+def test_registry_render_and_reset():
+    registry = Registry()
+    histogram = registry.histogram("test_seconds", "Test.")
+    registry.gauge("test_depth", "Queue depth.", lambda: {("a",): 3, ("b",): None}, ("queue",))
+    registry.gauge("test_broken", "Raises.", lambda: 1 / 0)
+    histogram.observe(0.2)
+
+    text = registry.render()
+    assert "# TYPE test_seconds histogram" in text
+    assert "test_seconds_count 1" in text
+    assert 'test_depth{queue="a"} 3' in text
+    assert 'queue="b"' not in text
+    assert "# TYPE test_broken gauge" in text
+
+    registry.reset()
+    assert histogram.count() == 0
+
+# Test Stages Are Recorded In The Histogram And The Request Timings
+def test_stage_timings():
+    before = STAGE_SECONDS.count("test-stage")
+    timings = start_request_timings()
+    with stage("test-stage"):
+        time.sleep(0.01)
+    assert STAGE_SECONDS.count("test-stage") == before + 1
+    assert timings["test-stage"] >= 0.01
+    assert server_timing({"decode": 0.0012}) == "decode;dur=1.20"
+
+# Test MongoDB Command Latency Is Recorded Per Collection
+def test_command_metrics():
+    histogram = Histogram("test_command_seconds", "Test.", ("command", "collection", "outcome"))
+    listener = CommandMetrics(histogram)
+    listener.started(SimpleNamespace(command_name="find", command={"find": "users"}, connection_id=1, request_id=7))
+    listener.started(SimpleNamespace(command_name="getMore", command={"getMore": 123, "collection": "snakes"},
+                                     connection_id=1, request_id=8))
+    listener.succeeded(SimpleNamespace(command_name="find", connection_id=1, request_id=7, duration_micros=1500))
+    listener.failed(SimpleNamespace(command_name="getMore", connection_id=1, request_id=8, duration_micros=200))
+
+    assert histogram.count("find", "users", "ok") == 1
+    assert histogram.count("getMore", "snakes", "error") == 1
+
+# Test The Sampling Profiler Sees The Profiled Thread's Stack
+def test_sampling_profiler():
+    def busy_loop():
+        deadline = time.perf_counter() + 0.1
+        while time.perf_counter() < deadline:
+            pass
+
+    profiler = SamplingProfiler(threading.get_ident(), interval=0.001).start()
+    busy_loop()
+    profiler.stop()
+
+    assert profiler.samples > 0
+    assert "busy_loop" in profiler.collapsed()
+    assert profiler.top(1)[0][0].startswith("busy_loop")
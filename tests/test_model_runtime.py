@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pytest
+
+from imaging import decode_image
+from model_runtime import load_runtime, warm_up, class_list, DEFAULT_MODEL_PATH, RUNTIMES, LazyRuntime
+
+requires_model = pytest.mark.skipif(not os.path.exists(DEFAULT_MODEL_PATH), reason="mobilenet-ft.h5 not available")
+
+TEST_IMAGES = ['tests/test_image.jpg', 'tests/test_image1.jpg']
+
+
+def load_batch():
+    batch = np.empty((len(TEST_IMAGES), 224, 224, 3), dtype=np.float32)
+    for i, path in enumerate(TEST_IMAGES):
+        with open(path, 'rb') as f:
+            decode_image(f.read(), out=batch[i])
+    return batch
+
+
+@pytest.fixture(scope='module')
+def keras_top1():
+    runtime = load_runtime('keras')
+    return np.argmax(runtime.predict(load_batch()), axis=1)
+
+
+@pytest.fixture(scope='module')
+def tflite_exports(tmp_path_factory):
+    pytest.importorskip("tensorflow")
+    from keras.models import load_model
+    from export_model import export_tflite
+
+    keras_model = load_model(DEFAULT_MODEL_PATH)
+    directory = tmp_path_factory.mktemp('exports')
+    exports = {}
+    for quantize in ('none', 'float16', 'int8'):
+        exports[quantize] = str(directory / f'model-{quantize}.tflite')
+        export_tflite(keras_model, exports[quantize], quantize=quantize, calibration_dir='tests')
+    return exports
+
+
+# Test the compiled tf.function backend agrees with plain Keras
+@requires_model
+def test_tf_function_matches_keras(keras_top1):
+    runtime = load_runtime('tf-function')
+    warm_up(runtime)
+    predictions = runtime.predict(load_batch())
+    assert predictions.shape == (len(TEST_IMAGES), len(class_list))
+    assert list(np.argmax(predictions, axis=1)) == list(keras_top1)
+
+
+# Test every TFLite export agrees with plain Keras
+@requires_model
+@pytest.mark.parametrize('quantize', ['none', 'float16', 'int8'])
+def test_tflite_matches_keras(keras_top1, tflite_exports, quantize):
+    runtime = load_runtime('tflite', tflite_exports[quantize])
+    warm_up(runtime, (1, 4))
+    predictions = runtime.predict(load_batch())
+    assert predictions.shape == (len(TEST_IMAGES), len(class_list))
+    assert list(np.argmax(predictions, axis=1)) == list(keras_top1)
+
+
+# Test unknown backends are rejected
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        load_runtime('caffe')
+
+
+class FakeRuntime:
+    loads = 0
+
+    def __init__(self, path):
+        FakeRuntime.loads += 1
+        self.calls = []
+
+    def predict(self, batch):
+        self.calls.append(len(batch))
+        return np.zeros((len(batch), len(class_list)))
+
+
+# Test the lazy runtime loads once, on first use, and warms up
+def test_lazy_runtime_loads_on_first_use(monkeypatch):
+    monkeypatch.setitem(RUNTIMES, 'fake', FakeRuntime)
+    FakeRuntime.loads = 0
+
+    runtime = LazyRuntime('fake', 'model.fake', warmup_batch_sizes=(1, 8))
+    assert not runtime.loaded
+    assert FakeRuntime.loads == 0
+
+    runtime.predict(np.zeros((2, 224, 224, 3)))
+    runtime.predict(np.zeros((3, 224, 224, 3)))
+    assert runtime.loaded
+    assert FakeRuntime.loads == 1
+    assert runtime.load().calls == [1, 8, 2, 3]
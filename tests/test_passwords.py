@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from passwords import PasswordHasher, AuthBusy, hash_rounds
+
+
+# Test hashing and checking a password
+def test_hash_and_check():
+    hasher = PasswordHasher(rounds=4)
+    hashed = hasher.hash("password123")
+
+    assert hash_rounds(hashed) == 4
+    assert hasher.check(hashed, "password123")
+    assert not hasher.check(hashed, "wrong")
+    assert not hasher.check("not a bcrypt hash", "password123")
+    assert hasher.stats()["hashed"] == 1
+    assert hasher.stats()["checked"] == 3
+
+
+# Test hashes made with another cost factor need a rehash
+def test_needs_rehash():
+    old = PasswordHasher(rounds=4).hash("password123")
+    hasher = PasswordHasher(rounds=5)
+    assert hasher.needs_rehash(old)
+    assert not hasher.needs_rehash(hasher.hash("password123"))
+
+    # The old hash still verifies
+    assert hasher.check(old, "password123")
+
+
+# Test the rehash is handed to the callback
+def test_rehash_in_background():
+    hasher = PasswordHasher(rounds=4)
+    stored = []
+    done = threading.Event()
+
+    def on_done(hashed):
+        stored.append(hashed)
+        done.set()
+
+    hasher.rehash_in_background("password123", on_done)
+    assert done.wait(5)
+    assert hasher.check(stored[0], "password123")
+
+
+# Test requests beyond max_pending are rejected
+def test_admission_control():
+    hasher = PasswordHasher(rounds=4, max_workers=1, max_pending=2)
+    gate = threading.Event()
+    futures = [hasher.submit(gate.wait, 5) for _ in range(2)]
+
+    with pytest.raises(AuthBusy):
+        hasher.submit_hash("password123")
+    assert hasher.stats()["rejected"] == 1
+
+    gate.set()
+    for future in futures:
+        future.result(timeout=5)
+    # Capacity is given back once the hashes finish
+    assert hasher.check(hasher.hash("password123"), "password123")
+    assert hasher.stats()["pending"] == 0
@@ -0,0 +1,65 @@
+import numpy as np
+
+from postprocessing import (PostProcessor, apply_temperature, expected_calibration_error, fit_temperature,
+                            negative_log_likelihood, top_k)
+
+CLASSES = ["Cobra", "Common Krait", "Python"]
+
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+# Test temperature scaling matches scaling the logits
+def test_apply_temperature():
+    logits = np.array([[2.0, 1.0, 0.1], [0.5, 0.4, 3.0]])
+    np.testing.assert_allclose(apply_temperature(softmax(logits), 2.0), softmax(logits / 2.0), rtol=1e-6)
+    np.testing.assert_allclose(apply_temperature(softmax(logits), 1.0), softmax(logits))
+
+
+# Test top-k ranks each row, most likely first
+def test_top_k():
+    probabilities = np.array([[0.1, 0.6, 0.3], [0.5, 0.2, 0.3]])
+    indices, values = top_k(probabilities, 2)
+    assert indices.tolist() == [[1, 2], [0, 2]]
+    np.testing.assert_allclose(values, [[0.6, 0.3], [0.5, 0.3]])
+
+    # k is clamped to the number of classes
+    assert top_k(probabilities, 10)[0].shape == (2, 3)
+
+
+# Test fitting recovers the temperature of over-confident predictions
+def test_fit_temperature():
+    rng = np.random.default_rng(0)
+    logits = rng.normal(size=(2000, 3)) * 2
+    labels = np.array([rng.choice(3, p=p) for p in softmax(logits)])
+
+    # The model reports logits three times too sharp
+    overconfident = softmax(logits * 3)
+    temperature = fit_temperature(overconfident, labels)
+    assert 2.5 < temperature < 3.5
+
+    calibrated = apply_temperature(overconfident, temperature)
+    assert negative_log_likelihood(calibrated, labels) < negative_log_likelihood(overconfident, labels)
+    assert expected_calibration_error(calibrated, labels) < expected_calibration_error(overconfident, labels)
+
+
+# Test results for a batch, with catalog details and the uncertain flag
+def test_post_processor():
+    postprocessor = PostProcessor(CLASSES, uncertain_threshold=0.5)
+    lookup = {"Common Krait": {"name": "Common Krait", "endemism": "Asia"}}
+    results = postprocessor([[0.1, 0.8, 0.1], [0.4, 0.35, 0.25]], k=2, lookup=lookup)
+
+    assert results[0]["snake"] == "Common Krait"
+    assert results[0]["accuracy"] == 80.0
+    assert not results[0]["uncertain"]
+    assert results[0]["top_k"][0] == {"snake": "Common Krait", "probability": 0.8, "details": lookup["Common Krait"]}
+    assert results[0]["top_k"][1]["details"] is None
+
+    assert results[1]["snake"] == "Cobra"
+    assert results[1]["uncertain"]
+    assert [entry["snake"] for entry in results[1]["top_k"]] == ["Cobra", "Common Krait"]
+
+    # Each row comes out the same as when processed on its own
+    assert postprocessor([[0.4, 0.35, 0.25]], k=2, lookup=lookup)[0] == results[1]
@@ -0,0 +1,71 @@
+import time
+
+import numpy as np
+
+from prediction_cache import PredictionCache, key_for_bytes, key_for_array
+
+
+class DictBackend:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, probabilities, ttl):
+        self.data[key] = probabilities
+
+
+PROBS = [0.1, 0.1, 0.1, 0.1, 0.5, 0.1, 0.1]
+
+
+# Test hits and misses are counted
+def test_get_and_set():
+    cache = PredictionCache(max_entries=4)
+    key = key_for_bytes(b'photo')
+    assert cache.get(key) is None
+    cache.set(key, PROBS)
+    assert np.allclose(cache.get(key), PROBS)
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+
+# Test the least recently used entry is evicted first
+def test_lru_eviction():
+    cache = PredictionCache(max_entries=2)
+    cache.set('a', PROBS)
+    cache.set('b', PROBS)
+    cache.get('a')
+    cache.set('c', PROBS)
+
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.stats()['evictions'] == 1
+
+
+# Test entries expire after the TTL
+def test_ttl_expiry():
+    cache = PredictionCache(max_entries=2, ttl_seconds=0.01)
+    cache.set('a', PROBS)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+
+# Test a shared backend fills local misses
+def test_shared_backend():
+    backend = DictBackend()
+    PredictionCache(backend=backend).set('a', PROBS)
+
+    other_worker = PredictionCache(backend=backend)
+    assert np.allclose(other_worker.get('a'), PROBS)
+    assert other_worker.stats()['backend_hits'] == 1
+
+
+# Test the keys depend on content only
+def test_keys():
+    assert key_for_bytes(b'same') == key_for_bytes(b'same')
+    assert key_for_bytes(b'same') != key_for_bytes(b'other')
+    assert key_for_array(np.zeros((2, 2))) == key_for_array(np.zeros((2, 2)))
@@ -0,0 +1,56 @@
+import json
+from datetime import datetime
+
+import numpy as np
+import pytest
+from bson import ObjectId
+
+import streaming
+
+
+# Test ObjectIds, datetimes and numpy values are encoded, with and without orjson
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(streaming, "orjson", None)
+    elif streaming.orjson is None:
+        pytest.skip("orjson is not installed")
+    oid = ObjectId()
+    body = streaming.dumps({"b": oid, "a": datetime(2024, 1, 2, 3, 4, 5), "c": np.float32(0.5),
+                            "d": np.arange(2), "name": "Kōbra"}, sort_keys=True)
+    assert json.loads(body) == {"a": "2024-01-02T03:04:05", "b": str(oid), "c": 0.5, "d": [0, 1], "name": "Kōbra"}
+    assert body.startswith(b'{"a"')
+
+
+# Test fields= is checked against the allowed fields
+def test_parse_fields():
+    assert streaming.parse_fields(None, ("name", "image")) is None
+    assert streaming.parse_fields("image, name,image", ("name", "image")) == ["image", "name"]
+    with pytest.raises(ValueError):
+        streaming.parse_fields("name,password", ("name", "image"))
+    with pytest.raises(ValueError):
+        streaming.parse_fields(",", ("name", "image"))
+    assert streaming.project({"name": "Cobra", "image": "x"}, ["name"]) == {"name": "Cobra"}
+
+
+# Test the format is picked from format= before the Accept header
+def test_wants_ndjson():
+    assert streaming.wants_ndjson("ndjson", "application/json")
+    assert not streaming.wants_ndjson(None, "application/json, application/x-ndjson")
+    assert streaming.wants_ndjson(None, "application/x-ndjson")
+    assert not streaming.wants_ndjson(None, None)
+    with pytest.raises(ValueError):
+        streaming.wants_ndjson("xml")
+
+
+# Test streamed bodies parse the same however they are chunked
+def test_chunks():
+    items = [{"i": i, "name": "x" * 50} for i in range(100)]
+    chunks = list(streaming.json_chunks(iter(items), "items", lambda: {"next": 3}, chunk_bytes=256))
+    assert len(chunks) > 1
+    assert json.loads(b"".join(chunks)) == {"items": items, "next": 3}
+    assert json.loads(b"".join(streaming.json_chunks(iter([]), "items"))) == {"items": []}
+
+    lines = b"".join(streaming.ndjson_chunks(iter(items), lambda: {"next": 3}, chunk_bytes=256)).splitlines()
+    assert [json.loads(line) for line in lines] == items + [{"next": 3}]
+    assert list(streaming.ndjson_chunks(iter([]), lambda: None)) == []
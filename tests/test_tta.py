@@ -0,0 +1,59 @@
+import numpy as np
+
+from tta import MAX_VIEWS, TTAPolicy, augment, merge
+
+
+def make_image():
+    return np.random.default_rng(0).random((224, 224, 3), dtype=np.float32)
+
+
+# Test the augmented views are stacked into one batch
+def test_augment():
+    img = make_image()
+    views = augment(img, MAX_VIEWS)
+
+    assert views.shape == (MAX_VIEWS, 224, 224, 3)
+    np.testing.assert_array_equal(views[0], img)
+    np.testing.assert_array_equal(views[1], img[:, ::-1])
+    # Crops are resized back to the full input size
+    np.testing.assert_array_equal(views[3][0, 0], img[0, 0])
+    np.testing.assert_array_equal(views[6][-1, -1], img[-1, -1])
+
+    # K is clamped to the available views
+    assert augment(img, 20).shape[0] == MAX_VIEWS
+    assert augment(img, 0).shape[0] == 1
+
+    # The unchanged image can be left out
+    np.testing.assert_array_equal(augment(img, 4, first=1), views[1:4])
+
+
+# Test merging averages the logits of the views
+def test_merge():
+    probabilities = np.array([[0.7, 0.2, 0.1], [0.7, 0.2, 0.1]])
+    np.testing.assert_allclose(merge(probabilities), [0.7, 0.2, 0.1])
+
+    merged = merge([[0.9, 0.1], [0.1, 0.9]])
+    np.testing.assert_allclose(merged, [0.5, 0.5])
+
+
+# Test the adaptive policy only augments low-confidence predictions
+def test_policy():
+    policy = TTAPolicy(views=4, threshold=0.6)
+    assert policy.should_augment([0.5, 0.3, 0.2], "auto")
+    assert not policy.should_augment([0.9, 0.05, 0.05], "auto")
+    assert policy.should_augment([0.9, 0.05, 0.05], "always")
+    assert not policy.should_augment([0.5, 0.3, 0.2], "off")
+
+    calls = []
+
+    def predict_many(batch):
+        calls.append(len(batch))
+        return np.tile([0.5, 0.3, 0.2], (len(batch), 1))
+
+    np.testing.assert_allclose(policy.run(make_image(), predict_many), [0.5, 0.3, 0.2])
+    assert calls == [4]  # One forward pass for all the views
+
+    # Already predicted single-view probabilities are not predicted again
+    merged = policy.run(make_image(), predict_many, probabilities=[0.5, 0.3, 0.2])
+    np.testing.assert_allclose(merged, [0.5, 0.3, 0.2])
+    assert calls == [4, 3]
@@ -0,0 +1,68 @@
+import io
+
+import pytest
+from PIL import Image
+
+from uploads import HeaderProbe, UploadBuffer, UploadRejected
+
+
+def encode(size, format="JPEG"):
+    out = io.BytesIO()
+    Image.new("RGB", size, (120, 80, 40)).save(out, format)
+    return out.getvalue()
+
+
+def stream(buffer, data, chunk_size=1024):
+    for start in range(0, len(data), chunk_size):
+        buffer.write(data[start:start + chunk_size])
+
+
+# Test an image streams in and its header is checked on the way
+def test_upload_buffer_accepts_image():
+    data = encode((640, 480))
+    buffer = UploadBuffer(max_bytes=1024 * 1024, max_pixels=1_000_000)
+    stream(buffer, data)
+    assert buffer.probe.done
+    assert buffer.getvalue() == data
+
+
+# Test a file that is not an image is rejected from its first bytes, for
+# that file only
+def test_upload_buffer_rejects_other_formats():
+    buffer = UploadBuffer(max_bytes=1024 * 1024, max_pixels=1_000_000)
+    buffer.write(b"%PDF-1.7 " + b"x" * 100)
+    buffer.write(b"x" * 4096)
+    assert buffer.rejected.status == 415
+    assert buffer.getvalue() == b""
+
+    buffer = UploadBuffer(1024 * 1024, 1_000_000)
+    buffer.write(encode((10, 10), "GIF"))
+    assert buffer.rejected is not None
+
+
+# Test the byte limit is enforced while the upload arrives
+def test_upload_buffer_byte_limit():
+    buffer = UploadBuffer(max_bytes=4096, max_pixels=None)
+    with pytest.raises(UploadRejected) as e:
+        stream(buffer, encode((64, 64), "PNG") + b"\0" * 8192)
+    assert e.value.status == 413
+    assert buffer.tell() <= 4096
+
+
+# Test oversized dimensions are rejected from the header alone
+def test_header_probe_pixel_limit():
+    data = encode((2000, 1500))
+    probe = HeaderProbe(max_pixels=1_000_000)
+    with pytest.raises(UploadRejected) as e:
+        probe.check(data[:1024])
+    assert e.value.status == 413
+
+
+# Test a truncated header only fails once the upload is complete
+def test_header_probe_waits_for_more_data():
+    data = encode((100, 100))
+    probe = HeaderProbe(max_pixels=1_000_000)
+    probe.check(data[:12])
+    assert not probe.done
+    with pytest.raises(UploadRejected):
+        probe.check(data[:12], final=True)
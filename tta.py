@@ -0,0 +1,89 @@
+import numpy as np
+
+from imaging import TARGET_SIZE
+from postprocessing import log_probabilities, softmax
+
+# Side of the square crops, resized back up to the model's input size
+CROP_SIZE = 192
+
+# Views in the order they are added as K grows; each is (crop corner, flip).
+# None is the whole image, "center" and the corner names are CROP_SIZE crops.
+VIEWS = [
+    (None, False),
+    (None, True),
+    ("center", False),
+    ("top_left", False),
+    ("top_right", False),
+    ("bottom_left", False),
+    ("bottom_right", False),
+    ("center", True),
+]
+MAX_VIEWS = len(VIEWS)
+
+
+def _crop_indices(corner):
+    # Row and column indices that crop and nearest-neighbour resize in one gather
+    height, width = TARGET_SIZE
+    if corner is None:
+        return np.arange(height), np.arange(width)
+    top = {"center": (height - CROP_SIZE) // 2, "top_left": 0, "top_right": 0,
+           "bottom_left": height - CROP_SIZE, "bottom_right": height - CROP_SIZE}[corner]
+    left = {"center": (width - CROP_SIZE) // 2, "top_left": 0, "bottom_left": 0,
+            "top_right": width - CROP_SIZE, "bottom_right": width - CROP_SIZE}[corner]
+    rows = top + np.arange(height) * CROP_SIZE // height
+    cols = left + np.arange(width) * CROP_SIZE // width
+    return rows, cols
+
+
+def augment(img_array, views, out=None, first=0):
+    """Stacks the first `views` augmented views of one preprocessed
+    (224, 224, 3) image into a (views, 224, 224, 3) batch, leaving out the
+    `first` ones (first=1 skips the unchanged image)."""
+    views = min(max(int(views), 1), MAX_VIEWS)
+    if out is None:
+        out = np.empty((views - first,) + img_array.shape, dtype=img_array.dtype)
+    for i, (corner, flip) in enumerate(VIEWS[first:views]):
+        rows, cols = _crop_indices(corner)
+        if flip:
+            cols = cols[::-1]
+        out[i] = img_array[rows[:, None], cols]
+    return out
+
+
+def merge(probabilities):
+    """Combines the probabilities of every view of one image by averaging
+    their logits, i.e. the log-probabilities, and applying softmax again."""
+    return softmax(log_probabilities(probabilities).mean(axis=0))
+
+
+class TTAPolicy:
+    """Decides when a prediction is worth the extra forward passes of
+    test-time augmentation.
+
+    "always" augments every image; "auto" only those whose single-view top
+    probability is below `threshold`, so confident predictions cost nothing
+    extra; "off" never does. The number of views is capped at MAX_VIEWS.
+    """
+
+    MODES = ("off", "auto", "always")
+
+    def __init__(self, views=4, threshold=0.6):
+        self.views = min(max(int(views), 1), MAX_VIEWS)
+        self.threshold = float(threshold)
+
+    def should_augment(self, probabilities, mode):
+        if mode == "always":
+            return self.views > 1
+        if mode == "auto":
+            return self.views > 1 and float(np.max(probabilities)) < self.threshold
+        return False
+
+    def run(self, img_array, predict_many, probabilities=None):
+        """Runs every view through `predict_many` as one batch and merges the
+        results. The `probabilities` of the unchanged image, when they were
+        already predicted to decide on augmenting, stand in for the first
+        view, so only the other views are run."""
+        if probabilities is None:
+            return merge(predict_many(augment(img_array, self.views)))
+        augmented = predict_many(augment(img_array, self.views, first=1))
+        return merge(np.concatenate([np.asarray(probabilities)[np.newaxis], np.asarray(augmented)]))
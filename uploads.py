@@ -0,0 +1,105 @@
+import io
+
+from PIL import Image
+
+# Formats accepted for classification, by their leading bytes
+SIGNATURES = {
+    "JPEG": lambda head: head[:3] == b"\xff\xd8\xff",
+    "PNG": lambda head: head[:8] == b"\x89PNG\r\n\x1a\n",
+    "WEBP": lambda head: head[:4] == b"RIFF" and head[8:12] == b"WEBP",
+}
+SIGNATURE_BYTES = 12
+
+
+class UploadRejected(Exception):
+    """An upload that is too large or not an image we accept. `status` is
+    the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def sniff_format(head):
+    """The format named by an upload's first bytes; raises UploadRejected for anything else."""
+    for name, matches in SIGNATURES.items():
+        if matches(head):
+            return name
+    raise UploadRejected(f"Unsupported image format, use {', '.join(SIGNATURES)}", 415)
+
+
+def check_image(img, max_pixels):
+    """Rejects an opened (not yet decoded) image we would not decode."""
+    if img.format not in SIGNATURES:
+        raise UploadRejected(f"Unsupported image format, use {', '.join(SIGNATURES)}", 415)
+    width, height = img.size
+    if width < 1 or height < 1:
+        raise UploadRejected("Image has no pixels")
+    if max_pixels and width * height > max_pixels:
+        raise UploadRejected(f"Image is {width}x{height}, the limit is {max_pixels} pixels", 413)
+
+
+class HeaderProbe:
+    """Reads an image's header from the first bytes of an upload.
+
+    Each `check` gets everything received so far. The format is checked as
+    soon as the signature bytes are in, and the dimensions once PIL can parse
+    the header, which for JPEG can sit behind EXIF data. Attempts double in
+    size so a long header is not re-parsed for every chunk.
+    """
+
+    def __init__(self, max_pixels, max_header_bytes=256 * 1024):
+        self.max_pixels = max_pixels
+        self.max_header_bytes = max_header_bytes
+        self.done = False
+        self.next_attempt = SIGNATURE_BYTES
+
+    def check(self, head, final=False):
+        if self.done or (len(head) < self.next_attempt and not final):
+            return
+        sniff_format(head[:SIGNATURE_BYTES])
+        try:
+            img = Image.open(io.BytesIO(head))
+        except Image.DecompressionBombError as e:
+            raise UploadRejected(str(e), 413)
+        except Exception:
+            if final or len(head) >= self.max_header_bytes:
+                raise UploadRejected("Could not read the image header")
+            self.next_attempt = max(2 * len(head), 4096)
+            return
+        check_image(img, self.max_pixels)
+        self.done = True
+
+
+class UploadBuffer(io.BytesIO):
+    """In-memory file for one multipart upload.
+
+    Werkzeug writes the part into it as it arrives. More than `max_bytes`,
+    or an image of more than `max_pixels`, aborts the request there, before
+    the rest of the body is read. A header that is not an accepted image
+    only fails this file: the error is kept in `rejected` and the rest of
+    the part is discarded, so the other files of a batch are still read.
+    """
+
+    def __init__(self, max_bytes, max_pixels):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.probe = HeaderProbe(max_pixels)
+        self.rejected = None
+
+    def write(self, data):
+        if self.rejected is not None:
+            return len(data)
+        if self.max_bytes and self.tell() + len(data) > self.max_bytes:
+            raise UploadRejected(f"Image is larger than {self.max_bytes / (1024 * 1024):g} MB", 413)
+        written = super().write(data)
+        if not self.probe.done and self.tell() >= self.probe.next_attempt:
+            try:
+                self.probe.check(self.getvalue()[:self.probe.max_header_bytes])
+            except UploadRejected as e:
+                if e.status == 413:
+                    raise
+                self.rejected = e
+                self.seek(0)
+                self.truncate()
+        return written